@@ -0,0 +1,54 @@
+"""
+Compare the JSON backends available in powertrack.json_helper on decoding and converting synthetic activity lines.
+
+    python -m benchmarks.bench_json --count 1000000
+"""
+import argparse
+import time
+
+from powertrack import json_helper
+from powertrack.csv_helper import RowConverter
+from benchmarks.synthetic import make_lines
+
+
+def run(lines, backend):
+    """
+    Decode and convert activity lines with a JSON backend
+    :param lines: Activity lines
+    :param backend: One of json_helper.BACKENDS
+    :return: (seconds, rows) tuple
+    """
+    json_helper.set_backend(backend)
+    converter = RowConverter()
+
+    t = time.time()
+    rows = [converter.convert(json_helper.loads(line)) for line in lines]
+
+    return time.time() - t, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=1000000, help="number of tweets")
+    args = parser.parse_args()
+
+    lines = list(make_lines(args.count))
+    stdlib_time, stdlib_rows = run(lines, json_helper.STDLIB)
+    print("{backend:8} {time:.2f}s ({per_tweet:.2f} us/tweet)".format(backend=json_helper.STDLIB, time=stdlib_time,
+                                                                    per_tweet=stdlib_time / args.count * 1e6))
+
+    for backend in json_helper.BACKENDS:
+        if backend == json_helper.STDLIB:
+            continue
+        try:
+            backend_time, rows = run(lines, backend)
+        except ImportError:
+            print("{backend:8} not installed".format(backend=backend))
+            continue
+        print("{backend:8} {time:.2f}s ({per_tweet:.2f} us/tweet, {gain:.2f} us/tweet faster), output {identical}".format(
+            backend=backend, time=backend_time, per_tweet=backend_time / args.count * 1e6,
+            gain=(stdlib_time - backend_time) / args.count * 1e6, identical="identical" if rows == stdlib_rows else "DIFFERS"))
+
+
+if __name__ == "__main__":
+    main()
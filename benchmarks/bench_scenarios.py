@@ -0,0 +1,198 @@
+"""
+Run end-to-end export scenarios against a local GNIP stand-in and report tweets/s, bytes/s and peak RSS.
+
+    python -m benchmarks.bench_scenarios --files 20 --tweets-per-file 10000 --search-tweets 50000
+
+Every scenario runs in its own process, so that peak RSS figures don't include the previous ones (nor the stand-in server, which runs in
+yet another process). Bytes are what the stand-in sent for network scenarios, JSON for tweet2csv and tweet bodies for find_category.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import urllib2
+from multiprocessing import Event, Process, Queue
+
+from benchmarks.gnip_server import ACCOUNT_NAME, LABEL, GnipStandIn
+from benchmarks.synthetic import WORDS, make_lines
+
+
+HISTORICAL_ENGINES = ("threads", "processes", "async")
+SCENARIOS = ["tweet2csv", "find_category", "search", "search_windows"] + ["build_csv_file_" + engine for engine in HISTORICAL_ENGINES]
+
+
+def serve(folder, args, url_q, stop):
+    """
+    Stand-in server process
+    """
+    stand_in = GnipStandIn(folder, num_files=args.files, tweets_per_file=args.tweets_per_file, search_tweets=args.search_tweets).start()
+    url_q.put(stand_in.url)
+    stop.wait()
+    stand_in.stop()
+
+
+def bytes_sent(url):
+    return json.loads(urllib2.urlopen(url + "/stats").read())["bytes_sent"]
+
+
+def configure(folder, args, engine=None):
+    """
+    Point powertrack's config to the stand-in, overriding any local config file
+    """
+    from powertrack.config_helper import config
+
+    settings = {
+        "credentials": {"account_name": ACCOUNT_NAME, "username": "benchmark", "password": "benchmark", "label": LABEL},
+        "output": {"folder": folder, "num_threads": str(args.threads), "format": "csv"},
+    }
+    if engine is not None:
+        settings["output"]["engine"] = engine
+
+    config.remove_section("cache")
+    for section, options in settings.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options.items():
+            config.set(section, option, value)
+
+
+def run_tweet2csv(url, folder, args):
+    from powertrack import json_helper
+    from powertrack.csv_helper import tweet2csv
+
+    lines = list(make_lines(args.count))
+    tweets = [json_helper.loads(line) for line in lines]
+
+    t = time.time()
+    for tweet in tweets:
+        tweet2csv(tweet)
+    return time.time() - t, len(tweets), sum(len(line) for line in lines)
+
+
+def run_find_category(url, folder, args):
+    from powertrack import json_helper
+    from powertrack.category_helper import Job
+
+    job = Job("benchmark")
+    for i in range(args.categories):
+        job.create_category("category{i}".format(i=i), ["term{i}_{j}".format(i=i, j=j) for j in range(args.terms_per_category)])
+    for word in WORDS:
+        job.create_category(word.encode("utf-8"), [word.encode("utf-8")])
+    tweets = [json_helper.loads(line) for line in make_lines(args.count)]
+
+    t = time.time()
+    for tweet in tweets:
+        job.find_category(tweet["body"], tweet["twitter_entities"])
+    return time.time() - t, len(tweets), sum(len(tweet["body"].encode("utf-8")) for tweet in tweets)
+
+
+def run_search(url, folder, args, concurrency=1):
+    from powertrack.api import SEARCH_API, PowerTrack
+
+    pt = PowerTrack(api=SEARCH_API)
+    pt.powertrack_root_url = url + "/"
+    job = pt.jobs.create(title="search")
+
+    start_bytes = bytes_sent(url)
+    t = time.time()
+    count = job.export_tweets(concurrency=concurrency)
+    return time.time() - t, count, bytes_sent(url) - start_bytes
+
+
+def run_search_windows(url, folder, args):
+    return run_search(url, folder, args, concurrency=args.search_concurrency)
+
+
+def run_build_csv_file(url, folder, args):
+    from powertrack.api import HISTORICAL_API, PowerTrack
+
+    pt = PowerTrack(api=HISTORICAL_API)
+    pt.powertrack_root_url = url + "/"
+    job = pt.jobs.get()[0]
+
+    start_bytes = bytes_sent(url)
+    t = time.time()
+    job.export_tweets()
+    return time.time() - t, args.files * args.tweets_per_file, bytes_sent(url) - start_bytes
+
+
+def run_scenario(scenario, url, args, result_q):
+    """
+    Scenario process
+    """
+    folder = tempfile.mkdtemp(prefix="powertrack-benchmark-")
+    engine = scenario[len("build_csv_file_"):] if scenario.startswith("build_csv_file_") else None
+    configure(folder, args, engine)
+    sys.stdout = open(os.devnull, "w")  # Exports report their progress
+
+    try:
+        runner = run_build_csv_file if engine is not None else globals()["run_" + scenario]
+        seconds, tweets, num_bytes = runner(url, folder, args)
+    except Exception as e:  # Such as ImportError for the async engine without tornado
+        result_q.put({"scenario": scenario, "error": "{name}: {error}".format(name=type(e).__name__, error=e)})
+        return
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    result_q.put({
+        "scenario": scenario,
+        "seconds": seconds,
+        "tweets": tweets,
+        "bytes": num_bytes,
+        "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,  # Linux reports kilobytes
+        "children_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated list of scenarios (all of them by default)")
+    parser.add_argument("--count", type=int, default=100000, help="number of tweets for tweet2csv and find_category")
+    parser.add_argument("--files", type=int, default=10, help="number of Historical API data files")
+    parser.add_argument("--tweets-per-file", type=int, default=10000, help="number of tweets per data file")
+    parser.add_argument("--search-tweets", type=int, default=20000, help="number of Search API results")
+    parser.add_argument("--search-concurrency", type=int, default=4, help="number of windows for search_windows")
+    parser.add_argument("--threads", type=int, default=4, help="num_threads for the threads engine")
+    parser.add_argument("--categories", type=int, default=100, help="number of extra categories for find_category")
+    parser.add_argument("--terms-per-category", type=int, default=10, help="number of terms per extra category")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario {scenario}, choose from {scenarios}".format(scenario=scenario, scenarios=", ".join(SCENARIOS)))
+
+    data_folder = tempfile.mkdtemp(prefix="powertrack-gnip-")
+    url_q = Queue()
+    stop = Event()
+    server = Process(target=serve, args=(data_folder, args, url_q, stop))
+    server.start()
+
+    try:
+        url = url_q.get()
+        print("{scenario:24} {tweets:>10} {seconds:>9} {rate:>11} {mb_rate:>8} {rss:>12} {children_rss:>12}".format(
+            scenario="scenario", tweets="tweets", seconds="seconds", rate="tweets/s", mb_rate="MB/s", rss="peak RSS MB",
+            children_rss="workers MB"))
+        for scenario in scenarios:
+            result_q = Queue()
+            process = Process(target=run_scenario, args=(scenario, url, args, result_q))
+            process.start()
+            result = result_q.get()
+            process.join()
+            if "error" in result:
+                print("{scenario:24} not run, {error}".format(**result))
+                continue
+            print("{scenario:24} {tweets:>10} {seconds:>9.2f} {rate:>11.0f} {mb_rate:>8.2f} {rss:>12.1f} {children_rss:>12.1f}".format(
+                rate=result["tweets"] / result["seconds"], mb_rate=result["bytes"] / result["seconds"] / 1024 / 1024, **result))
+    finally:
+        stop.set()
+        server.join()
+        shutil.rmtree(data_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Compare RowConverter with the per-tweet implementation of tweet2csv it replaced.
+
+    python -m benchmarks.bench_tweet2csv --count 3000000
+"""
+import argparse
+import json
+import time
+
+from powertrack.csv_helper import RowConverter, get_field
+from benchmarks.synthetic import make_lines
+
+
+def legacy_get_the_geom(tweet):
+    """
+    get_the_geom as it was before geometry_helper, kept as the baseline
+    :param tweet:
+    :return:
+    """
+    try:
+        the_geom = tweet["geo"]
+    except KeyError:
+        pass
+    else:
+        try:
+            # Fix twitter's geojson in the geo field
+            lat = the_geom["coordinates"][0]
+            lon = the_geom["coordinates"][1]
+            the_geom["coordinates"][0] = lon
+            the_geom["coordinates"][1] = lat
+            return json.dumps(the_geom)
+        except (KeyError, TypeError, IndexError):
+            pass
+
+    try:
+        the_geom = tweet["location"]["geo"]
+    except (KeyError, TypeError, IndexError):
+        pass
+    else:
+        try:
+            if the_geom["type"] == "point" or the_geom["type"] == "Point":
+                return json.dumps(the_geom)
+            elif the_geom["type"] == "polygon" or the_geom["type"] == "Polygon":
+                bbox = zip(*the_geom["coordinates"][0])
+                the_geom = {"type": "point", "coordinates": [(max(bbox[0]) + min(bbox[0])) / 2, (max(bbox[1]) + min(bbox[1])) / 2]}
+                return json.dumps(the_geom)
+        except (KeyError, TypeError, IndexError):
+            pass
+
+    try:
+        the_geom = tweet["gnip"]["profileLocations"][0]["geo"]
+    except (KeyError, TypeError, IndexError):
+        pass
+    else:
+        try:
+            if the_geom["type"] == "point" or the_geom["type"] == "Point":
+                return json.dumps(the_geom)
+            elif the_geom["type"] == "polygon" or the_geom["type"] == "Polygon":
+                bbox = zip(*the_geom["coordinates"][0])
+                the_geom = {"type": "point", "coordinates": [(max(bbox[0]) + min(bbox[0])) / 2, (max(bbox[1]) + min(bbox[1])) / 2]}
+                return json.dumps(the_geom)
+        except (KeyError, TypeError, IndexError):
+            pass
+
+
+def legacy_tweet2csv(tweet=None, columns=None):
+    """
+    tweet2csv as it was before RowConverter, kept as the baseline (column name typos included)
+    """
+    if tweet is not None:
+        the_geom = legacy_get_the_geom(tweet)
+        if the_geom is None:
+            return None
+    else:  # Header row
+        the_geom = None
+
+    tweet = tweet or {}
+
+    actor = tweet.get("actor", {})
+    location = tweet.get("location", {})
+
+    row = {
+        "the_geom": the_geom,
+        "postedtime": get_field(tweet, "postedTime", ""),
+    }
+
+    if columns is None or "actor_displayname" in columns:
+        row["actor_displayname"] = get_field(actor, "displayName", "")
+    if columns is None or "actor_followerscount" in columns:
+        row["actor_followerscount"] = get_field(actor, "followersCount", 0)
+    if columns is None or "actor_friendscount" in columns:
+        row["actor_friendscount"] = get_field(actor, "friendsCount", 0)
+    if columns is None or "actor_id" in columns:
+        row["actor_id"] = get_field(actor, "id", "")
+    if columns is None or "actor_dispactor_imagelayname" in columns:
+        row["actor_image"] = get_field(actor, "image", "")
+    if columns is None or "actor_listedcount" in columns:
+        row["actor_listedcount"] = get_field(actor, "listedCount", 0)
+    if columns is None or "actor_location" in columns:
+        row["actor_location"] = get_field(actor, "location", "", as_json=True)
+    if columns is None or "actor_postedtime" in columns:
+        row["actor_postedtime"] = get_field(actor, "postedTime", "")
+    if columns is None or "actor_preferredusername" in columns:
+        row["actor_preferredusername"] = get_field(actor, "preferredUsername", "")
+    if columns is None or "actor_statusescount" in columns:
+        row["actor_statusescount"] = get_field(actor, "statusesCount", 0)
+    if columns is None or "actor_summary" in columns:
+        row["actor_summary"] = get_field(actor, "summary", "")
+    if columns is None or "actor_utcoffset" in columns:
+        row["actor_utcoffset"] = get_field(actor, "utcOffset", 0)
+    if columns is None or "actor_verified" in columns:
+        row["actor_verified"] = get_field(actor, "verified", False)
+    if columns is None or "body" in columns:
+        row["body"] = get_field(tweet, "body", "")
+    if columns is None or "favoritescount" in columns:
+        row["favoritescount"] = get_field(tweet, "favoritesCount", 0)
+    if columns is None or "geo" in columns:
+        row["geo"] = get_field(tweet, "geo", "", as_json=True)
+    if columns is None or "actoinreplyto_linkr_displayname" in columns:
+        row["inreplyto_link"] = get_field(tweet, "inReplyTo", "", as_json=True)
+    if columns is None or "link" in columns:
+        row["link"] = get_field(tweet, "link", "")
+    if columns is None or "location_geo" in columns:
+        row["location_geo"] = get_field(location, "geo", "", as_json=True)
+    if columns is None or "location_name" in columns:
+        row["location_name"] = get_field(location, "name", "")
+    if columns is None or "object_type" in columns:
+        row["object_type"] = get_field(tweet, "objectType", "")
+    if columns is None or "retweetcount" in columns:
+        row["retweetcount"] = get_field(tweet, "retweetCount", 0)
+    if columns is None or "actor_distwitter_entitiesplayname" in columns:
+        row["twitter_entities"] = get_field(tweet, "twitter_entities", "", as_json=True)
+    if columns is None or "actor_twitter_langdisplayname" in columns:
+        row["twitter_lang"] = get_field(tweet, "twitter_lang", "")
+
+    if tweet:
+        keys = sorted(row.keys())
+        return [row[key] for key in keys]
+    else:
+        return sorted(row.keys())
+
+
+def run(count, columns, chunk_size=10000):
+    """
+    Convert the same synthetic tweets with both implementations, timing only the conversion
+    :param count: Number of tweets
+    :param columns: Array of columns, None for all columns
+    :param chunk_size: Tweets generated at once, to keep memory usage low
+    :return: (legacy seconds, RowConverter seconds) tuple
+    """
+    converter = RowConverter(columns)
+    legacy_time = 0.0
+    converter_time = 0.0
+
+    for start in range(0, count, chunk_size):
+        lines = list(make_lines(min(chunk_size, count - start), start=start))
+
+        tweets = [json.loads(line) for line in lines]  # get_the_geom modifies tweets, so each implementation gets its own copy
+        t = time.time()
+        legacy_rows = [legacy_tweet2csv(tweet, columns) for tweet in tweets]
+        legacy_time += time.time() - t
+
+        tweets = [json.loads(line) for line in lines]
+        t = time.time()
+        rows = [converter.convert(tweet) for tweet in tweets]
+        converter_time += time.time() - t
+
+        if columns is None and rows != legacy_rows:
+            raise AssertionError("RowConverter output differs from the legacy tweet2csv output")
+
+    return legacy_time, converter_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=3000000, help="number of tweets")
+    parser.add_argument("--columns", default=None, help="comma-separated list of columns (all of them by default)")
+    args = parser.parse_args()
+
+    columns = args.columns.split(",") if args.columns else None
+    legacy_time, converter_time = run(args.count, columns)
+
+    print("tweets: {count}, columns: {columns}".format(count=args.count, columns=args.columns or "all"))
+    print("legacy tweet2csv: {time:.2f}s ({rate:.0f} tweets/s)".format(time=legacy_time, rate=args.count / legacy_time))
+    print("RowConverter:     {time:.2f}s ({rate:.0f} tweets/s)".format(time=converter_time, rate=args.count / converter_time))
+    print("speedup: {speedup:.2f}x".format(speedup=legacy_time / converter_time))
+
+
+if __name__ == "__main__":
+    main()
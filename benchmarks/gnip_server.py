@@ -0,0 +1,209 @@
+"""
+Local stand-in for the GNIP endpoints used by powertrack, so that exports can be benchmarked without network access or paid API calls.
+
+It serves a single delivered Historical API job (jobs.json, the job itself and its urlList), the gzipped data files of that job, and
+the Search API data and counts endpoints, with "next" pagination and fromDate/toDate filtering (queries are ignored: every tweet
+matches). GET /stats returns the number of response bytes sent so far.
+"""
+import json
+import os
+import re
+import shutil
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from benchmarks.synthetic import make_lines, write_data_file
+
+
+ACCOUNT_NAME = "benchmark"
+LABEL = "benchmark"
+JOB_UUID = "benchmark"
+JOB_TITLE = "benchmark"
+DEFAULT_MAX_RESULTS = 500
+COPY_BUFFER_SIZE = 64 * 1024
+
+JOBS_PATH = "/historical/powertrack/accounts/{account_name}/publishers/twitter/jobs".format(account_name=ACCOUNT_NAME)
+SEARCH_PATH = "/search/30day/accounts/{account_name}/{label}".format(account_name=ACCOUNT_NAME, label=LABEL)
+
+
+def posted_time_to_date(posted_time):
+    """
+    :param posted_time: Activity postedTime, such as "2016-06-01T12:30:00.000Z"
+    :return: Same time in GNIP's fromDate/toDate format, such as "201606011230"
+    """
+    return re.sub(r"\D", "", posted_time)[:12]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class GnipHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, as GNIP does
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.stand_in.count_bytes(len(body))
+
+    def send_file(self, file_name):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(file_name)))
+        self.end_headers()
+        with open(file_name, "rb") as data_file:
+            shutil.copyfileobj(data_file, self.wfile, COPY_BUFFER_SIZE)
+        self.server.stand_in.count_bytes(os.path.getsize(file_name))
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        path = urlparse.urlparse(self.path).path
+
+        if path == JOBS_PATH + ".json":
+            self.send_body(json.dumps({"jobs": [stand_in.job_data()]}))
+        elif path == "{jobs_path}/{uuid}.json".format(jobs_path=JOBS_PATH, uuid=JOB_UUID):
+            self.send_body(json.dumps(stand_in.job_data()))
+        elif path == "{jobs_path}/{uuid}/results.json".format(jobs_path=JOBS_PATH, uuid=JOB_UUID):
+            url_list = [stand_in.url + "/data/" + name for name in stand_in.data_file_names]
+            self.send_body(json.dumps({"urlCount": len(url_list), "urlList": url_list, "totalFileSizeBytes": stand_in.data_size}))
+        elif path.startswith("/data/") and os.path.basename(path) in stand_in.data_file_names:
+            self.send_file(os.path.join(stand_in.folder, os.path.basename(path)))
+        elif path == "/stats":
+            self.send_body(json.dumps({"bytes_sent": stand_in.bytes_sent}))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        stand_in = self.server.stand_in
+        path = urlparse.urlparse(self.path).path
+        request_data = json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))) or "{}")
+
+        if path == SEARCH_PATH + ".json":
+            self.send_body(stand_in.search_page(request_data))
+        elif path == SEARCH_PATH + "/counts.json":
+            self.send_body(stand_in.search_counts(request_data))
+        else:
+            self.send_error(404)
+
+
+class GnipStandIn(object):
+    """
+    GNIP stand-in server, running in a background thread. Data files and search results are generated when it's created
+    """
+    def __init__(self, folder, num_files=10, tweets_per_file=10000, search_tweets=10000, seed=0):
+        """
+        GnipStandIn constructor
+        :param folder: Folder where data files are written
+        :param num_files: Number of data files in the Historical API job
+        :param tweets_per_file: Number of tweets per data file
+        :param search_tweets: Number of tweets returned by the Search API
+        :param seed: Random seed
+        :return:
+        """
+        self.folder = folder
+        self.data_file_names = []
+        self.data_size = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+
+        for i in range(num_files):
+            name = "{i:05d}.json.gz".format(i=i)
+            self.data_size += write_data_file(os.path.join(folder, name), tweets_per_file, seed=seed + i, start=i * tweets_per_file)
+            self.data_file_names.append(name)
+        self.historical_tweets = num_files * tweets_per_file
+
+        # Search results are kept as encoded lines, newest first, so that pages are just joined together
+        lines = list(make_lines(search_tweets, seed=seed))
+        dates = [posted_time_to_date(json.loads(line)["postedTime"]) for line in lines]
+        self.search_results = sorted(zip(dates, lines), reverse=True)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), GnipHandler)
+        self.server.stand_in = self
+        self.url = "http://127.0.0.1:{port}".format(port=self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count_bytes(self, num_bytes):
+        with self.lock:
+            self.bytes_sent += num_bytes
+
+    def job_data(self):
+        """
+        :return: The delivered Historical API job, as GNIP describes it
+        """
+        return {
+            "title": JOB_TITLE,
+            "account": ACCOUNT_NAME,
+            "publisher": "twitter",
+            "streamType": "track",
+            "format": "activity_streams",
+            "fromDate": "201606010000",
+            "toDate": "201607010000",
+            "requestedBy": "benchmark@example.com",
+            "requestedAt": "2016-07-01T00:00:00Z",
+            "acceptedBy": "benchmark@example.com",
+            "acceptedAt": "2016-07-01T00:00:00Z",
+            "jobURL": "{url}{jobs_path}/{uuid}.json".format(url=self.url, jobs_path=JOBS_PATH, uuid=JOB_UUID),
+            "status": "delivered",
+            "statusMessage": "Job delivered and available for download.",
+            "percentComplete": 100,
+            "quote": {"estimatedActivityCount": self.historical_tweets},
+            "results": {
+                "activityCount": self.historical_tweets,
+                "fileCount": len(self.data_file_names),
+                "fileSizeMb": self.data_size / 1024.0 / 1024.0,
+                "dataURL": "{url}{jobs_path}/{uuid}/results.json".format(url=self.url, jobs_path=JOBS_PATH, uuid=JOB_UUID),
+            },
+        }
+
+    def select(self, request_data):
+        """
+        :param request_data: Search API request
+        :return: Search results (date, line) within the request's time span
+        """
+        from_date = request_data.get("fromDate", "")
+        to_date = request_data.get("toDate", "999999999999")
+        return [result for result in self.search_results if from_date <= result[0] < to_date]
+
+    def search_page(self, request_data):
+        """
+        :param request_data: Search API data request
+        :return: Response body, with a "next" token if there are more results
+        """
+        results = self.select(request_data)
+        start = int(request_data.get("next", 0))
+        end = start + int(request_data.get("maxResults", DEFAULT_MAX_RESULTS))
+        body = '{"results": [' + ", ".join(line for date, line in results[start:end]) + ']'
+        if end < len(results):
+            body += ', "next": "{end}"'.format(end=end)
+        return body + ', "requestParameters": ' + json.dumps(request_data) + '}'
+
+    def search_counts(self, request_data):
+        """
+        :param request_data: Search API counts request
+        :return: Response body, with the number of tweets per bucket
+        """
+        length = {"day": 8, "hour": 10, "minute": 12}[request_data.get("bucket", "day")]
+        counts = {}
+        for date, line in self.select(request_data):
+            bucket = date[:length].ljust(12, "0")
+            counts[bucket] = counts.get(bucket, 0) + 1
+        return json.dumps({"results": [{"timePeriod": bucket, "count": count} for bucket, count in sorted(counts.items())],
+                           "totalCount": sum(counts.values()), "requestParameters": request_data})
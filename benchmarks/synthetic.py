@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic activity-streams tweets for benchmarks
+"""
+import gzip
+import json
+import os
+import random
+
+
+POINT = "point"
+POLYGON = "polygon"
+PROFILE = "profile"
+NO_GEO = "none"
+
+GEO_VARIANTS = (POINT, POLYGON, PROFILE, NO_GEO)
+
+WORDS = [u"lakers", u"celtics", u"game", u"tonight", u"#nba", u"@nba", u"randle", u"ainge", u"finals", u"señor", u"what", u"a", u"play"]
+
+
+def make_tweet(i, geo_variant=None, rnd=random):
+    """
+    Build a synthetic activity
+    :param i: Sequence number, used to build ids and timestamps
+    :param geo_variant: One of GEO_VARIANTS, chosen from i if None
+    :param rnd: Random number generator
+    :return: Tweet in json format
+    """
+    geo_variant = geo_variant or GEO_VARIANTS[i % len(GEO_VARIANTS)]
+    lon = rnd.uniform(-180, 180)
+    lat = rnd.uniform(-85, 85)
+
+    tweet = {
+        "id": "tag:search.twitter.com,2005:{id}".format(id=700000000000000000 + i),
+        "objectType": "activity",
+        "postedTime": "2016-06-{day:02d}T{hour:02d}:{minute:02d}:{second:02d}.000Z".format(day=1 + i % 28, hour=i % 24, minute=i % 60,
+                                                                                         second=(i // 60) % 60),
+        "body": u" ".join(rnd.choice(WORDS) for _ in range(12)),
+        "link": "http://twitter.com/user/statuses/{id}".format(id=700000000000000000 + i),
+        "favoritesCount": rnd.randint(0, 100),
+        "retweetCount": rnd.randint(0, 100),
+        "twitter_lang": "en",
+        "actor": {
+            "id": "id:twitter.com:{id}".format(id=i % 100000),
+            "displayName": u"User {i}".format(i=i % 100000),
+            "preferredUsername": "user{i}".format(i=i % 100000),
+            "image": "https://pbs.twimg.com/profile_images/{i}/a.png".format(i=i % 100000),
+            "summary": u"Just a\nsynthetic user",
+            "postedTime": "2010-01-01T00:00:00.000Z",
+            "followersCount": rnd.randint(0, 10000),
+            "friendsCount": rnd.randint(0, 1000),
+            "listedCount": rnd.randint(0, 10),
+            "statusesCount": rnd.randint(0, 100000),
+            "utcOffset": None,
+            "verified": rnd.random() < 0.01,
+            "location": {"objectType": "place", "displayName": u"Somewhere"},
+        },
+        "twitter_entities": {
+            "hashtags": [{"text": u"lakers", "indices": [0, 7]}],
+            "user_mentions": [{"screen_name": u"nba", "indices": [8, 12]}],
+            "urls": [],
+        },
+    }
+
+    if geo_variant == POINT:
+        tweet["geo"] = {"type": "Point", "coordinates": [lat, lon]}  # Twitter's lat, lon order
+    elif geo_variant == POLYGON:
+        tweet["location"] = {
+            "objectType": "place",
+            "name": u"Somewhere",
+            "geo": {"type": "Polygon", "coordinates": [[[lon, lat], [lon, lat + 0.1], [lon + 0.1, lat + 0.1], [lon + 0.1, lat]]]},
+        }
+    elif geo_variant == PROFILE:
+        tweet["gnip"] = {"profileLocations": [{"objectType": "place", "geo": {"type": "point", "coordinates": [lon, lat]}}]}
+
+    return tweet
+
+
+def make_tweets(count, seed=0, start=0):
+    """
+    Generate synthetic tweets
+    :param count: Number of tweets
+    :param seed: Random seed, so that runs can be compared
+    :param start: Sequence number of the first tweet
+    :return: Generator of tweets in json format
+    """
+    rnd = random.Random(seed)
+    for i in range(start, start + count):
+        yield make_tweet(i, rnd=rnd)
+
+
+def make_lines(count, seed=0, start=0):
+    """
+    Generate synthetic activity-streams lines, as found in GNIP data files
+    :param count: Number of tweets
+    :param seed: Random seed
+    :param start: Sequence number of the first tweet
+    :return: Generator of json strings
+    """
+    for tweet in make_tweets(count, seed=seed, start=start):
+        yield json.dumps(tweet)
+
+
+def write_data_file(file_name, count, seed=0, start=0):
+    """
+    Write a synthetic GNIP data file: gzipped activity lines followed by the info line that closes every data file
+    :param file_name: Data file name
+    :param count: Number of tweets
+    :param seed: Random seed
+    :param start: Sequence number of the first tweet
+    :return: Size of the data file, in bytes
+    """
+    data_file = gzip.open(file_name, "wb")
+    try:
+        for line in make_lines(count, seed=seed, start=start):
+            data_file.write(line + "\n")
+        data_file.write(json.dumps({"info": {"message": "Replay Request Completed", "sent": "2016-06-29T00:00:00+00:00",
+                                             "activity_count": count}}) + "\n")
+    finally:
+        data_file.close()
+
+    return os.path.getsize(file_name)
@@ -0,0 +1,219 @@
+import calendar
+import struct
+import time
+from binascii import unhexlify
+from math import atan, degrees, log, pi, radians, sin, sinh
+
+from powertrack import json_helper
+from powertrack.config_helper import get_option
+from powertrack.csv_helper import Row
+from powertrack.geometry_helper import EWKB, get_geometry_format, to_ewkb
+from powertrack.json_helper import dumps
+
+
+QUADKEY = "quadkey"
+LATLON = "latlon"
+GRIDS = (QUADKEY, LATLON)
+
+DEFAULT_ZOOM = 10
+DEFAULT_TIME_BUCKET = 3600  # Seconds
+DEFAULT_CATEGORY_COLUMN = "category_name"  # See category_helper.Job
+
+MAX_LATITUDE = 85.05112878  # Web Mercator tiles don't go any further
+
+COUNT_COLUMN = "tweet_count"
+AGGREGATE_HEADER = ["the_geom", "cell", "bucket", "category", COUNT_COLUMN]
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def get_coordinates(point):
+    """
+    :param point: Point GeoJSON dictionary
+    :return: (lon, lat) tuple, or None if it's not a valid point
+    """
+    try:
+        coordinates = point["coordinates"]
+        return float(coordinates[0]), float(coordinates[1])
+    except (KeyError, TypeError, IndexError, ValueError):
+        return None
+
+
+def parse_point(the_geom):
+    """
+    :param the_geom: the_geom of a row, either GeoJSON or hex EWKB (see geometry_helper)
+    :return: (lon, lat) tuple, or None if it's not a point
+    """
+    try:
+        if the_geom.startswith("{"):
+            return get_coordinates(json_helper.loads(the_geom))
+        return struct.unpack("<dd", unhexlify(the_geom[18:50]))  # Coordinates follow a 9-byte header
+    except (AttributeError, TypeError, ValueError, struct.error):
+        return None
+
+
+def get_row_point(row, the_geom_index):
+    """
+    :param row: Row, as built by csv_helper.RowConverter or read back from a CSV file
+    :param the_geom_index: Index of the_geom in the row
+    :return: (lon, lat) tuple, or None if the row's geometry is not a point. Rows built by a converter keep their point, so only rows read
+             from files need the_geom to be parsed
+    """
+    if type(row) is Row and row.point is not None:
+        return get_coordinates(row.point)
+    return parse_point(row[the_geom_index])
+
+
+class Aggregator(object):
+    """
+    Counts tweets by grid cell, time bucket and category. Cells are Web Mercator tiles (identified by their quadkey) or the cells of a
+    regular lat/lon grid (identified as zoom/x/y), 360 / 2 ** zoom degrees wide, at a given zoom. Time buckets start at multiples of
+    time_bucket seconds since the epoch, and the_geom of every aggregate is the center of its cell, so the table can be mapped right away
+    (e.g. as a torque map of tweet_count over bucket)
+    """
+    def __init__(self, grid=QUADKEY, zoom=DEFAULT_ZOOM, time_bucket=DEFAULT_TIME_BUCKET, category_column=DEFAULT_CATEGORY_COLUMN,
+                 geometry_format=None):
+        """
+        Aggregator constructor
+        :param grid: QUADKEY or LATLON
+        :param zoom: Grid zoom level, there are 2 ** zoom cells along the equator
+        :param time_bucket: Bucket size in seconds
+        :param category_column: Column the category is taken from. Rows are not split by category if the export doesn't have it
+        :param geometry_format: Format of the_geom for cell centers (see geometry_helper). None for the one in the config file
+        :return:
+        """
+        if grid not in GRIDS:
+            raise ValueError("Unknown aggregation grid: {grid}".format(grid=grid))
+        self.grid = grid
+        self.zoom = zoom
+        self.size = 1 << zoom
+        self.time_bucket = time_bucket
+        self.category_column = category_column
+        self.geometry_format = geometry_format or get_geometry_format()
+        self.counts = {}
+        self.days = {}
+
+    def get_cell(self, lon, lat):
+        """
+        :return: (x, y) of the cell a point falls in
+        """
+        if self.grid == QUADKEY:
+            sin_lat = sin(radians(min(max(lat, -MAX_LATITUDE), MAX_LATITUDE)))
+            x = int((lon + 180.0) / 360.0 * self.size)
+            y = int((0.5 - log((1 + sin_lat) / (1 - sin_lat)) / (4 * pi)) * self.size)
+            return min(max(x, 0), self.size - 1), min(max(y, 0), self.size - 1)
+
+        cell_size = 360.0 / self.size
+        x = int((lon + 180.0) / cell_size)
+        y = int((lat + 90.0) / cell_size)
+        return min(max(x, 0), self.size - 1), min(max(y, 0), max(self.size // 2, 1) - 1)
+
+    def get_cell_center(self, x, y):
+        """
+        :return: (lon, lat) of the center of a cell
+        """
+        if self.grid == QUADKEY:
+            return (x + 0.5) / self.size * 360.0 - 180.0, degrees(atan(sinh(pi * (1 - 2 * (y + 0.5) / self.size))))
+
+        cell_size = 360.0 / self.size
+        return (x + 0.5) * cell_size - 180.0, (y + 0.5) * cell_size - 90.0
+
+    def get_cell_id(self, x, y):
+        if self.grid == QUADKEY:
+            digits = []
+            for i in range(self.zoom, 0, -1):
+                mask = 1 << (i - 1)
+                digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+            return "".join(digits)
+        return "{zoom}/{x}/{y}".format(zoom=self.zoom, x=x, y=y)
+
+    def parse_cell_id(self, cell_id):
+        """
+        :param cell_id: Result of get_cell_id
+        :return: (x, y) of the cell
+        """
+        if self.grid == QUADKEY:
+            x = y = 0
+            for digit in cell_id:
+                x = x << 1 | (int(digit) & 1)
+                y = y << 1 | (int(digit) >> 1)
+            return x, y
+        zoom, x, y = cell_id.split("/")
+        return int(x), int(y)
+
+    def get_bucket(self, postedtime):
+        """
+        :param postedtime: Timestamp as GNIP writes it, such as 2016-06-09T05:00:00.000Z
+        :return: Start of the bucket, in seconds since the epoch. Days are cached, as most tweets of an export share a few of them
+        """
+        try:
+            day = self.days[postedtime[:10]]
+        except KeyError:
+            day = self.days[postedtime[:10]] = calendar.timegm(time.strptime(postedtime[:10], "%Y-%m-%d"))
+        seconds = day + int(postedtime[11:13]) * 3600 + int(postedtime[14:16]) * 60 + int(postedtime[17:19])
+        return seconds - seconds % self.time_bucket
+
+    def indexes(self, header):
+        """
+        :param header: Column names of the rows to be added
+        :return: (the_geom index, postedtime index, category index or None) tuple, for add_rows
+        """
+        category_index = header.index(self.category_column) if self.category_column in header else None
+        return header.index("the_geom"), header.index("postedtime"), category_index
+
+    def add_rows(self, rows, indexes):
+        """
+        Count rows
+        :param rows: Iterable of rows
+        :param indexes: Result of indexes() for their header
+        :return: Number of rows that could not be counted, because their geometry or time are not valid
+        """
+        the_geom_index, postedtime_index, category_index = indexes
+        counts = self.counts
+        skipped = 0
+        for row in rows:
+            point = get_row_point(row, the_geom_index)
+            try:
+                bucket = self.get_bucket(row[postedtime_index])
+            except (TypeError, ValueError):
+                bucket = None
+            if point is None or bucket is None:
+                skipped += 1
+                continue
+            key = self.get_cell(*point) + (bucket, row[category_index] if category_index is not None else "")
+            counts[key] = counts.get(key, 0) + 1
+        return skipped
+
+    def seed(self, rows):
+        """
+        Add the aggregates of a previous export, so that appending to it keeps counting
+        :param rows: Rows of an aggregate table, as returned by get_rows (values may be strings, as read from CSV)
+        """
+        for the_geom, cell_id, bucket, category, count in rows:
+            key = self.parse_cell_id(cell_id) + (calendar.timegm(time.strptime(bucket, TIME_FORMAT)), category)
+            self.counts[key] = self.counts.get(key, 0) + int(count)
+
+    def get_rows(self):
+        """
+        :return: List of aggregate rows (see AGGREGATE_HEADER), sorted by bucket, cell and category
+        """
+        rows = []
+        for (x, y, bucket, category), count in sorted(self.counts.items(), key=lambda item: (item[0][2], item[0][:2], item[0][3])):
+            lon, lat = self.get_cell_center(x, y)
+            point = {"type": "Point", "coordinates": [lon, lat]}
+            the_geom = to_ewkb(point) if self.geometry_format == EWKB else dumps(point)
+            rows.append([the_geom, self.get_cell_id(x, y), time.strftime(TIME_FORMAT, time.gmtime(bucket)), category, count])
+        return rows
+
+
+def build_aggregator():
+    """
+    Create an Aggregator as set in the [aggregate] section of the config file
+    :return: Aggregator, or None if the section doesn't set a grid
+    """
+    grid = get_option('aggregate', 'grid')
+    if grid is None:
+        return None
+    return Aggregator(grid=grid,
+                      zoom=get_option('aggregate', 'zoom', DEFAULT_ZOOM, int),
+                      time_bucket=get_option('aggregate', 'time_bucket', DEFAULT_TIME_BUCKET, int),
+                      category_column=get_option('aggregate', 'category_column', DEFAULT_CATEGORY_COLUMN))
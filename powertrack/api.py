@@ -1,17 +1,18 @@
-import ConfigParser
 import json
-import requests
 import urlparse
+from functools import partial
 
+from powertrack.config_helper import config, get_option
+from powertrack.http_helper import DEFAULT_POOL_CONNECTIONS, DEFAULT_TIMEOUT, build_session
 from powertrack.historical_api import JobManager as HistoricalAPIJobManager
+from powertrack.schedule_helper import AdaptiveConcurrency, build_scheduler
 from powertrack.search_api import JobManager as SearchAPIJobManager
 
 
 HISTORICAL_API = "historical"
 SEARCH_API = "search"
 
-config = ConfigParser.RawConfigParser()
-config.read("powertrack.conf")
+DEFAULT_NUM_THREADS = 10
 
 
 class PowerTrack(object):
@@ -23,7 +24,18 @@ class PowerTrack(object):
         self.password = config.get('credentials', 'password')
         self.label = config.get('credentials', 'label')
         self.folder = config.get('output', 'folder')
-        self.num_threads = config.get('output', 'num_threads')
+        self.num_threads = get_option('output', 'num_threads', DEFAULT_NUM_THREADS, int)
+
+        # Download threads start at num_threads, and adapt between min_threads and max_threads to throughput and throttling
+        self.concurrency = AdaptiveConcurrency(self.num_threads,
+                                               minimum=get_option('output', 'min_threads', 1, int),
+                                               maximum=get_option('output', 'max_threads', 2 * self.num_threads, int))
+        self.scheduler = build_scheduler(self.concurrency)
+
+        self.timeout = (get_option('connection', 'connect_timeout', DEFAULT_TIMEOUT[0], float),
+                        get_option('connection', 'read_timeout', DEFAULT_TIMEOUT[1], float))
+        self.session = build_session(get_option('connection', 'pool_connections', DEFAULT_POOL_CONNECTIONS, int),
+                                     get_option('connection', 'pool_maxsize', self.concurrency.maximum + 1, int))
 
         if self.api == HISTORICAL_API:
             self.powertrack_root_url = "https://gnip-api.gnip.com/"
@@ -42,22 +54,26 @@ class PowerTrack(object):
 
     def get(self, path):
         """
-        GET request to a relative path with basic authentication
+        GET request to a relative path with basic authentication. Like every other request, it goes through the scheduler, which rate
+        limits it and retries it if it's throttled or fails (see schedule_helper)
         :param path: Relative path
         :return: Response
         """
         url = self.build_url(path)
-        return requests.get(url, auth=(self.username, self.password))
+        return self.scheduler.send(partial(self.session.get, url, auth=(self.username, self.password), timeout=self.timeout))
 
-    def post(self, path, data):
+    def post(self, path, data, retry_errors=True):
         """
         POST request to a relative path with basic authentication
         :param path: Relative path
         :param data: POST body data
+        :param retry_errors: If False, only throttled requests are retried, not failed ones (for requests that are not idempotent)
         :return: Response
         """
         url = self.build_url(path)
-        return requests.post(url, data=json.dumps(data), auth=(self.username, self.password), headers={'Content-Type': 'application/json'})
+        return self.scheduler.send(partial(self.session.post, url, data=json.dumps(data), auth=(self.username, self.password),
+                                           headers={'Content-Type': 'application/json'}, timeout=self.timeout),
+                                   retry_errors=retry_errors)
 
     def put(self, path, data):
         """
@@ -67,4 +83,5 @@ class PowerTrack(object):
         :return: Response
         """
         url = self.build_url(path)
-        return requests.put(url, data=json.dumps(data), auth=(self.username, self.password), headers={'Content-Type': 'application/json'})
+        return self.scheduler.send(partial(self.session.put, url, data=json.dumps(data), auth=(self.username, self.password),
+                                           headers={'Content-Type': 'application/json'}, timeout=self.timeout))
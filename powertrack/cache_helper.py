@@ -0,0 +1,170 @@
+import hashlib
+import os
+import shutil
+import threading
+from functools import partial
+from threading import Lock
+
+from powertrack.gzip_helper import DEFAULT_CHUNK_SIZE
+from powertrack.http_helper import data_file_key
+
+
+CACHE_FILE_SUFFIX = ".json.gz"
+PARTIAL_FILE_SUFFIX = ".part"
+
+
+class DataFileCache(object):
+    """
+    Size-capped local copy of downloaded data files, so that exporting a job again doesn't download them again.
+    Files are named after data_file_key (URL signatures change between requests of the URL list), their modification time is updated
+    every time they're used, and the least recently used ones are removed when the total size goes over the limit.
+    The folder can be shared by several threads or processes: files are written under a temporary name and renamed into place.
+    """
+    def __init__(self, folder, max_size):
+        """
+        DataFileCache constructor
+        :param folder: Folder where data files are kept (created if needed)
+        :param max_size: Maximum total size of the cached files, in bytes
+        :return:
+        """
+        self.folder = folder
+        self.max_size = max_size
+        self.lock = Lock()
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def __getstate__(self):
+        return {"folder": self.folder, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["folder"], state["max_size"])
+
+    def file_name(self, url):
+        """
+        :param url: Data file URL
+        :return: Path of the cached copy of the data file
+        """
+        return os.path.join(self.folder, hashlib.md5(data_file_key(url).encode("utf-8")).hexdigest() + CACHE_FILE_SUFFIX)
+
+    @staticmethod
+    def partial_file_name(file_name):
+        """
+        Get a temporary name for a cached file while it's being written, unique to the current process and thread
+        :param file_name: Path of the cached file
+        :return: Temporary path
+        """
+        return "{file_name}.{pid}.{thread}{suffix}".format(file_name=file_name, pid=os.getpid(), thread=threading.current_thread().ident,
+                                                           suffix=PARTIAL_FILE_SUFFIX)
+
+    def read(self, url):
+        """
+        Read the cached copy of a data file, marking it as recently used
+        :param url: Data file URL
+        :return: Generator of compressed chunks, or None if the data file is not in the cache
+        """
+        file_name = self.file_name(url)
+        try:
+            cached_file = open(file_name, "rb")
+            os.utime(file_name, None)
+        except (IOError, OSError):
+            return None
+
+        def read_chunks():
+            with cached_file:
+                for chunk in iter(partial(cached_file.read, DEFAULT_CHUNK_SIZE), b""):
+                    yield chunk
+
+        return read_chunks()
+
+    def get(self, url):
+        """
+        Get the cached copy of a data file, marking it as recently used
+        :param url: Data file URL
+        :return: Path of the cached copy, or None if the data file is not in the cache
+        """
+        file_name = self.file_name(url)
+        try:
+            os.utime(file_name, None)
+        except OSError:
+            return None
+
+        return file_name
+
+    def store(self, url, chunks):
+        """
+        Copy a data file into the cache while it's being downloaded. The copy is only kept if all the chunks are read
+        :param url: Data file URL
+        :param chunks: Iterable of compressed chunks
+        :return: Generator of the same chunks
+        """
+        file_name = self.file_name(url)
+        partial_file_name = self.partial_file_name(file_name)
+        completed = False
+
+        try:
+            with open(partial_file_name, "wb") as partial_file:
+                for chunk in chunks:
+                    partial_file.write(chunk)
+                    yield chunk
+            completed = True
+        finally:
+            if completed is True:
+                os.rename(partial_file_name, file_name)
+                self.evict(keep=file_name)
+            else:
+                try:
+                    os.remove(partial_file_name)
+                except OSError:
+                    pass
+
+    def put(self, url, content):
+        """
+        Copy a fully downloaded data file into the cache
+        :param url: Data file URL
+        :param content: Compressed data file
+        """
+        for chunk in self.store(url, [content]):
+            pass
+
+    def add(self, url, file_name):
+        """
+        Move a downloaded data file into the cache
+        :param url: Data file URL
+        :param file_name: Path of the downloaded data file. It won't be there anymore after calling this method
+        """
+        cached_file_name = self.file_name(url)
+        partial_file_name = self.partial_file_name(cached_file_name)
+        shutil.move(file_name, partial_file_name)  # The downloaded file may be in a different file system
+        os.rename(partial_file_name, cached_file_name)
+        self.evict(keep=cached_file_name)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used data files until the cache fits its maximum size
+        :param keep: Path of a file that must not be removed (typically the one just added)
+        """
+        with self.lock:
+            cached_files = []
+            total_size = 0
+            for name in os.listdir(self.folder):
+                if not name.endswith(CACHE_FILE_SUFFIX):
+                    continue
+                file_name = os.path.join(self.folder, name)
+                try:
+                    stat = os.stat(file_name)
+                except OSError:  # Removed by someone else in the meantime
+                    continue
+                cached_files.append((stat.st_mtime, stat.st_size, file_name))
+                total_size += stat.st_size
+
+            for last_used, size, file_name in sorted(cached_files):
+                if total_size <= self.max_size:
+                    break
+                if file_name == keep:
+                    continue
+                try:
+                    os.remove(file_name)
+                except OSError:
+                    pass
+                total_size -= size
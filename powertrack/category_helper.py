@@ -1,18 +1,96 @@
 import os
+import re
 import warnings
+from collections import deque
 from datetime import datetime
 
-from powertrack.api import SEARCH_API, PowerTrack
+from powertrack.api import HISTORICAL_API, SEARCH_API, PowerTrack
+from powertrack.dedup_helper import DuplicateFilter, PackedIdSet, get_duplicate_filter
+from powertrack.region_helper import get_region_filter
+from powertrack.search_api import export_jobs
+from powertrack.sink_helper import get_extension
 
 
 SEARCH_API_MAX_CLAUSE_LENGTH = 128
 SEARCH_API_MAX_RULE_LENGTH = 2048
+SEARCH_API_MAX_POSITIVE_CLAUSES = 30
+SEARCH_API_GEO_RULE = "({rule}) (has:geo)"  # Same as search_api.JobManager.create's
+
+HISTORICAL_API_MAX_RULE_LENGTH = 2048
+HISTORICAL_API_MAX_POSITIVE_CLAUSES = 30
+HISTORICAL_API_MAX_RULES = 1000  # Per job
+HISTORICAL_API_GEO_RULE = "({rule}) (has:geo OR has:profile_geo)"  # Same as historical_api.JobManager.create's, with geo enrichment
+
+DEFAULT_RULE_CONCURRENCY = 4
+
+CLAUSE_PATTERN = re.compile(r'-?\(*"[^"]*"\)*|\S+')  # Quoted phrases count as a single clause, with any parentheses around them
+
+ENTITY_PREFIXES = (u"#", u"@")
+
+
+def to_unicode(text):
+    """
+    :param text: utf-8 encoded string or unicode
+    :return: unicode
+    """
+    return text if isinstance(text, unicode) else text.decode("utf-8", "replace")
 
 
 class CategoryException(Exception):
     pass
 
 
+def count_positive_clauses(rule):
+    """
+    :param rule: Powertrack rule, or part of a rule
+    :return: Number of positive clauses in the rule, the way Powertrack counts them for its limits
+    """
+    return sum(1 for clause in CLAUSE_PATTERN.findall(rule) if not clause.startswith("-") and clause != "OR")
+
+
+def pack_rules(terms, max_length, max_clauses, geo_rule):
+    """
+    Combine terms into as few OR'ed rules as possible, so that each rule, once wrapped in the geo filter, fits the length and positive
+    clause limits of a Powertrack request. Terms are placed biggest first into the first rule with room for them (first-fit decreasing),
+    which is within a few rules of the optimum in the worst case and usually optimal. Repeated terms are only included once
+    :param terms: Array of terms
+    :param max_length: Maximum length of a rule
+    :param max_clauses: Maximum number of positive clauses in a rule
+    :param geo_rule: Format string for the rule actually sent, with a {rule} placeholder
+    :return: Array of rules
+    """
+    available_length = max_length - len(geo_rule.format(rule=""))
+    available_clauses = max_clauses - count_positive_clauses(geo_rule.replace("({rule})", ""))  # The wrapper's own clauses
+
+    unique_terms = []
+    seen = set()
+    for term in terms:
+        if term.lower() not in seen:
+            unique_terms.append(term)
+            seen.add(term.lower())
+
+    def size(item):
+        # Share of a rule that a term takes, in whichever limit it's closest to
+        position, term = item
+        return -max(len(term) / float(available_length), count_positive_clauses(term) / float(available_clauses)), position
+
+    bins = []  # [length, clauses, [(position, term), ...]]
+    for position, term in sorted(enumerate(unique_terms), key=size):
+        clauses = count_positive_clauses(term)
+        if len(term) > available_length or clauses > available_clauses:
+            raise CategoryException("{term} does not fit in a single Powertrack rule".format(term=term))
+        for current_bin in bins:
+            if current_bin[0] + len(" OR ") + len(term) <= available_length and current_bin[1] + clauses <= available_clauses:
+                current_bin[0] += len(" OR ") + len(term)
+                current_bin[1] += clauses
+                current_bin[2].append((position, term))
+                break
+        else:
+            bins.append([len(term), clauses, [(position, term)]])
+
+    return [" OR ".join(term for position, term in sorted(current_bin[2])) for current_bin in bins]
+
+
 class Category(object):
     def __init__(self, name, terms=None):
         """
@@ -29,9 +107,6 @@ class Category(object):
             if len(term) > SEARCH_API_MAX_CLAUSE_LENGTH:
                 warnings.warn("{term} exceeds Search API length for a single positive clause".format(term=term))
 
-        if len("({query}) (has:geo)".format(query=self.rule)) > SEARCH_API_MAX_RULE_LENGTH:
-            warnings.warn("Category definition exceeds the length of a single Search API request")
-
     @property
     def rule(self):
         """
@@ -41,7 +116,73 @@ class Category(object):
         return " OR ".join(self.terms)
 
 
+class TermMatcher(object):
+    """
+    Aho-Corasick automaton that finds, in a single pass over a text, which of a set of terms it contains
+    """
+    def __init__(self, terms):
+        """
+        TermMatcher constructor
+        :param terms: Iterable of (term, value) tuples. Values must be comparable, as the lowest value among the matching terms is returned
+        :return:
+        """
+        self.transitions = [{}]
+        self.fail = [0]
+        self.values = [None]
+
+        for term, value in terms:
+            node = 0
+            for char in term:
+                try:
+                    node = self.transitions[node][char]
+                except KeyError:
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.values.append(None)
+                    self.transitions[node][char] = node = len(self.transitions) - 1
+            if self.values[node] is None or value < self.values[node]:
+                self.values[node] = value
+
+        # Breadth-first, so that the fail node of every node is computed before its children's
+        pending = deque(self.transitions[0].values())
+        while pending:
+            node = pending.popleft()
+            fail_value = self.values[self.fail[node]]
+            if fail_value is not None and (self.values[node] is None or fail_value < self.values[node]):
+                self.values[node] = fail_value  # Terms that are suffixes of this one match as well
+            for char, child in self.transitions[node].items():
+                fail = self.fail[node]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.transitions[fail].get(char, 0)
+                pending.append(child)
+
+    def find(self, text):
+        """
+        Find the lowest value among the terms contained in a text
+        :param text: Text to be scanned
+        :return: Lowest value, or None if no term is found
+        """
+        transitions = self.transitions
+        fail = self.fail
+        values = self.values
+
+        node = 0
+        best = None
+        for char in text:
+            while node and char not in transitions[node]:
+                node = fail[node]
+            node = transitions[node].get(char, 0)
+            value = values[node]
+            if value is not None and (best is None or value < best):
+                best = value
+
+        return best
+
+
 class Job(object):
+    header = ["category_number", "category_name"]  # Columns added to every row as a pipeline stage (see process)
+
     def __init__(self, name):
         """
         Job constructor
@@ -51,6 +192,7 @@ class Job(object):
         self.name = name
         self.categories = []
         self.category_numbers = {}
+        self._matcher = None
 
     def add_category(self, category):
         """
@@ -60,6 +202,7 @@ class Job(object):
         """
         self.categories.append(category)
         self.category_numbers[category.name] = len(self.categories)
+        self._matcher = None
 
     def create_category(self, name, terms=None):
         """
@@ -72,75 +215,123 @@ class Job(object):
         new_category = Category(name, terms)
         self.categories.append(new_category)
         self.category_numbers[new_category.name] = len(self.categories)
+        self._matcher = None
         return new_category
 
     def get_ruleset(self, api):
         """
-        Get the set of rules that will be sent to Powertrack as individual requests.
-        Because of the limitation on positive clauses, each rule in the ruleset will keep combining individual category rules as long as the
-        positive clause limit is not exceeded.
+        Get the set of rules that will be sent to Powertrack as individual requests (Search API) or as the rules of a job (Historical API).
+        The terms of all the categories are packed into as few rules as possible that fit the limits of the API (see pack_rules). Since
+        categories are assigned to tweets afterwards, a rule can combine terms from different categories
         :param api: Either SEARCH_API or HISTORICAL_API
-        :return: Ruleset as an array of rules, each rule being the combination of one or more individual category rules
+        :return: Ruleset as an array of rules
         """
-        # TODO: add support for the historical API (limits are more relaxed there)
-        ruleset = []
+        terms = [term for category in self.categories for term in category.terms or []]
 
         if api == SEARCH_API:
-            clauses_in_current_rule = 0
-            rule = ''
-            for category in self.categories:
-                rule += " OR " + category.rule
-                clauses_in_current_rule += len(category.terms)
-            ruleset.append(rule[4:])  # Remove first " OR "
+            return pack_rules(terms, SEARCH_API_MAX_RULE_LENGTH, SEARCH_API_MAX_POSITIVE_CLAUSES, SEARCH_API_GEO_RULE)
+        elif api == HISTORICAL_API:
+            ruleset = pack_rules(terms, HISTORICAL_API_MAX_RULE_LENGTH, HISTORICAL_API_MAX_POSITIVE_CLAUSES, HISTORICAL_API_GEO_RULE)
+            if len(ruleset) > HISTORICAL_API_MAX_RULES:
+                raise CategoryException("Category set needs {num_rules} rules, more than a Historical API job can have".format(
+                    num_rules=len(ruleset)))
+            return ruleset
+
+        raise CategoryException("Unknown API: {api}".format(api=api))
+
+    def build_matcher(self):
+        """
+        Compile the terms of all the categories, so that tweets can be scanned for all of them at once. Terms that are hashtags or mentions
+        are also looked up directly in the tweet's twitter entities. Several threads can be finding categories at the same time (see run),
+        so both are stored with a single assignment once they're complete
+        :return: (TermMatcher, dictionary of entity terms to category indexes) tuple
+        """
+        terms = []
+        entities = {}
 
-        if len("({query}) (has:geo)".format(query=ruleset)) > SEARCH_API_MAX_RULE_LENGTH:
-            warnings.warn("Category set definition exceeds the length of a single Search API request")
+        for i, category in enumerate(self.categories):
+            for term in category.terms or []:
+                term = to_unicode(term).lower()
+                terms.append((term, i))
+                if term[:1] in ENTITY_PREFIXES and entities.get(term, i) >= i:
+                    entities[term] = i
 
-        return ruleset
+        self._matcher = TermMatcher(terms), entities
+        return self._matcher
 
-    def find_category(self, csv_tweet):
+    def find_category(self, text, entities=None):
         """
-        Find which category a tweet belong to
-        :param csv_tweet: Tweet to be scanned
+        Find which category a tweet belong to. If several categories match, the first one added to the job wins
+        :param text: Text to be scanned, typically the tweet's body (utf-8 encoded or unicode). Matching is case insensitive
+        :param entities: Tweet's twitter_entities (dictionary), used to match hashtags and mentions exactly. None to skip them
         :return: Tuple with category number and name. Number is internal to each Job object, not stored in the category itself
         """
-        # TODO: use only the tweet's body for scanning purposes, instead of the whole tweet
-        for category in self.categories:
-            for term in category.terms:
-                if term.lower() in csv_tweet.lower():
-                    return str(self.category_numbers[category.name]), category.name
+        matcher = self._matcher
+        if matcher is None:
+            matcher = self.build_matcher()
+        term_matcher, entity_indexes = matcher
+
+        index = term_matcher.find(to_unicode(text).lower())
+
+        if entities:
+            entity_terms = [u"#" + hashtag.get("text", "") for hashtag in entities.get("hashtags") or []] + \
+                           [u"@" + mention.get("screen_name", "") for mention in entities.get("user_mentions") or []]
+            for entity_term in entity_terms:
+                entity_index = entity_indexes.get(entity_term.lower())
+                if entity_index is not None and (index is None or entity_index < index):
+                    index = entity_index
+
+        if index is None:
+            return '', ''
+
+        category = self.categories[index]
+        return str(self.category_numbers[category.name]), category.name
 
-        return '', ''
+    def process(self, tweet):
+        """
+        Pipeline stage (see csv_helper.RowConverter): get the category columns of a tweet
+        :param tweet: Tweet in json format
+        :return: [category number, category name]
+        """
+        return list(self.find_category(tweet.get("body") or u"", tweet.get("twitter_entities")))
 
-    def run(self, start, end=None, title=None, columns=None, api=SEARCH_API):
+    def run(self, start, end=None, title=None, columns=None, api=SEARCH_API, concurrency=DEFAULT_RULE_CONCURRENCY, incremental=False):
         """
-        Run the Powertrack job to fetch the tweets, scan the resulting file so that categories can be assigned and create the final tweet file
+        Run the Powertrack job to fetch the tweets and create the tweet file. Categories are assigned while the tweets are being converted,
+        so rows are written once, already tagged.
+        With the Search API, every rule in the ruleset is a separate request. They're run concurrently into the same file, and tweets
+        matched by several rules are only written once (even if deduplication is disabled in the config file, which then only applies to
+        single-rule jobs), and tweets outside the regions set in the config file, if any, are dropped (see region_helper.RegionFilter).
+        With the Historical API, a single job with all the rules is created in GNIP and returned. Once it's been accepted and delivered,
+        export it with export_tweets(stages=[this category job]) to get the categories
         :param start: Start timestamp
         :param end: End timestamp, defaults to now
         :param title: Title to be used as the file name (defaults to Job's name)
         :param columns: Array of columns to be created in CartoDB's table. None for all columns.
         :param api: Either SEARCH_API or HISTORICAL_API
-        :return:
+        :param concurrency: Number of Search API requests run at the same time
+        :param incremental: Search API only. If True, every rule only fetches the tweets newer than those of the previous incremental run
+                            into the same file, and they're appended to it (see search_api.start_sync)
+        :return: Number of tweets collected (Search API) or Historical API job
         """
-        # TODO: test against the historical API
         title = title or self.name
 
         if end is None:
             end = datetime.utcnow()
 
         pt = PowerTrack(api=api)
+        ruleset = self.get_ruleset(api)
+        if not ruleset:
+            raise CategoryException("Job has no category terms")
+
+        if api == HISTORICAL_API:
+            return pt.jobs.create(start, end, title, ruleset)
+
+        dedup = get_duplicate_filter()
+        if dedup is None and len(ruleset) > 1:
+            dedup = DuplicateFilter(PackedIdSet())  # Tweets matched by several packed rules would be written once per rule
 
-        for i, rule in enumerate(self.get_ruleset(api)):
-            new_job = pt.jobs.create(start, end, title + "_tmp", rule, columns)
-            new_job.export_tweets(append=False if i == 0 else True)
-
-        with open(os.path.join(pt.folder, title + "_tmp.csv")) as tmp_file:
-            with open(os.path.join(pt.folder, title + ".csv"), "w") as final_file:
-                for i, csv_tweet in enumerate(tmp_file):
-                    if i == 0:
-                        csv_tweet = csv_tweet.rstrip() + ",category_number,category_name\n"
-                    else:
-                        category_number, category_name = self.find_category(csv_tweet)
-                        csv_tweet = csv_tweet.rstrip() + ",{category_number},{category_name}\n".format(category_number=category_number,
-                                                                                                       category_name=category_name)
-                    final_file.write(csv_tweet)
+        self.build_matcher()  # Before the rules' threads start using it
+        stages = [stage for stage in (get_region_filter(), dedup) if stage is not None] + [self]
+        jobs = [pt.jobs.create(start, end, title, rule, columns, stages=stages) for rule in ruleset]
+        return export_jobs(jobs, os.path.join(pt.folder, title + get_extension()), min(concurrency, len(jobs)), incremental=incremental)
@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+from threading import Lock
+
+from powertrack.dedup_helper import tweet_id
+from powertrack.http_helper import data_file_key
+from powertrack.sink_helper import open_sink
+
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+class Manifest(object):
+    """
+    Keeps track of which data files have been fully converted, so that an interrupted export can be resumed. Each data file is converted
+    into its own segment file, which is renamed into place (atomically) only when the whole data file has been written. The manifest
+    itself is rewritten atomically after every segment, and the final output file is built from the segments in URL order.
+    Data files are identified by data_file_key, so that a fresh URL list with new signatures still matches.
+    """
+    def __init__(self, folder, header):
+        """
+        Manifest constructor. Loads the existing manifest in the folder, if any
+        :param folder: Folder where the manifest and segment files are kept
+        :param header: Header row of the CSV file. If it doesn't match the one in an existing manifest, the export starts over
+        :return:
+        """
+        self.folder = folder
+        self.header = list(header)
+        self.files = {}
+        self.lock = Lock()
+
+        try:
+            with open(os.path.join(self.folder, MANIFEST_FILE_NAME)) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            manifest = None
+
+        if manifest is not None and manifest.get("header") == self.header:
+            self.files = manifest.get("files", {})
+        elif os.path.isdir(self.folder):
+            logging.warning("Discarding unusable export checkpoint at {folder}\n".format(folder=self.folder))
+            shutil.rmtree(self.folder)
+
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+
+    def is_done(self, url):
+        """
+        :param url: Data file URL
+        :return: True if the data file has already been converted
+        """
+        return data_file_key(url) in self.files
+
+    def segment_file_name(self, url, partial=False):
+        """
+        Get the path of the segment file for a data file
+        :param url: Data file URL
+        :param partial: If True, get the path where the segment is written before being committed
+        :return: Path
+        """
+        file_name = os.path.join(self.folder, hashlib.md5(data_file_key(url).encode("utf-8")).hexdigest() + ".csv")
+        return file_name + ".part" if partial is True else file_name
+
+    def commit(self, url, rows):
+        """
+        Mark a data file as done, once its partial segment file has been fully written and closed
+        :param url: Data file URL
+        :param rows: Number of rows in the segment
+        """
+        with self.lock:
+            os.rename(self.segment_file_name(url, partial=True), self.segment_file_name(url))
+            self.files[data_file_key(url)] = {"segment": os.path.basename(self.segment_file_name(url)), "rows": rows}
+            self.save()
+
+    def discard(self, url):
+        """
+        Remove the partial segment file of a data file that could not be converted
+        :param url: Data file URL
+        """
+        try:
+            os.remove(self.segment_file_name(url, partial=True))
+        except OSError:
+            pass
+
+    def save(self):
+        """
+        Write the manifest file atomically
+        """
+        manifest_file_name = os.path.join(self.folder, MANIFEST_FILE_NAME)
+        with open(manifest_file_name + ".part", "w") as manifest_file:
+            json.dump({"header": self.header, "files": self.files}, manifest_file)
+        os.rename(manifest_file_name + ".part", manifest_file_name)
+
+    def merge(self, file_name, urls, output_format=None):
+        """
+        Build the final output file from the header and the committed segments, in URL order
+        :param file_name: Output file name
+        :param urls: Data file URLs
+        :param output_format: Output file format (see sink_helper). None for the one in the config file
+        :return: List of the URLs whose data files are still missing
+        """
+        missing = []
+
+        sink = open_sink(file_name + ".part", self.header, output_format)
+        try:
+            for url in urls:
+                if not self.is_done(url):
+                    missing.append(url)
+                    continue
+                with open(self.segment_file_name(url)) as segment_file:
+                    sink.write_segment(segment_file)
+        finally:
+            sink.close()
+        os.rename(file_name + ".part", file_name)
+
+        return missing
+
+    def remove(self):
+        """
+        Remove the manifest and all the segment files
+        """
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+class HighWaterMark(object):
+    """
+    Newest tweet (by postedTime, then tweet id) seen by a Search API job, so that an incremental export only keeps the tweets that are
+    newer. Several time windows of the same job can go through it at the same time
+    """
+    def __init__(self, posted_time=None, activity_id=None):
+        """
+        HighWaterMark constructor
+        :param posted_time: postedTime of the newest tweet in a previous export, such as 2016-06-09T05:00:00.000Z. None if there's none
+        :param activity_id: Its activity id
+        :return:
+        """
+        self.posted_time = posted_time
+        self.activity_id = activity_id
+        self.mark = self.key(posted_time, activity_id) if posted_time is not None else None
+        self.newest = self.mark
+        self.newest_tweet = (posted_time, activity_id)
+        self.lock = Lock()
+
+    @staticmethod
+    def key(posted_time, activity_id):
+        return posted_time or "", tweet_id(activity_id or "")
+
+    def filter(self, tweets):
+        """
+        Keep the tweets newer than the mark, and take note of the newest one
+        :param tweets: List of tweets in json format
+        :return: List of the tweets newer than the mark
+        """
+        new_tweets = []
+        newest = None
+        for tweet in tweets:
+            key = self.key(tweet.get("postedTime"), tweet.get("id"))
+            if self.mark is None or key > self.mark:
+                new_tweets.append(tweet)
+            if newest is None or key > newest[0]:
+                newest = key, tweet
+        if newest is not None:
+            with self.lock:
+                if self.newest is None or newest[0] > self.newest:
+                    self.newest = newest[0]
+                    self.newest_tweet = (newest[1].get("postedTime"), newest[1].get("id"))
+        return new_tweets
+
+    def advance(self):
+        """
+        Move the mark to the newest tweet seen, once the tweets up to it have been written
+        """
+        self.posted_time, self.activity_id = self.newest_tweet
+        self.mark = self.newest
+
+
+class SyncState(object):
+    """
+    High-water marks of incremental Search API exports, one per rule (query), kept in a small JSON file next to their output file. The file
+    is rewritten atomically, like the manifest
+    """
+    def __init__(self, file_name):
+        """
+        SyncState constructor. Loads the existing state file, if any
+        :param file_name: State file name
+        :return:
+        """
+        self.file_name = file_name
+        try:
+            with open(self.file_name) as state_file:
+                self.marks = json.load(state_file).get("marks", {})
+        except (IOError, ValueError, AttributeError):
+            self.marks = {}
+
+    def get_mark(self, key):
+        """
+        :param key: Rule (query) of the job
+        :return: HighWaterMark, with no mark if the rule has not been exported yet
+        """
+        mark = self.marks.get(key) or {}
+        return HighWaterMark(mark.get("postedTime"), mark.get("id"))
+
+    def set_mark(self, key, mark):
+        """
+        :param key: Rule (query) of the job
+        :param mark: HighWaterMark. Nothing is stored if it has no mark
+        """
+        if mark.posted_time is not None:
+            self.marks[key] = {"postedTime": mark.posted_time, "id": mark.activity_id}
+
+    def clear(self):
+        self.marks = {}
+
+    def save(self):
+        """
+        Write the state file atomically
+        """
+        with open(self.file_name + ".part", "w") as state_file:
+            json.dump({"marks": self.marks}, state_file, indent=2, separators=(",", ": "), sort_keys=True)
+        os.rename(self.file_name + ".part", self.file_name)
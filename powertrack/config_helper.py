@@ -0,0 +1,25 @@
+import ConfigParser
+
+
+config = ConfigParser.RawConfigParser()
+config.read("powertrack.conf")
+
+
+def get_option(section, option, default=None, type=str):
+    """
+    Get an optional value from the config file
+    :param section: Config file section
+    :param option: Option name
+    :param default: What to return if the option is not in the config file
+    :param type: Callable used to cast the raw (string) value
+    :return: Option value
+    """
+    if not config.has_option(section, option):
+        return default
+
+    value = config.get(section, option)
+
+    if type is bool:
+        return value.strip().lower() in ("1", "true", "yes", "on")
+
+    return type(value)
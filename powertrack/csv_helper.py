@@ -1,4 +1,7 @@
-import json
+from itertools import izip
+
+from powertrack.geometry_helper import format_points, get_geometry_format, get_point, get_points
+from powertrack.json_helper import dumps
 
 
 def get_field(obj, name, default, as_json=False):
@@ -14,7 +17,7 @@ def get_field(obj, name, default, as_json=False):
         field = obj[name]
 
         if field is not None:
-            field = json.dumps(field) if as_json is True else field
+            field = dumps(field) if as_json is True else field
         else:
             field = default
     else:
@@ -33,54 +36,230 @@ def get_field(obj, name, default, as_json=False):
 
 def get_the_geom(tweet):
     """
-    Get the_geom from a tweet, either from the geo field or from the gnip field
+    Get the_geom from a tweet, either from the geo field or from the gnip field (see geometry_helper.find_geometry for the details)
     :param tweet:
     :return:
     """
-    try:
-        the_geom = tweet["geo"]
-    except KeyError:
-        pass
-    else:
-        try:
-            # Fix twitter's geojson in the geo field
-            lat = the_geom["coordinates"][0]
-            lon = the_geom["coordinates"][1]
-            the_geom["coordinates"][0] = lon
-            the_geom["coordinates"][1] = lat
-            return json.dumps(the_geom)
-        except (KeyError, TypeError, IndexError):
-            pass
+    point = get_point(tweet)
+    if point is not None:
+        return dumps(point)
+
+
+TWEET = 0
+ACTOR = 1
+LOCATION = 2
+
+# Column name: (object the field is taken from, field name, default value, whether the field is to be serialized as JSON)
+COLUMNS = {
+    "actor_displayname": (ACTOR, "displayName", "", False),
+    "actor_followerscount": (ACTOR, "followersCount", 0, False),
+    "actor_friendscount": (ACTOR, "friendsCount", 0, False),
+    "actor_id": (ACTOR, "id", "", False),
+    "actor_image": (ACTOR, "image", "", False),
+    "actor_listedcount": (ACTOR, "listedCount", 0, False),
+    "actor_location": (ACTOR, "location", "", True),
+    "actor_postedtime": (ACTOR, "postedTime", "", False),
+    "actor_preferredusername": (ACTOR, "preferredUsername", "", False),
+    "actor_statusescount": (ACTOR, "statusesCount", 0, False),
+    "actor_summary": (ACTOR, "summary", "", False),
+    "actor_utcoffset": (ACTOR, "utcOffset", 0, False),
+    "actor_verified": (ACTOR, "verified", False, False),
+    "body": (TWEET, "body", "", False),
+    "favoritescount": (TWEET, "favoritesCount", 0, False),
+    "geo": (TWEET, "geo", "", True),
+    "inreplyto_link": (TWEET, "inReplyTo", "", True),
+    "link": (TWEET, "link", "", False),
+    "location_geo": (LOCATION, "geo", "", True),
+    "location_name": (LOCATION, "name", "", False),
+    "object_type": (TWEET, "objectType", "", False),
+    "postedtime": (TWEET, "postedTime", "", False),
+    "retweetcount": (TWEET, "retweetCount", 0, False),
+    "twitter_entities": (TWEET, "twitter_entities", "", True),
+    "twitter_lang": (TWEET, "twitter_lang", "", False),
+}
+MANDATORY_COLUMNS = ("the_geom", "postedtime")
+
+class Row(list):
+    """
+    CSV row that keeps the point its the_geom was formatted from, so that rows can be aggregated (see aggregate_helper) without parsing
+    the_geom back
+    """
+    __slots__ = ("point",)
 
-    try:
-        the_geom = tweet["location"]["geo"]
-    except (KeyError, TypeError, IndexError):
-        pass
-    else:
-        try:
-            if the_geom["type"] == "point" or the_geom["type"] == "Point":
-                return json.dumps(the_geom)
-            elif the_geom["type"] == "polygon" or the_geom["type"] == "Polygon":
-                bbox = zip(*the_geom["coordinates"][0])
-                the_geom = {"type": "point", "coordinates": [(max(bbox[0]) + min(bbox[0])) / 2, (max(bbox[1]) + min(bbox[1])) / 2]}
-                return json.dumps(the_geom)
-        except (KeyError, TypeError, IndexError):
-            pass
 
+# Reasons why RowConverter.convert_with_reason drops a tweet
+NO_GEOMETRY = "no_geometry"
+DROPPED_BY_STAGE = "dropped_by_stage"
+
+
+def make_field_getter(name, default, as_json=False):
+    """
+    Build a function that does the same as get_field for a given field, with the checks that only depend on the field definition
+    resolved in advance
+    :param name: Field name
+    :param default: What to use if field is empty or non-existing. Must match the expected data type (e.g. "" for strings, 0 for integers...)
+    :param as_json: Whether the field is to be serialized as JSON
+    :return: Function that takes an object (dictionary) and returns the CSV field
+    """
+    if as_json is True and default == "":
+        def get_json_field(obj):
+            field = obj.get(name)
+            return dumps(field) if field is not None else ""  # JSON output is ASCII and has no line breaks
+        return get_json_field
+
+    if default == "":
+        def get_string_field(obj):
+            field = obj.get(name)
+            if field is None:
+                return ""
+            return field.encode("utf-8").replace('\n', ' ').replace('\r', '')
+        return get_string_field
+
+    if as_json is True:
+        def get_other_field(obj):
+            return get_field(obj, name, default, as_json=True)
+        return get_other_field
+
+    def get_plain_field(obj):
+        field = obj.get(name)
+        if field is None:
+            return default
+        if isinstance(field, basestring):
+            return field.replace('\n', ' ').replace('\r', '')
+        return field
+    return get_plain_field
+
+
+class RowConverter(object):
+    """
+    Turns tweets in json format into CSV rows. The list of columns is resolved once, when the converter is created, so that converting
+    a tweet only takes extracting its fields in order.
+    the_geom is GeoJSON (see get_the_geom) or hex EWKB, as set by geometry_format. Batches of tweets can be converted at once with
+    convert_batch, which extracts all their geometries together (see geometry_helper.get_points).
+    Stages add their own columns after the tweet's. A stage is any object with a "header" attribute (list of column names) and a
+    "process" method that takes a tweet in json format and returns the values of those columns, or None to drop the tweet. Stages that
+    need the tweet's location define "process_point" instead, which takes the tweet and its point (a GeoJSON dictionary, see
+    geometry_helper.get_point). Stages run in order before the row's fields are extracted, so dropping tweets early saves the rest of the
+    work. They run in the same process as the converter, so the process engines need them to be picklable.
+    """
+    def __init__(self, columns=None, stages=None, geometry_format=None):
+        """
+        RowConverter constructor
+        :param columns: Array of columns to be created in CartoDB's table. None for all columns. the_geom and postedtime are always included
+        :param stages: Array of stages that add columns to every row, such as category_helper.Job. None for no extra columns
+        :param geometry_format: geometry_helper.GEOJSON or geometry_helper.EWKB. None for the one in the config file
+        :return:
+        """
+        self.geometry_format = geometry_format or get_geometry_format()
+        if columns is None:
+            columns = COLUMNS.keys()
+
+        self.header = sorted(set(MANDATORY_COLUMNS) | set(column for column in columns if column in COLUMNS))
+        self.the_geom_index = self.header.index("the_geom")
+        self.fields = [(COLUMNS[column][0], make_field_getter(*COLUMNS[column][1:])) for column in self.header if column != "the_geom"]
+        self.stages = list(stages or [])
+        self.point_stages = [hasattr(stage, "process_point") for stage in self.stages]
+        for stage in self.stages:
+            self.header.extend(stage.header)
+
+    def convert(self, tweet):
+        """
+        Turn a tweet in json format into a CSV row.
+        :param tweet: Tweet in json format
+        :return: CSV row, or None if the tweet has no geometry or a stage drops it
+        """
+        return self.convert_with_reason(tweet)[0]
+
+    def convert_with_reason(self, tweet):
+        """
+        Turn a tweet in json format into a CSV row, telling why it's dropped if it is
+        :param tweet: Tweet in json format
+        :return: (CSV row, None) tuple, or (None, NO_GEOMETRY) or (None, DROPPED_BY_STAGE) if the tweet is dropped
+        """
+        point = get_point(tweet)
+        if point is None:
+            return None, NO_GEOMETRY
+
+        values = self.process_stages(tweet, point)
+        if values is None:
+            return None, DROPPED_BY_STAGE
+
+        return self.build_row(tweet, format_points([point], self.geometry_format)[0], values, point)
+
+    def convert_batch(self, tweets):
+        """
+        Turn a batch of tweets in json format into CSV rows, extracting all their geometries at once
+        :param tweets: List of tweets in json format
+        :return: List of (CSV row, None) or (None, reason) tuples, as returned by convert_with_reason
+        """
+        points = get_points(tweets)
+        results = [(None, NO_GEOMETRY)] * len(tweets)
+        kept = []
+        for i, point in enumerate(points):
+            if point is not None:
+                values = self.process_stages(tweets[i], point)
+                if values is not None:
+                    kept.append((i, values))
+                else:
+                    results[i] = None, DROPPED_BY_STAGE
+
+        # Only the geometries of the tweets kept are formatted
+        for (i, values), the_geom in izip(kept, format_points([points[i] for i, values in kept], self.geometry_format)):
+            results[i] = self.build_row(tweets[i], the_geom, values, points[i])
+
+        return results
+
+    def process_stages(self, tweet, point):
+        """
+        :param tweet: Tweet in json format
+        :param point: Its point GeoJSON dictionary
+        :return: Values of the columns added by the stages, or None if a stage drops the tweet
+        """
+        values = []
+        for stage, uses_point in izip(self.stages, self.point_stages):
+            stage_values = stage.process_point(tweet, point) if uses_point is True else stage.process(tweet)
+            if stage_values is None:
+                return None
+            values.extend(stage_values)
+        return values
+
+    def build_row(self, tweet, the_geom, values, point=None):
+        """
+        :param tweet: Tweet in json format
+        :param the_geom: Its the_geom, or None if it has no geometry
+        :param values: Values of the columns added by the stages
+        :param point: Point GeoJSON dictionary the_geom was formatted from
+        :return: (Row, None) tuple, or (None, NO_GEOMETRY) if there's no the_geom
+        """
+        if the_geom is None:
+            return None, NO_GEOMETRY
+
+        objects = (tweet, tweet.get("actor", {}), tweet.get("location", {}))
+
+        row = Row()
+        row.extend([get_field_value(objects[source]) for source, get_field_value in self.fields])
+        row.insert(self.the_geom_index, the_geom)
+        row.extend(values)
+        row.point = point
+
+        return row, None
+
+
+_converters = {}
+
+
+def get_converter(columns=None):
+    """
+    Get a (cached) converter for a set of columns
+    :param columns: Array of columns to be created in CartoDB's table. None for all columns.
+    :return: RowConverter
+    """
+    key = tuple(columns) if columns is not None else None
     try:
-        the_geom = tweet["gnip"]["profileLocations"][0]["geo"]
-    except (KeyError, TypeError, IndexError):
-        pass
-    else:
-        try:
-            if the_geom["type"] == "point" or the_geom["type"] == "Point":
-                return json.dumps(the_geom)
-            elif the_geom["type"] == "polygon" or the_geom["type"] == "Polygon":
-                bbox = zip(*the_geom["coordinates"][0])
-                the_geom = {"type": "point", "coordinates": [(max(bbox[0]) + min(bbox[0])) / 2, (max(bbox[1]) + min(bbox[1])) / 2]}
-                return json.dumps(the_geom)
-        except (KeyError, TypeError, IndexError):
-            pass
+        return _converters[key]
+    except KeyError:
+        converter = _converters[key] = RowConverter(columns)
+        return converter
 
 
 def tweet2csv(tweet=None, columns=None):
@@ -90,75 +269,9 @@ def tweet2csv(tweet=None, columns=None):
     :param columns: Array of columns to be created in CartoDB's table. None for all columns.
     :return: CSV row
     """
+    converter = get_converter(columns)
 
-    if tweet is not None:
-        the_geom = get_the_geom(tweet)
-        if the_geom is None:
-            return None
-    else:  # Header row
-        the_geom = None
-
-    tweet = tweet or {}
-
-    actor = tweet.get("actor", {})
-    location = tweet.get("location", {})
-
-    row = {
-        "the_geom": the_geom,
-        "postedtime": get_field(tweet, "postedTime", ""),
-    }
-
-    if columns is None or "actor_displayname" in columns:
-        row["actor_displayname"] = get_field(actor, "displayName", "")
-    if columns is None or "actor_followerscount" in columns:
-        row["actor_followerscount"] = get_field(actor, "followersCount", 0)
-    if columns is None or "actor_friendscount" in columns:
-        row["actor_friendscount"] = get_field(actor, "friendsCount", 0)
-    if columns is None or "actor_id" in columns:
-        row["actor_id"] = get_field(actor, "id", "")
-    if columns is None or "actor_dispactor_imagelayname" in columns:
-        row["actor_image"] = get_field(actor, "image", "")
-    if columns is None or "actor_listedcount" in columns:
-        row["actor_listedcount"] = get_field(actor, "listedCount", 0)
-    if columns is None or "actor_location" in columns:
-        row["actor_location"] = get_field(actor, "location", "", as_json=True)
-    if columns is None or "actor_postedtime" in columns:
-        row["actor_postedtime"] = get_field(actor, "postedTime", "")
-    if columns is None or "actor_preferredusername" in columns:
-        row["actor_preferredusername"] = get_field(actor, "preferredUsername", "")
-    if columns is None or "actor_statusescount" in columns:
-        row["actor_statusescount"] = get_field(actor, "statusesCount", 0)
-    if columns is None or "actor_summary" in columns:
-        row["actor_summary"] = get_field(actor, "summary", "")
-    if columns is None or "actor_utcoffset" in columns:
-        row["actor_utcoffset"] = get_field(actor, "utcOffset", 0)
-    if columns is None or "actor_verified" in columns:
-        row["actor_verified"] = get_field(actor, "verified", False)
-    if columns is None or "body" in columns:
-        row["body"] = get_field(tweet, "body", "")
-    if columns is None or "favoritescount" in columns:
-        row["favoritescount"] = get_field(tweet, "favoritesCount", 0)
-    if columns is None or "geo" in columns:
-        row["geo"] = get_field(tweet, "geo", "", as_json=True)
-    if columns is None or "actoinreplyto_linkr_displayname" in columns:
-        row["inreplyto_link"] = get_field(tweet, "inReplyTo", "", as_json=True)
-    if columns is None or "link" in columns:
-        row["link"] = get_field(tweet, "link", "")
-    if columns is None or "location_geo" in columns:
-        row["location_geo"] = get_field(location, "geo", "", as_json=True)
-    if columns is None or "location_name" in columns:
-        row["location_name"] = get_field(location, "name", "")
-    if columns is None or "object_type" in columns:
-        row["object_type"] = get_field(tweet, "objectType", "")
-    if columns is None or "retweetcount" in columns:
-        row["retweetcount"] = get_field(tweet, "retweetCount", 0)
-    if columns is None or "actor_distwitter_entitiesplayname" in columns:
-        row["twitter_entities"] = get_field(tweet, "twitter_entities", "", as_json=True)
-    if columns is None or "actor_twitter_langdisplayname" in columns:
-        row["twitter_lang"] = get_field(tweet, "twitter_lang", "")
-
-    if tweet:
-        keys = sorted(row.keys())
-        return [row[key] for key in keys]
-    else:
-        return sorted(row.keys())
+    if tweet is None:  # Header row
+        return list(converter.header)
+
+    return converter.convert(tweet)
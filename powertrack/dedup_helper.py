@@ -0,0 +1,205 @@
+import csv
+import hashlib
+import math
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+from powertrack.config_helper import get_option
+
+
+PACKED = "packed"
+BLOOM = "bloom"
+
+DEFAULT_NUM_BUCKETS = 65521
+DEFAULT_BLOOM_CAPACITY = 5000000  # About 12 MB at the default error rate. Bigger jobs should set dedup_capacity
+DEFAULT_BLOOM_ERROR_RATE = 0.0001
+
+ID_TYPECODE = "l" if array("l").itemsize == 8 else None  # 64-bit signed integers ("q" is not available in Python 2)
+
+
+def tweet_id(activity_id):
+    """
+    Turn an activity id (such as "tag:search.twitter.com,2005:123456789") or a tweet link (such as
+    "http://twitter.com/user/statuses/123456789") into a 64-bit integer. Ids not ending in a number are hashed
+    :param activity_id: Activity id or tweet link
+    :return: Integer
+    """
+    try:
+        return int(activity_id.rsplit(":", 1)[-1].rsplit("/", 1)[-1])
+    except ValueError:
+        return int(hashlib.md5(activity_id.encode("utf-8")).hexdigest()[:15], 16)
+
+
+class PackedIdSet(object):
+    """
+    Hash set of 64-bit integers that takes about 8 bytes per item, plus a fixed overhead for the buckets. Items are spread over a fixed
+    number of buckets, each of them a sorted packed array, so that looking an item up is a binary search in a small array and adding
+    it only moves the items after it in its bucket.
+    Falls back to a regular set on platforms without 64-bit C longs.
+    """
+    def __init__(self, num_buckets=DEFAULT_NUM_BUCKETS):
+        """
+        PackedIdSet constructor
+        :param num_buckets: Number of buckets. Preferably a prime number, as tweet ids are not uniformly distributed. With the default,
+                            buckets hold about 1000 items each at 64 million items
+        :return:
+        """
+        self.num_buckets = num_buckets
+        if ID_TYPECODE is not None:
+            self.buckets = [array(ID_TYPECODE) for i in range(num_buckets)]
+        else:
+            self.buckets = [set()]
+        self.count = 0
+
+    def __contains__(self, item):
+        if ID_TYPECODE is None:
+            return item in self.buckets[0]
+        bucket = self.buckets[item % self.num_buckets]
+        i = bisect_left(bucket, item)
+        return i < len(bucket) and bucket[i] == item
+
+    def __len__(self):
+        return self.count
+
+    def add(self, item):
+        """
+        :param item: Integer
+        """
+        if ID_TYPECODE is None:
+            self.buckets[0].add(item)
+            self.count = len(self.buckets[0])
+            return
+        bucket = self.buckets[item % self.num_buckets]
+        i = bisect_left(bucket, item)
+        if i == len(bucket) or bucket[i] != item:
+            bucket.insert(i, item)
+            self.count += 1
+
+    def memory_size(self):
+        """
+        :return: Approximate memory usage, in bytes
+        """
+        if ID_TYPECODE is None:
+            return 60 * self.count
+        return 8 * self.count + 64 * self.num_buckets
+
+
+class BloomFilter(object):
+    """
+    Probabilistic set whose memory usage is fixed in advance by its capacity and error rate. It never misses an item that has been added,
+    but it may report, with probability error_rate, that an item is there when it's not (i.e. a new tweet would be dropped as a duplicate).
+    """
+    def __init__(self, capacity=DEFAULT_BLOOM_CAPACITY, error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        """
+        BloomFilter constructor
+        :param capacity: Number of items it's sized for. The error rate grows if more are added
+        :param error_rate: False positive probability at full capacity
+        :return:
+        """
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        """
+        :param item: Integer
+        :return: Bit positions for the item, from two independent hashes (Kirsch-Mitzenmacher)
+        """
+        digest = hashlib.md5(str(item)).hexdigest()
+        h1, h2 = int(digest[:16], 16), int(digest[16:], 16)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, item):
+        """
+        :param item: Integer
+        """
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def memory_size(self):
+        """
+        :return: Memory usage, in bytes
+        """
+        return len(self.bits)
+
+
+class DuplicateFilter(object):
+    """
+    Pipeline stage (see csv_helper.RowConverter) that drops tweets that have already been converted, based on their activity id. It adds
+    no columns. It's meant for exports where the same tweet can come from several requests, such as several rules run into the same file.
+    One filter can be shared by several converters in different threads, but not in different processes.
+    """
+    header = []
+
+    def __init__(self, ids=None):
+        """
+        DuplicateFilter constructor
+        :param ids: Set-like object (with add and "in") to keep the ids of the tweets seen, such as PackedIdSet or BloomFilter.
+                    PackedIdSet if None
+        :return:
+        """
+        self.seen = ids if ids is not None else PackedIdSet()
+        self.lock = Lock()
+        self.duplicates = 0
+
+    def process(self, tweet):
+        """
+        :param tweet: Tweet in json format
+        :return: No values if the tweet is new, None if it has been seen before
+        """
+        activity_id = tweet.get("id")
+        if activity_id is None:
+            return []
+
+        item = tweet_id(activity_id)
+        with self.lock:
+            if item in self.seen:
+                self.duplicates += 1
+                return None
+            self.seen.add(item)
+
+        return []
+
+    def seed(self, file_name):
+        """
+        Add the tweets already in a CSV file, so that appending to it doesn't duplicate them. Tweets are identified by the link column,
+        so nothing is added if the file doesn't have it
+        :param file_name: CSV file name
+        :return: Number of tweets added
+        """
+        count = 0
+        with open(file_name) as csv_file:
+            csv_reader = csv.reader(csv_file)
+            header = next(csv_reader, [])
+            if "link" not in header:
+                return count
+            link_index = header.index("link")
+            with self.lock:
+                for row in csv_reader:
+                    if len(row) > link_index and row[link_index]:
+                        self.seen.add(tweet_id(row[link_index]))
+                        count += 1
+        return count
+
+
+def get_duplicate_filter():
+    """
+    Create a DuplicateFilter as set in the config file
+    :return: DuplicateFilter, or None if deduplication is disabled
+    """
+    dedup = get_option('output', 'dedup', PACKED)
+    if dedup == PACKED:
+        return DuplicateFilter(PackedIdSet())
+    elif dedup == BLOOM:
+        return DuplicateFilter(BloomFilter(get_option('output', 'dedup_capacity', DEFAULT_BLOOM_CAPACITY, int),
+                                           get_option('output', 'dedup_error_rate', DEFAULT_BLOOM_ERROR_RATE, float)))
+    return None
@@ -0,0 +1,218 @@
+import struct
+from binascii import hexlify
+from itertools import chain
+
+from powertrack.config_helper import get_option
+from powertrack.json_helper import dumps
+
+try:
+    import numpy
+except ImportError:  # Polygon centroids and EWKB are computed one by one without it
+    numpy = None
+
+
+GEOJSON = "geojson"
+EWKB = "ewkb"
+GEOMETRY_FORMATS = (GEOJSON, EWKB)
+
+SRID = 4326  # WGS 84
+EWKB_POINT_HEADER = struct.pack("<BII", 1, 0x20000001, SRID)  # Little endian, point with SRID
+EWKB_POINT_SIZE = len(EWKB_POINT_HEADER) + 16
+
+MIN_VECTORIZED = 16  # Below this many polygons or points, NumPy's overhead outweighs its speed
+
+# Where tweets are looked for a geometry, in order
+TWEET_GEO = 0
+LOCATION_GEO = 1
+PROFILE_LOCATION_GEO = 2
+
+
+def get_geometry_format():
+    """
+    :return: Format of the_geom set in the config file, GEOJSON by default
+    """
+    geometry_format = get_option('output', 'geometry_format', GEOJSON)
+    if geometry_format not in GEOMETRY_FORMATS:
+        raise ValueError("Unknown geometry format: {name}".format(name=geometry_format))
+    return geometry_format
+
+
+def find_geometry(tweet, start=TWEET_GEO):
+    """
+    Find the geometry of a tweet, following the same rules as csv_helper.get_the_geom: the geo field (whose coordinates are fixed to
+    lon, lat in place), then the location field, then the first profile location
+    :param tweet: Tweet in json format
+    :param start: First place to look at, TWEET_GEO, LOCATION_GEO or PROFILE_LOCATION_GEO
+    :return: (place, point, ring) tuple. point is a point GeoJSON dictionary, or None if the geometry is a polygon, in which case ring is
+             its outer ring. (None, None, None) if there's no geometry
+    """
+    # Most tweets lack some of these fields, so they're looked up with get() rather than by catching KeyError, which is much slower
+    the_geom = tweet.get("geo") if start <= TWEET_GEO else None
+    if the_geom is not None:
+        try:
+            lat = the_geom["coordinates"][0]
+            lon = the_geom["coordinates"][1]
+            the_geom["coordinates"][0] = lon
+            the_geom["coordinates"][1] = lat
+            return TWEET_GEO, the_geom, None
+        except (KeyError, TypeError, IndexError):
+            pass
+
+    for place in (LOCATION_GEO, PROFILE_LOCATION_GEO):
+        if place < start:
+            continue
+        try:
+            if place == LOCATION_GEO:
+                the_geom = (tweet.get("location") or {}).get("geo")
+            else:
+                the_geom = (tweet.get("gnip") or {}).get("profileLocations")
+                the_geom = the_geom[0]["geo"] if the_geom else None
+            if the_geom is None:
+                continue
+            if the_geom["type"] == "point" or the_geom["type"] == "Point":
+                return place, the_geom, None
+            elif the_geom["type"] == "polygon" or the_geom["type"] == "Polygon":
+                return place, None, the_geom["coordinates"][0]
+        except (AttributeError, KeyError, TypeError, IndexError):
+            pass
+
+    return None, None, None
+
+
+def bbox_centroid(ring):
+    """
+    :param ring: Polygon ring, as a list of [lon, lat] coordinates
+    :return: [lon, lat] of the center of the ring's bounding box. Raises KeyError, TypeError or IndexError if the ring is not valid
+    """
+    bbox = zip(*ring)
+    return [(max(bbox[0]) + min(bbox[0])) / 2.0, (max(bbox[1]) + min(bbox[1])) / 2.0]  # Float even for integer coordinates, as with NumPy
+
+
+def bbox_centroids(rings):
+    """
+    Compute the bounding box centroids of many rings at once with NumPy
+    :param rings: List of polygon rings
+    :return: List of [lon, lat] centroids, or None if NumPy is not installed, there are too few rings for it to pay off, or some ring is not
+             valid (so that they're computed one by one with bbox_centroid)
+    """
+    if numpy is None or len(rings) < MIN_VECTORIZED:
+        return None
+
+    try:
+        lengths = [len(ring) for ring in rings]
+        coordinates = numpy.fromiter(chain.from_iterable(chain.from_iterable(rings)), dtype=float)
+    except (TypeError, ValueError):
+        return None
+    if 0 in lengths or len(coordinates) != 2 * sum(lengths):  # Not all of them [lon, lat] pairs
+        return None
+
+    offsets = numpy.cumsum([0] + lengths[:-1])
+    lons = coordinates[0::2]
+    lats = coordinates[1::2]
+    centroid_lons = (numpy.maximum.reduceat(lons, offsets) + numpy.minimum.reduceat(lons, offsets)) / 2
+    centroid_lats = (numpy.maximum.reduceat(lats, offsets) + numpy.minimum.reduceat(lats, offsets)) / 2
+
+    return numpy.column_stack((centroid_lons, centroid_lats)).tolist()
+
+
+def get_point(tweet, start=TWEET_GEO):
+    """
+    Get the point geometry of a tweet, polygons being replaced by the center of their bounding box
+    :param tweet: Tweet in json format
+    :param start: First place to look at (see find_geometry)
+    :return: Point GeoJSON dictionary, or None if there's no (valid) geometry
+    """
+    place, point, ring = find_geometry(tweet, start)
+    while ring is not None:
+        try:
+            return {"type": "point", "coordinates": bbox_centroid(ring)}
+        except (KeyError, TypeError, IndexError):
+            place, point, ring = find_geometry(tweet, place + 1)
+    return point
+
+
+def get_points(tweets):
+    """
+    Batch version of get_point: polygon centroids are computed all at once
+    :param tweets: List of tweets in json format
+    :return: List of point GeoJSON dictionaries (or None), one per tweet
+    """
+    points = [None] * len(tweets)
+    polygons = []
+    for i, tweet in enumerate(tweets):
+        place, point, ring = find_geometry(tweet)
+        if ring is None:
+            points[i] = point
+        else:
+            polygons.append((i, place, ring))
+
+    centroids = bbox_centroids([ring for i, place, ring in polygons])
+    for j, (i, place, ring) in enumerate(polygons):
+        if centroids is not None:
+            points[i] = {"type": "point", "coordinates": centroids[j]}
+        else:
+            points[i] = get_point(tweets[i], place)
+
+    return points
+
+
+def to_ewkb(point):
+    """
+    :param point: Point GeoJSON dictionary
+    :return: Hex EWKB of the point with SRID 4326, as PostGIS writes it, or None if its coordinates are not numbers
+    """
+    try:
+        return hexlify(EWKB_POINT_HEADER + struct.pack("<dd", point["coordinates"][0], point["coordinates"][1])).upper()
+    except (KeyError, TypeError, IndexError, struct.error):
+        return None
+
+
+def to_ewkbs(points):
+    """
+    Batch version of to_ewkb, which packs all the points into a single NumPy buffer when there are enough of them
+    :param points: List of point GeoJSON dictionaries (or None)
+    :return: List of hex EWKB strings (or None)
+    """
+    indexes = [i for i, point in enumerate(points) if point is not None]
+    if numpy is None or len(indexes) < MIN_VECTORIZED:
+        return [to_ewkb(point) if point is not None else None for point in points]
+
+    ewkb_points = numpy.zeros(len(indexes), dtype=[("header", "S{size}".format(size=len(EWKB_POINT_HEADER))), ("lon", "<f8"),
+                                                   ("lat", "<f8")])
+    try:
+        ewkb_points["lon"] = [points[i]["coordinates"][0] for i in indexes]
+        ewkb_points["lat"] = [points[i]["coordinates"][1] for i in indexes]
+    except (KeyError, TypeError, IndexError, ValueError):
+        return [to_ewkb(point) if point is not None else None for point in points]
+    ewkb_points["header"] = EWKB_POINT_HEADER
+
+    hex_size = EWKB_POINT_SIZE * 2
+    hex_points = hexlify(ewkb_points.tostring()).upper()
+    ewkbs = [None] * len(points)
+    for j, i in enumerate(indexes):
+        ewkbs[i] = hex_points[j * hex_size:(j + 1) * hex_size]
+
+    return ewkbs
+
+
+def format_points(points, geometry_format=GEOJSON):
+    """
+    Turn points into the_geom values
+    :param points: List of point GeoJSON dictionaries (or None), as returned by get_points
+    :param geometry_format: GEOJSON, or EWKB for hex EWKB points with SRID 4326, which PostGIS reads without parsing JSON
+    :return: List of the_geom values (or None)
+    """
+    if geometry_format == EWKB:
+        return to_ewkbs(points)
+    return [dumps(point) if point is not None else None for point in points]
+
+
+def get_the_geoms(tweets, geometry_format=GEOJSON):
+    """
+    Get the_geom for a batch of tweets, as csv_helper.get_the_geom does for a single one
+    :param tweets: List of tweets in json format
+    :param geometry_format: GEOJSON, for the same output as get_the_geom (polygon centroids aside, which are always computed as floats), or
+                            EWKB
+    :return: List of the_geom values, None for tweets without geometry
+    """
+    return format_points(get_points(tweets), geometry_format)
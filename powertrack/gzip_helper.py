@@ -0,0 +1,56 @@
+import mmap
+import zlib
+
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS  # Expect a gzip header and trailer
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def iter_mapped_chunks(data_file, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Read a file through a read-only memory map, so that its pages are handed over to the decompressor without being copied first
+    :param data_file: File object, opened in binary mode
+    :param chunk_size: Size of every chunk, in bytes
+    :return: Generator of buffers over the mapped file. They're only valid until the generator is exhausted or closed
+    """
+    try:
+        mapped_file = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:  # Empty files cannot be mapped
+        return
+
+    try:
+        for offset in xrange(0, len(mapped_file), chunk_size):
+            yield buffer(mapped_file, offset, chunk_size)
+    finally:
+        mapped_file.close()
+
+
+def iter_gzip_lines(chunks):
+    """
+    Decompress a gzip stream as it arrives and yield its lines as soon as they're complete, so that memory usage doesn't depend on the
+    size of the stream. Concatenated gzip members are supported.
+    :param chunks: Iterable of compressed byte strings, such as response.iter_content()
+    :return: Generator of decompressed lines, without the trailing newline
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    pending = ""
+
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        while decompressor.unused_data:  # A new gzip member starts within this chunk
+            unused_data = decompressor.unused_data
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+            data += decompressor.decompress(unused_data)
+
+        if not data:
+            continue
+
+        lines = (pending + data).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+
+    lines = (pending + decompressor.flush()).split("\n")
+    for line in lines:
+        if line:
+            yield line
@@ -1,23 +1,83 @@
-import ConfigParser
 import csv
-import json
+import glob
 import logging
 import os
 import re
+import shutil
+import signal
 import sys
-import requests
+import tempfile
+import time
+import zlib
+from functools import partial
 from gzip import GzipFile
-from threading import Thread
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from threading import Event, Thread
 from StringIO import StringIO
 from datetime import datetime
 from Queue import Queue
-from requests.exceptions import ConnectionError, SSLError
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, SSLError, Timeout
 
-from powertrack.csv_helper import tweet2csv
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from tornado import gen, ioloop, locks
+    from tornado.httpclient import AsyncHTTPClient, HTTPError as AsyncHTTPError, HTTPRequest
+except ImportError:  # The async engine is optional
+    AsyncHTTPClient = None
 
+from powertrack import json_helper
+from powertrack.cache_helper import DataFileCache
+from powertrack.checkpoint_helper import Manifest
+from powertrack.config_helper import config, get_option
+from powertrack.csv_helper import NO_GEOMETRY, RowConverter
+from powertrack.gzip_helper import DEFAULT_CHUNK_SIZE, iter_gzip_lines, iter_mapped_chunks
+from powertrack.http_helper import DEFAULT_TIMEOUT, build_session
+from powertrack.metrics_helper import BYTES_DOWNLOADED, BYTES_FROM_DISK, CONVERT, DATA_FILE_EVENT, DATA_FILES, DATA_FILES_FAILED, \
+    DECODE, DECODE_ERRORS, DOWNLOAD, LINES, QUEUE_WAIT, RETRIES, ROWS, ROWS_DROPPED, ROWS_WITHOUT_GEOMETRY, ROWS_WRITTEN, WRITE, \
+    ExportStats
+from powertrack.queue_helper import RowQueue
+from powertrack.schedule_helper import THROTTLE_STATUS_CODES, AdaptiveConcurrency, RequestScheduler, build_scheduler, \
+    parse_retry_after
+from powertrack.sink_helper import get_extension, open_sink
 
-config = ConfigParser.RawConfigParser()
-config.read("powertrack.conf")
+
+DEFAULT_WRITER_QUEUE_SIZE = 100000
+DEFAULT_BATCH_SIZE = 1000
+WRITE_BUFFER_SIZE = 1024 * 1024
+POOL_RESULT_TIMEOUT = 365 * 24 * 3600
+
+THREAD_ENGINE = "threads"
+PROCESS_ENGINE = "processes"
+ASYNC_ENGINE = "async"
+
+DEFAULT_MAX_DOWNLOADS = 100
+ASYNC_REQUEST_TIMEOUT = 3600
+
+DATA_FILE_DONE = "done"
+DATA_FILE_FAILED = "failed"
+CHECKPOINT_FOLDER_SUFFIX = ".parts"
+DATA_FILE_SUFFIX = ".json.gz"
+DEFAULT_CACHE_SIZE_MB = 10 * 1024
+
+DEFAULT_METADATA_TTL = 30
+DEFAULT_WATCH_INTERVAL = 60
+DEFAULT_EXPORT_CONCURRENCY = 1
+DELIVERED = "delivered"
+FINAL_STATUSES = (DELIVERED, "rejected", "failed", "expired")
+
+
+def get_data_file_cache():
+    """
+    Get the data file cache defined in the config file
+    :return: DataFileCache, or None if the cache is not enabled
+    """
+    folder = get_option('cache', 'folder')
+    if folder is None:
+        return None
+
+    return DataFileCache(folder, get_option('cache', 'max_size_mb', DEFAULT_CACHE_SIZE_MB, int) * 1024 * 1024)
 
 
 class Job(object):
@@ -26,20 +86,23 @@ class Job(object):
     _status_message = None
     _uuid = None
     data_url = None
+    updated_at = None
 
-    def __init__(self, pt, uuid=None, job_data=None):
+    def __init__(self, pt, uuid=None, job_data=None, ttl=None):
         """
         Job constructor
         :param pt: Powertrack instance, used to connect with GNIP
         :param uuid: UUID (it'll try to get it from the jobURL field if not set)
         :param job_data: Data dictionary to populate the internal attributes
+        :param ttl: Seconds during which the job's info is considered fresh, so that reading status or status_message doesn't call GNIP
+                    again. Defaults to the metadata_ttl option in the config file, or DEFAULT_METADATA_TTL
         :return:
         """
         self.pt = pt
+        self.ttl = ttl if ttl is not None else get_option('connection', 'metadata_ttl', DEFAULT_METADATA_TTL, float)
 
         if uuid is not None:
             self.uuid = uuid
-            self.job_url = self.build_url()
 
         if job_data is not None:
             self.update_fields(job_data)
@@ -97,6 +160,7 @@ class Job(object):
 
         self.job_url = job_data.get("jobURL")
         self.uuid = self.build_uuid(self.job_url)
+        self.updated_at = time.time()
 
     def accept(self):
         """
@@ -123,20 +187,32 @@ class Job(object):
         r = self.pt.get(self.job_url)
         self.update_fields(r.json())
 
+    def refresh(self, ttl=None):
+        """
+        Call GNIP and update the job, unless its info is fresh enough
+        :param ttl: Maximum age of the job's info, in seconds. Defaults to the job's ttl
+        :return: True if GNIP was called
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if self.updated_at is not None and time.time() - self.updated_at < ttl:
+            return False
+        self.update()
+        return True
+
     @property
     def status(self):
         """
-        Return updated status from GNIP
+        Return status from GNIP, calling it only if the job's info is older than its ttl
         """
-        self.update()
+        self.refresh()
         return self._status
 
     @property
     def status_message(self):
         """
-        Return updated status message from GNIP
+        Return status message from GNIP, calling it only if the job's info is older than its ttl
         """
-        self.update()
+        self.refresh()
         return self._status_message
 
     def get_quote(self):
@@ -149,18 +225,45 @@ class Job(object):
 
         return self._quote
 
-    def export_tweets(self):
+    def export_tweets(self, resume=False, stages=None, stats=None):
         """
         Generate CSV file from this job's data files (if job is completed in GNIP)
+        :param resume: If True, progress is saved after every data file, so that running the export again after an interruption only
+                       converts the remaining data files. Rows are then written twice, to the segments and to the CSV file
+        :param stages: Array of stages that add columns to every row (see csv_helper.RowConverter). None for no extra columns
+        :param stats: ExportStats to collect the metrics of the export in (see metrics_helper). A new one is created if None
         """
-        if self._status != "delivered":
+        if self._status != DELIVERED:
             return False
 
+        if self.data_url is None:  # Job listings may not have the results
+            self.update()
+
         r = self.pt.get(self.data_url)
         urls = r.json().get("urlList")
+        engine = get_option('output', 'engine', THREAD_ENGINE)
+        num_processes = get_option('output', 'num_processes', cpu_count(), int)
+        if engine == PROCESS_ENGINE:
+            num_workers = num_processes
+        elif engine == ASYNC_ENGINE:
+            num_workers = get_option('output', 'max_downloads', DEFAULT_MAX_DOWNLOADS, int)
+        else:
+            num_workers = self.pt.num_threads
         build_csv_file(urls,
-                       os.path.join(config.get('output', 'folder'), "{filename}.csv".format(filename=self.title)),
-                       int(config.get('output', 'num_threads')))
+                       os.path.join(config.get('output', 'folder'), self.title + get_extension()),
+                       num_workers,
+                       session=self.pt.session,
+                       timeout=self.pt.timeout,
+                       stream=get_option('output', 'stream', True, bool),
+                       writer_queue_size=get_option('output', 'writer_queue_size', DEFAULT_WRITER_QUEUE_SIZE, int),
+                       batch_size=get_option('output', 'batch_size', DEFAULT_BATCH_SIZE, int),
+                       engine=engine,
+                       resume=resume,
+                       cache=get_data_file_cache(),
+                       num_processes=num_processes,
+                       stages=stages,
+                       stats=stats,
+                       scheduler=self.pt.scheduler)
 
         return True
 
@@ -193,9 +296,17 @@ class JobManager(object):
             "rules": rules,
         }
 
-        r = self.pt.post(self.jobs_path, data)
+        r = self.pt.post(self.jobs_path, data, retry_errors=False)  # Retrying after a server error could create the job twice
         return Job(self.pt, job_data=r.json())
 
+    def list_job_data(self):
+        """
+        Get the info of all the jobs from GNIP, in a single request
+        :return: List of job data dictionaries
+        """
+        r = self.pt.get(self.jobs_path)
+        return r.json()["jobs"]
+
     def get(self, uuid=None):
         """
         Retrieve jobs from GNIP
@@ -203,88 +314,1016 @@ class JobManager(object):
         :return: Job or jobs
         """
         if uuid is None:
-            r = self.pt.get(self.jobs_path)
-            return [Job(self.pt, job_data=job_data) for job_data in r.json()["jobs"]]
+            return [Job(self.pt, job_data=job_data) for job_data in self.list_job_data()]
         else:
-            r = Job.build_job_url(uuid, self.pt.account_name)
+            r = self.pt.get(Job.build_job_url(uuid, self.pt.account_name))
             return Job(self.pt, job_data=r.json())
 
+    def watch(self, jobs=None, interval=None, export=True, export_concurrency=None, callback=None, **export_options):
+        """
+        Follow jobs until they're done, and export them as soon as they're delivered (see JobWatcher)
+        :param jobs: Jobs to follow. None for all the jobs that are not done yet
+        :param interval: Seconds between job listings. Defaults to the watch_interval option in the config file, or DEFAULT_WATCH_INTERVAL
+        :param export: If True, delivered jobs are exported
+        :param export_concurrency: Number of jobs exported at the same time. Defaults to the export_concurrency option in the config file,
+                                   or DEFAULT_EXPORT_CONCURRENCY
+        :param callback: Function called with the job every time a job's status changes, or None
+        :param export_options: Arguments for Job.export_tweets, such as resume or stages
+        :return: JobWatcher, already started. join() it to wait until every job is done
+        """
+        if jobs is None:
+            jobs = [job for job in self.get() if job._status not in FINAL_STATUSES]
+        if interval is None:
+            interval = get_option('output', 'watch_interval', DEFAULT_WATCH_INTERVAL, float)
+        if export_concurrency is None:
+            export_concurrency = get_option('output', 'export_concurrency', DEFAULT_EXPORT_CONCURRENCY, int)
+
+        watcher = JobWatcher(self, jobs, interval=interval, export=export, export_concurrency=export_concurrency, callback=callback,
+                             **export_options)
+        watcher.start()
+        return watcher
+
+
+class JobWatcher(Thread):
+    """
+    This thread follows a set of jobs with a single jobs.json listing per interval, instead of a request per job, until all of them
+    are delivered, rejected, failed or expired. Delivered jobs are exported right away in a pool of export_concurrency threads (which
+    share the PowerTrack instance's download concurrency, see schedule_helper.AdaptiveConcurrency).
+    """
+    def __init__(self, manager, jobs, interval=DEFAULT_WATCH_INTERVAL, export=True, export_concurrency=DEFAULT_EXPORT_CONCURRENCY,
+                 callback=None, **export_options):
+        """
+        Thread constructor
+        :param manager: JobManager
+        :param jobs: Jobs to follow
+        :param interval: Seconds between job listings
+        :param export: If True, delivered jobs are exported
+        :param export_concurrency: Number of jobs exported at the same time
+        :param callback: Function called with the job every time a job's status changes, or None
+        :param export_options: Arguments for Job.export_tweets
+        """
+        self.manager = manager
+        self.jobs = dict((job.uuid, job) for job in jobs)
+        self.pending = set(uuid for uuid, job in self.jobs.items() if job._status not in FINAL_STATUSES)
+        self.interval = interval
+        self.export = export
+        self.export_concurrency = export_concurrency
+        self.callback = callback
+        self.export_options = export_options
+        self.exports = {}
+        self.stopped = Event()
+        super(JobWatcher, self).__init__()
+        self.daemon = True
+
+    def poll(self, pool):
+        """
+        Update the pending jobs with a single job listing, and export the ones that have been delivered. Jobs missing from the listing are
+        updated one by one
+        :param pool: ThreadPool the exports are run in
+        """
+        listed = set()
+        for job_data in self.manager.list_job_data():
+            uuid = Job.build_uuid(job_data.get("jobURL"))
+            if uuid in self.pending:
+                self.update_job(self.jobs[uuid], job_data)
+                listed.add(uuid)
+
+        for uuid in self.pending - listed:
+            self.update_job(self.jobs[uuid])
+
+        for uuid in list(self.pending):
+            job = self.jobs[uuid]
+            if job._status in FINAL_STATUSES:
+                self.pending.discard(uuid)
+                if job._status == DELIVERED and self.export is True:
+                    self.exports[uuid] = pool.apply_async(job.export_tweets, kwds=self.export_options)
+
+    def update_job(self, job, job_data=None):
+        status = job._status
+        if job_data is not None:
+            job.update_fields(job_data)
+        else:
+            job.update()
+        if job._status != status and self.callback is not None:
+            self.callback(job)
+
+    def run(self):
+        pool = ThreadPool(self.export_concurrency)
+        try:
+            while self.pending and not self.stopped.is_set():
+                try:
+                    self.poll(pool)
+                except (ConnectionError, HTTPError, Timeout, ValueError) as e:
+                    logging.warning("Cannot list jobs: {error}. Will retry later.\n".format(error=e))
+                if self.pending:
+                    self.stopped.wait(self.interval)
+        finally:
+            pool.close()
+            pool.join()
+
+    def stop(self):
+        """
+        Stop following the jobs. Exports already started are finished
+        """
+        self.stopped.set()
+
+    def results(self):
+        """
+        :return: Dictionary of job UUID: result of export_tweets, for the jobs exported so far. Exports still running are waited for, and
+                 exceptions are raised
+        """
+        return dict((uuid, result.get()) for uuid, result in self.exports.items())
+
+
+def count_bytes(chunks, stats, counter):
+    """
+    Add the size of chunks to a counter as they go through
+    :param chunks: Iterable of byte strings
+    :param stats: ExportStats
+    :param counter: Counter name, such as BYTES_DOWNLOADED
+    :return: Generator of the same chunks
+    """
+    for chunk in chunks:
+        stats.add({counter: len(chunk)})
+        yield chunk
+
+
+def read_data_file(session, url, timeout=DEFAULT_TIMEOUT, stream=True, cache=None, stats=None, scheduler=None):
+    """
+    Get a data file and decompress it
+    :param session: HTTP session
+    :param url: Data file URL
+    :param timeout: Request timeout, either a number of seconds or a (connect, read) tuple
+    :param stream: If True, the data file is decompressed while it's being downloaded. If False, it's fully downloaded first
+    :param cache: DataFileCache to read the data file from, if it's there, and to store it in after downloading it. None for no cache
+    :param stats: ExportStats where the compressed bytes downloaded or read from the cache are counted, or None
+    :param scheduler: RequestScheduler the request is sent through, so that it's rate limited and retried if it's throttled or fails
+                      before the response arrives. None to send it directly
+    :return: Generator of activity lines
+    """
+    def get(**kwargs):
+        request = partial(session.get, url, timeout=timeout, **kwargs)
+        return scheduler.send(request) if scheduler is not None else request()
+
+    cached_chunks = cache.read(url) if cache is not None else None
+    if cached_chunks is not None:
+        if stats is not None:
+            cached_chunks = count_bytes(cached_chunks, stats, BYTES_FROM_DISK)
+        for line in iter_gzip_lines(cached_chunks):
+            yield line
+    elif stream is True:
+        r = get(stream=True)
+        try:
+            r.raise_for_status()
+            chunks = r.iter_content(DEFAULT_CHUNK_SIZE)
+            if stats is not None:
+                chunks = count_bytes(chunks, stats, BYTES_DOWNLOADED)
+            if cache is not None:
+                chunks = cache.store(url, chunks)
+            for line in iter_gzip_lines(chunks):
+                yield line
+        finally:
+            r.close()
+    else:
+        r = get()
+        r.raise_for_status()
+        if stats is not None:
+            stats.add({BYTES_DOWNLOADED: len(r.content)})
+        if cache is not None:
+            cache.put(url, r.content)
+        for line in GzipFile(fileobj=StringIO(r.content)):
+            yield line
+
+
+def convert_lines(lines, converter, stats, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Decode activity lines and turn them into CSV rows, batch_size tweets at a time so that their geometries are extracted together (see
+    RowConverter.convert_batch). Counts of lines, rows and dropped tweets and the time spent getting the lines (DOWNLOAD), decoding them
+    and converting them are added to stats when the lines are over, or when reading them fails. Lines are only counted once their batch
+    has been converted, so lines read before a failure but not turned into rows are read again on retry. Time spent by the caller between
+    rows is not counted
+    :param lines: Iterable of activity lines
+    :param converter: RowConverter
+    :param stats: ExportStats, typically one that belongs to the calling thread or process
+    :param batch_size: Maximum number of lines converted at once
+    :return: Generator of CSV rows
+    """
+    num_lines = decode_errors = rows = without_geometry = dropped = 0
+    download_time = decode_time = convert_time = 0.0
+    lines = iter(lines)
+    try:
+        while True:
+            tweets = []
+            batch_errors = 0
+            t0 = time.time()
+            for line in islice(lines, batch_size):
+                t1 = time.time()
+                download_time += t1 - t0
+                try:
+                    tweets.append(json_helper.loads(line))
+                except ValueError:
+                    batch_errors += 1
+                t0 = time.time()
+                decode_time += t0 - t1
+            t1 = time.time()
+            download_time += t1 - t0
+            if not tweets and not batch_errors:
+                break
+
+            converted = converter.convert_batch(tweets)
+            convert_time += time.time() - t1
+            num_lines += len(tweets) + batch_errors
+            decode_errors += batch_errors
+
+            for csv_tweet, reason in converted:
+                if csv_tweet is not None:
+                    rows += 1
+                    yield csv_tweet
+                elif reason == NO_GEOMETRY:
+                    without_geometry += 1
+                else:
+                    dropped += 1
+    finally:
+        stats.add({LINES: num_lines, DECODE_ERRORS: decode_errors, ROWS: rows, ROWS_WITHOUT_GEOMETRY: without_geometry,
+                   ROWS_DROPPED: dropped},
+                  {DOWNLOAD: download_time, DECODE: decode_time, CONVERT: convert_time})
+
+
+def finish_data_file(stats, data_file_stats, name, success):
+    """
+    Merge the stats of a data file into the ones of the export, and tell the callback about it
+    :param stats: ExportStats of the export
+    :param data_file_stats: Result of ExportStats.take() for the data file
+    :param name: Data file URL or file name
+    :param success: Whether the whole data file could be read
+    """
+    data_file_stats["counters"][DATA_FILES if success is True else DATA_FILES_FAILED] += 1
+    stats.merge(data_file_stats)
+    stats.event(DATA_FILE_EVENT, url=name, rows=data_file_stats["counters"][ROWS], success=success)
+
 
 class GetRequestThread(Thread):
     """
-    These threads will get a job data file, convert tweets to CSV and put them in a writer queue.
-    The number of these threads come from config file.
+    These threads will get a job data file, convert tweets to CSV and put them in a writer queue, in batches.
+    The number of these threads come from config file. All of them share the same HTTP session, so connections are reused, and the same
+    scheduler, whose AdaptiveConcurrency (if any) decides how many of them are working at any time.
+    URL queue items are (url, lines_done, attempt) tuples, lines_done being the number of lines already processed in previous, interrupted
+    attempts, and attempt the number of consecutive attempts that didn't get any further (the data file fails once there are more than the
+    scheduler's max_retries of them). A None item stops the thread.
+    Writer queue items are (url, list of CSV tweets) tuples. Once a data file has been fully read (or cannot be read), a (url, DATA_FILE_DONE)
+    (or (url, DATA_FILE_FAILED)) tuple is put as well.
     """
-    def __init__(self, url_q, writer_q):
+    def __init__(self, url_q, writer_q, session, converter, timeout=DEFAULT_TIMEOUT, stream=True, batch_size=DEFAULT_BATCH_SIZE, cache=None,
+                 stats=None, scheduler=None):
+        """
+        Thread constructor
+        :param url_q: Queue of (url, lines_done, attempt) tuples, or None to stop
+        :param writer_q: RowQueue where (url, list of CSV tweets) tuples are put
+        :param session: HTTP session
+        :param converter: RowConverter used to turn tweets into CSV rows
+        :param timeout: Request timeout, either a number of seconds or a (connect, read) tuple
+        :param stream: If True, data files are decompressed and converted while they're being downloaded. If False, every data file is
+                       fully downloaded first
+        :param batch_size: Maximum number of CSV tweets put together into the writer queue. The last batch of every data file may be smaller
+        :param cache: DataFileCache that data files are read through, or None
+        :param stats: ExportStats of the export. Every data file is measured separately and merged into it when it's done
+        :param scheduler: RequestScheduler shared by all the threads, or None
+        """
         self.url_q = url_q
         self.writer_q = writer_q
+        self.session = session
+        self.converter = converter
+        self.timeout = timeout
+        self.stream = stream
+        self.batch_size = batch_size
+        self.cache = cache
+        self.stats = stats if stats is not None else ExportStats(interval=0)
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
         super(GetRequestThread, self).__init__()
 
+    def put_batch(self, url, batch, data_file_stats):
+        t = time.time()
+        self.writer_q.put((url, batch))
+        data_file_stats.add(timings={QUEUE_WAIT: time.time() - t})
+
     def run(self):
+        concurrency = self.scheduler.concurrency
         while True:
-            url = self.url_q.get()
-            sys.stdout.write("Processing ({url}). URLs in queue: {pending}\n".format(url=url, pending=self.url_q.qsize()))
+            task = self.url_q.get()
+            if task is None:  # No more data files
+                self.url_q.task_done()
+                break
+            url, lines_done, attempt = task
+            # The slot is only taken once there's a data file to read, so that idle threads don't hold on to the scheduler's concurrency,
+            # which is shared with later exports
+            if concurrency is not None:
+                concurrency.acquire()
+            data_file_stats = ExportStats(interval=0)
+            batch = []
+            status = None
+            retry = None
             try:
-                r = requests.get(url)
-            except (ConnectionError, SSLError):
-                logging.warning("Connection error ({url}). Will retry later.\n".format(url=url))
-                self.url_q.put(url)
+                lines = read_data_file(self.session, url, timeout=self.timeout, stream=self.stream, cache=self.cache, stats=data_file_stats,
+                                       scheduler=self.scheduler)
+                # Lines already processed before the connection was lost are skipped
+                for csv_tweet in convert_lines(islice(lines, lines_done, None), self.converter, data_file_stats,
+                                               self.batch_size):
+                    batch.append(csv_tweet)
+                    if len(batch) >= self.batch_size:
+                        self.put_batch(url, batch, data_file_stats)
+                        batch = []
+            except (ConnectionError, SSLError, Timeout, ChunkedEncodingError) as e:
+                lines_read = lines_done + data_file_stats.counters[LINES]
+                attempt = attempt + 1 if lines_read == lines_done else 0
+                if attempt > self.scheduler.max_retries:
+                    logging.error("Cannot read data file ({url}): {error}. Giving up after {attempts} attempts without "
+                                  "progress\n".format(url=url, error=e, attempts=attempt))
+                    status = DATA_FILE_FAILED
+                else:
+                    retry = (url, lines_read, attempt), self.scheduler.backoff_delay(attempt)
+                    logging.warning("Connection error ({url}). Will retry in {delay:.1f}s.\n".format(url=url, delay=retry[1]))
+                    data_file_stats.add({RETRIES: 1})
+                self.scheduler.throttled()
+            except (HTTPError, IOError, zlib.error) as e:
+                logging.error("Cannot read data file ({url}): {error}\n".format(url=url, error=e))
+                status = DATA_FILE_FAILED
             else:
-                gz = GzipFile(fileobj=StringIO(r.content))
-                for line in gz:
-                    try:
-                        tweet = json.loads(line)
-                    except ValueError:
-                        continue
-                    csv_tweet = tweet2csv(tweet)
-                    if csv_tweet is not None:
-                        self.writer_q.put(csv_tweet)
+                status = DATA_FILE_DONE
+            finally:
+                if batch:
+                    self.put_batch(url, batch, data_file_stats)
+                num_bytes = data_file_stats.counters[BYTES_DOWNLOADED] + data_file_stats.counters[BYTES_FROM_DISK]
+                if status is not None:
+                    self.writer_q.put((url, status))
+                    finish_data_file(self.stats, data_file_stats.take(), url, status == DATA_FILE_DONE)
+                else:
+                    self.stats.merge(data_file_stats.take())
+                if concurrency is not None:
+                    concurrency.release(num_bytes)
+                if retry is not None:  # The slot is given back first, so that other threads can go on while this one waits
+                    time.sleep(retry[1])
+                    self.url_q.put(retry[0])
                 self.url_q.task_done()
 
 
 class WriteTweetThread(Thread):
     """
-    This thread (only one!!!) will take the CSV tweets from a writer queue and put them into the CSV file.
+    This thread (only one!!!) will take batches of CSV tweets from a writer queue and put them into the CSV file.
+    If there's a manifest, every data file is written to its own segment file instead, which is committed once the data file is done.
     """
-    def __init__(self, csv_writer, writer_q):
-        self.csv_writer = csv_writer
+    def __init__(self, sink, writer_q, manifest=None, stats=None):
+        """
+        Thread constructor
+        :param sink: Sink for the output file (see sink_helper; unused if there's a manifest)
+        :param writer_q: RowQueue with (url, list of CSV tweets or DATA_FILE_DONE or DATA_FILE_FAILED) tuples
+        :param manifest: Manifest that keeps track of the segment files, or None to write directly to the CSV file
+        :param stats: ExportStats where rows written and write times are added
+        """
+        self.sink = sink
         self.writer_q = writer_q
+        self.manifest = manifest
+        self.stats = stats if stats is not None else ExportStats(interval=0)
+        self.segments = {}
         super(WriteTweetThread, self).__init__()
 
+    def write_segment(self, url, csv_tweets):
+        """
+        Write CSV tweets to the segment file of their data file, or commit or discard it when the data file is over
+        :param url: Data file URL
+        :param csv_tweets: List of CSV tweets, or either DATA_FILE_DONE or DATA_FILE_FAILED
+        """
+        if isinstance(csv_tweets, list):
+            try:
+                segment_file, csv_writer, count = self.segments[url]
+            except KeyError:
+                segment_file = open(self.manifest.segment_file_name(url, partial=True), 'w', WRITE_BUFFER_SIZE)
+                csv_writer = csv.writer(segment_file)
+                count = 0
+            csv_writer.writerows(csv_tweets)
+            self.segments[url] = segment_file, csv_writer, count + len(csv_tweets)
+            return
+
+        if url in self.segments:
+            segment_file, csv_writer, count = self.segments.pop(url)
+            segment_file.close()
+        else:  # No tweets at all in this data file
+            open(self.manifest.segment_file_name(url, partial=True), 'w').close()
+            count = 0
+
+        if csv_tweets == DATA_FILE_DONE:
+            self.manifest.commit(url, count)
+        else:
+            self.manifest.discard(url)
+
     def run(self):
         while True:
-            csv_tweet = self.writer_q.get()
-            self.csv_writer.writerow(csv_tweet)
-            self.writer_q.task_done()
+            url, csv_tweets = self.writer_q.get()
+            t = time.time()
+            try:
+                if self.manifest is not None:
+                    self.write_segment(url, csv_tweets)
+                elif isinstance(csv_tweets, list):
+                    self.sink.writerows(csv_tweets)
+            finally:
+                self.stats.add({ROWS_WRITTEN: batch_weight((url, csv_tweets))}, {WRITE: time.time() - t})
+                self.writer_q.task_done()
+
+
+def batch_weight(item):
+    """
+    Get the number of rows in a writer queue item
+    :param item: (url, list of CSV tweets or DATA_FILE_DONE or DATA_FILE_FAILED) tuple
+    :return: Number of rows
+    """
+    return len(item[1]) if isinstance(item[1], list) else 0
+
+
+def append_segment(sink, segment_file_name, count, stats):
+    """
+    Append a segment file to the output file and remove it
+    :param sink: Sink for the output file
+    :param segment_file_name: Segment file name
+    :param count: Number of rows in the segment
+    :param stats: ExportStats where rows written and write time are added
+    """
+    t = time.time()
+    with open(segment_file_name) as segment_file:
+        sink.write_segment(segment_file)
+    os.remove(segment_file_name)
+    stats.add({ROWS_WRITTEN: count}, {WRITE: time.time() - t})
+
+
+def finish_checkpoint(manifest, file_name, urls, output_format=None, stats=None):
+    """
+    Build the CSV file from the segments of a resumable export, and remove them if no data file is missing
+    :param manifest: Manifest of the export
+    :param file_name: CSV file name
+    :param urls: Data file URLs
+    :param output_format: Output file format (see sink_helper). None for the one in the config file
+    :param stats: ExportStats where the time spent merging the segments is added as write time, or None
+    """
+    t = time.time()
+    missing = manifest.merge(file_name, urls, output_format=output_format)
+    if stats is not None:
+        stats.add(timings={WRITE: time.time() - t})
+    if missing:
+        logging.warning("{missing} data files could not be converted and are missing from {file_name}. Run the export again to retry "
+                        "them.\n".format(missing=len(missing), file_name=file_name))
+    else:
+        manifest.remove()
+
+
+_worker_session = None
+_worker_converter = None
+_worker_options = {}
+
+
+def _init_worker(timeout, stream, cache, stages=None):
+    """
+    Set up a process pool worker: create its own HTTP session and request scheduler, and leave keyboard interrupts to the parent process
+    :param timeout: Request timeout, either a number of seconds or a (connect, read) tuple
+    :param stream: If True, data files are decompressed and converted while they're being downloaded
+    :param cache: DataFileCache that data files are read through, or None
+    :param stages: Array of stages that add columns to every row, or None
+    """
+    global _worker_session, _worker_converter
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_session = build_session(pool_maxsize=1)
+    _worker_converter = RowConverter(stages=stages)
+    _worker_options.update(timeout=timeout, stream=stream, cache=cache, scheduler=build_scheduler())
+
+
+def _convert_data_file(task):
+    """
+    Process pool worker: get a data file, convert its tweets to CSV and write them to their own segment file
+    :param task: (index, url, segment file name) tuple
+    :return: (index, number of CSV tweets written, whether the whole data file could be read, stats) tuple, stats being the result of
+             ExportStats.take() for the data file
+    """
+    index, url, segment_file_name = task
+    stats = ExportStats(interval=0)
+    lines_done = 0
+    attempt = 0
+    success = True
+
+    with open(segment_file_name, 'w', WRITE_BUFFER_SIZE) as segment_file:
+        csv_writer = csv.writer(segment_file)
+        while True:
+            lines_before = stats.counters[LINES]
+            try:
+                lines = read_data_file(_worker_session, url, stats=stats, **_worker_options)
+                # Lines already processed before the connection was lost are skipped
+                for csv_tweet in convert_lines(islice(lines, lines_done, None), _worker_converter, stats):
+                    csv_writer.writerow(csv_tweet)
+            except (ConnectionError, SSLError, Timeout, ChunkedEncodingError) as e:
+                attempt = attempt + 1 if stats.counters[LINES] == lines_before else 0
+                if attempt > _worker_options["scheduler"].max_retries:
+                    logging.error("Cannot read data file ({url}): {error}. Giving up after {attempts} attempts without "
+                                  "progress\n".format(url=url, error=e, attempts=attempt))
+                    success = False
+                    break
+                delay = _worker_options["scheduler"].backoff_delay(attempt)
+                logging.warning("Connection error ({url}). Retrying in {delay:.1f}s.\n".format(url=url, delay=delay))
+                stats.add({RETRIES: 1})
+                lines_done += stats.counters[LINES] - lines_before
+                time.sleep(delay)
+            except (HTTPError, IOError, zlib.error) as e:
+                logging.error("Cannot read data file ({url}): {error}\n".format(url=url, error=e))
+                success = False
+                break
+            else:
+                break
+
+    return index, stats.counters[ROWS], success, stats.take()
 
 
-def build_csv_file(urls, file_name, num_get_request_threads):
-    sys.stdout.write("Building CSV file {file_name} from {num_urls} URLs.\n".format(file_name=file_name, num_urls=len(urls)))
-    csv_file = open(file_name, 'w')
-    csv_writer = csv.writer(csv_file)
-    csv_writer.writerow(tweet2csv())  # Header row
+def _convert_local_data_file(task):
+    """
+    Process pool worker: convert the tweets of a data file that is already on disk to CSV and write them to their own segment file
+    :param task: (index, data file name, segment file name) tuple, or (index, data file name, segment file name, stages) if rows need extra
+                 columns (workers started without _init_worker have no other way to get them)
+    :return: (index, number of CSV tweets written, whether the whole data file could be read, stats) tuple, stats being the result of
+             ExportStats.take() for the data file. Bytes read are not counted, as callers know them already
+    """
+    global _worker_converter
+    index, data_file_name, segment_file_name = task[:3]
+    if len(task) > 3 and task[3]:
+        converter = RowConverter(stages=task[3])
+    else:
+        if _worker_converter is None:  # Workers may have been started without _init_worker
+            _worker_converter = RowConverter()
+        converter = _worker_converter
+    stats = ExportStats(interval=0)
+    success = True
+
+    try:
+        with open(data_file_name, 'rb') as data_file, open(segment_file_name, 'w', WRITE_BUFFER_SIZE) as segment_file:
+            csv_writer = csv.writer(segment_file)
+            for csv_tweet in convert_lines(iter_gzip_lines(iter_mapped_chunks(data_file)), converter, stats):
+                csv_writer.writerow(csv_tweet)
+    except (EnvironmentError, zlib.error) as e:
+        logging.error("Cannot read data file ({file_name}): {error}\n".format(file_name=data_file_name, error=e))
+        success = False
+
+    return index, stats.counters[ROWS], success, stats.take()
+
+
+def build_csv_file_with_processes(urls, file_name, num_processes, timeout=DEFAULT_TIMEOUT, stream=True, resume=False, cache=None,
+                                  stages=None, output_format=None, stats=None):
+    """
+    Download all the data files and put their tweets into a single CSV file, decoding and converting them in a pool of processes so
+    that the work is not limited by the GIL. Each data file is written to its own segment file, and segments are appended to the CSV
+    file in the same order as the URLs, so the result doesn't depend on which process finishes first.
+    :param urls: Data file URLs
+    :param file_name: CSV file name
+    :param num_processes: Number of worker processes
+    :param timeout: Request timeout, either a number of seconds or a (connect, read) tuple
+    :param stream: If True, data files are decompressed and converted while they're being downloaded
+    :param resume: If True, keep the segments and a manifest in a folder next to the CSV file until the export is complete, so that an
+                   interrupted export only has to convert the remaining data files when run again
+    :param cache: DataFileCache that data files are read through, or None
+    :param stages: Array of stages that add columns to every row (see csv_helper.RowConverter). They must be picklable
+    :param output_format: Output file format (see sink_helper). None for the one in the config file. Segments are always CSV
+    :param stats: ExportStats to collect the metrics of the export in. A new one is created if None
+    :return: ExportStats
+    """
+    header = RowConverter(stages=stages).header
+    stats = stats if stats is not None else ExportStats()
+
+    if resume is True:
+        manifest = Manifest(file_name + CHECKPOINT_FOLDER_SUFFIX, header)
+        pending_urls = [url for url in urls if not manifest.is_done(url)]
+        tasks = [(i, url, manifest.segment_file_name(url, partial=True)) for i, url in enumerate(pending_urls)]
+        sink = None
+    else:
+        manifest = None
+        pending_urls = urls
+        segment_folder = tempfile.mkdtemp(prefix=os.path.basename(file_name) + ".", dir=os.path.dirname(os.path.abspath(file_name)))
+        tasks = [(i, url, os.path.join(segment_folder, "{i:08d}.csv".format(i=i))) for i, url in enumerate(pending_urls)]
+        sink = open_sink(file_name, header, output_format)
+
+    sys.stdout.write("Building CSV file {file_name} from {num_urls} URLs with {num_processes} processes.\n".format(
+        file_name=file_name, num_urls=len(pending_urls), num_processes=num_processes))
+
+    progress = {"results": 0}
+    stats.watch("urls_left", lambda: len(tasks) - progress["results"])
+    stats.start()
+    pool = Pool(num_processes, initializer=_init_worker, initargs=(timeout, stream, cache, stages))
+    try:
+        results = pool.imap(_convert_data_file, tasks)
+        for i in range(len(tasks)):
+            # A timeout is needed for KeyboardInterrupt to get through
+            index, count, success, data_file_stats = results.next(POOL_RESULT_TIMEOUT)
+            progress["results"] += 1
+            finish_data_file(stats, data_file_stats, pending_urls[index], success)
+            if manifest is not None:
+                if success is True:
+                    manifest.commit(pending_urls[index], count)
+                    stats.add({ROWS_WRITTEN: count})
+                else:
+                    manifest.discard(pending_urls[index])
+            else:
+                append_segment(sink, tasks[index][2], count, stats)
+    except KeyboardInterrupt:
+        pool.terminate()
+        if manifest is None:
+            sink.close()
+            shutil.rmtree(segment_folder, ignore_errors=True)
+        sys.exit(1)
+    else:
+        pool.close()
+        pool.join()
+        if manifest is not None:
+            finish_checkpoint(manifest, file_name, urls, output_format=output_format, stats=stats)
+        else:
+            sink.close()
+            shutil.rmtree(segment_folder, ignore_errors=True)
+        stats.stop()
+        sys.stdout.write("Done. {summary}.\n".format(summary=stats.summary()))
+
+    return stats
+
+
+def find_data_files(source):
+    """
+    Find already downloaded data files
+    :param source: Folder (searched recursively for DATA_FILE_SUFFIX files), glob pattern, or list of folders, patterns and files
+    :return: Sorted list of data file names
+    """
+    if isinstance(source, basestring):
+        source = [source]
+
+    data_file_names = set()
+    for item in source:
+        if os.path.isdir(item):
+            for dir_path, dir_names, file_names in os.walk(item):
+                data_file_names.update(os.path.join(dir_path, name) for name in file_names if name.endswith(DATA_FILE_SUFFIX))
+        else:
+            data_file_names.update(name for name in glob.glob(item) if os.path.isfile(name))
+
+    return sorted(data_file_names)
+
+
+def build_csv_file_from_files(source, file_name, num_processes=None, resume=False, stages=None, output_format=None, stats=None):
+    """
+    Replay data files that are already on disk (e.g. an archived GNIP delivery) through the same conversion as build_csv_file, in a pool
+    of processes and without any network access. Data files are memory-mapped rather than read, and segments are appended to the output
+    file in file name order.
+    :param source: Folder, glob pattern or list of them (see find_data_files)
+    :param file_name: Output file name
+    :param num_processes: Number of worker processes. Defaults to the number of CPUs
+    :param resume: If True, keep the segments and a manifest in a folder next to the output file until the export is complete, so that an
+                   interrupted export only has to convert the remaining data files when run again
+    :param stages: Array of stages that add columns to every row (see csv_helper.RowConverter). They must be picklable
+    :param output_format: Output file format (see sink_helper). None for the one in the config file
+    :param stats: ExportStats to collect the metrics of the export in. A new one is created if None
+    :return: Number of data files that could not be converted
+    """
+    num_processes = num_processes or cpu_count()
+    stats = stats if stats is not None else ExportStats()
+    data_file_names = find_data_files(source)
+    header = RowConverter(stages=stages).header
+
+    if resume is True:
+        manifest = Manifest(file_name + CHECKPOINT_FOLDER_SUFFIX, header)
+        pending_files = [name for name in data_file_names if not manifest.is_done(os.path.abspath(name))]
+        tasks = [(i, name, manifest.segment_file_name(os.path.abspath(name), partial=True)) for i, name in enumerate(pending_files)]
+        sink = None
+    else:
+        manifest = None
+        pending_files = data_file_names
+        segment_folder = tempfile.mkdtemp(prefix=os.path.basename(file_name) + ".", dir=os.path.dirname(os.path.abspath(file_name)))
+        tasks = [(i, name, os.path.join(segment_folder, "{i:08d}.csv".format(i=i))) for i, name in enumerate(pending_files)]
+        sink = open_sink(file_name, header, output_format)
+
+    sys.stdout.write("Building output file {file_name} from {num_files} data files with {num_processes} processes.\n".format(
+        file_name=file_name, num_files=len(pending_files), num_processes=num_processes))
+
+    failed = 0
+    progress = {"results": 0}
+    stats.watch("files_left", lambda: len(tasks) - progress["results"])
+    stats.start()
+    pool = Pool(num_processes, initializer=_init_worker, initargs=(DEFAULT_TIMEOUT, True, None, stages))
+    try:
+        results = pool.imap(_convert_local_data_file, tasks)
+        for i in range(len(tasks)):
+            # A timeout is needed for KeyboardInterrupt to get through
+            index, count, success, data_file_stats = results.next(POOL_RESULT_TIMEOUT)
+            progress["results"] += 1
+            if os.path.exists(pending_files[index]):
+                data_file_stats["counters"][BYTES_FROM_DISK] += os.path.getsize(pending_files[index])
+            finish_data_file(stats, data_file_stats, pending_files[index], success)
+            if success is False:
+                failed += 1
+            if manifest is not None:
+                if success is True:
+                    manifest.commit(os.path.abspath(pending_files[index]), count)
+                    stats.add({ROWS_WRITTEN: count})
+                else:
+                    manifest.discard(os.path.abspath(pending_files[index]))
+            else:
+                append_segment(sink, tasks[index][2], count, stats)
+    except KeyboardInterrupt:
+        pool.terminate()
+        if manifest is None:
+            sink.close()
+            shutil.rmtree(segment_folder, ignore_errors=True)
+        sys.exit(1)
+    else:
+        pool.close()
+        pool.join()
+        if manifest is not None:
+            finish_checkpoint(manifest, file_name, [os.path.abspath(name) for name in data_file_names], output_format=output_format,
+                              stats=stats)
+        else:
+            sink.close()
+            shutil.rmtree(segment_folder, ignore_errors=True)
+        stats.stop()
+        sys.stdout.write("Done. {summary}.\n".format(summary=stats.summary()))
+
+    return failed
+
+
+def build_csv_file_async(urls, file_name, max_downloads, num_processes=None, timeout=DEFAULT_TIMEOUT, resume=False, cache=None,
+                         stages=None, output_format=None, stats=None):
+    """
+    Download all the data files and put their tweets into a single CSV file, running all the downloads on a single event loop (tornado's,
+    which is asyncio's on Python 3) and converting the downloaded data files in a small pool of processes. Data files are downloaded to
+    disk, and at most max_downloads + 2 * num_processes of them are downloaded or waiting to be converted at any time.
+    Segments are appended to the CSV file in the same order as the URLs.
+    :param urls: Data file URLs
+    :param file_name: CSV file name
+    :param max_downloads: Maximum number of downloads in flight
+    :param num_processes: Number of conversion processes. Defaults to the number of CPUs
+    :param timeout: Request timeout, either a number of seconds or a (connect, read) tuple. Only the connection timeout is used, as
+                    downloads of big data files can take long
+    :param resume: If True, keep the segments and a manifest in a folder next to the CSV file until the export is complete, so that an
+                   interrupted export only has to convert the remaining data files when run again
+    :param cache: DataFileCache that data files are read through, or None
+    :param stages: Array of stages that add columns to every row (see csv_helper.RowConverter). They must be picklable
+    :param output_format: Output file format (see sink_helper). None for the one in the config file. Segments are always CSV
+    :param stats: ExportStats to collect the metrics of the export in. A new one is created if None
+    :return: ExportStats
+    """
+    if AsyncHTTPClient is None:
+        raise ImportError("The async engine needs tornado: pip install python-powertrack[async]")
+
+    num_processes = num_processes or cpu_count()
+    stats = stats if stats is not None else ExportStats()
+    connect_timeout = timeout[0] if isinstance(timeout, tuple) else timeout
+    header = RowConverter(stages=stages).header
+    download_folder = tempfile.mkdtemp(prefix=os.path.basename(file_name) + ".", dir=os.path.dirname(os.path.abspath(file_name)))
+
+    if resume is True:
+        manifest = Manifest(file_name + CHECKPOINT_FOLDER_SUFFIX, header)
+        pending_urls = [url for url in urls if not manifest.is_done(url)]
+        segment_file_names = [manifest.segment_file_name(url, partial=True) for url in pending_urls]
+        sink = None
+    else:
+        manifest = None
+        pending_urls = urls
+        segment_file_names = [os.path.join(download_folder, "{i:08d}.csv".format(i=i)) for i in range(len(pending_urls))]
+        sink = open_sink(file_name, header, output_format)
+
+    sys.stdout.write("Building CSV file {file_name} from {num_urls} URLs with up to {max_downloads} downloads and {num_processes} "
+                     "processes.\n".format(file_name=file_name, num_urls=len(pending_urls), max_downloads=max_downloads,
+                                           num_processes=num_processes))
+
+    executor = ProcessPoolExecutor(num_processes)
+    segments_done = {}
+    scheduler = build_scheduler()  # Only its retry and backoff settings, requests go through tornado's client
+    state = {"next_segment": 0, "downloads": 0, "converting": 0, "paused_until": 0}
+    stats.watch("downloads_in_flight", lambda: state["downloads"])
+    stats.watch("data_files_converting", lambda: state["converting"])
+
+    def merge_segments():
+        # Append the segments that are ready to the output file, in URL order
+        while state["next_segment"] in segments_done:
+            append_segment(sink, segment_file_names[state["next_segment"]], segments_done[state["next_segment"]], stats)
+            state["next_segment"] += 1
+
+    @gen.coroutine
+    def download(client, url, data_file_name):
+        attempt = 0
+        while True:
+            wait = state["paused_until"] - time.time()
+            if wait > 0:  # A download was throttled, and the server said how long to wait
+                yield gen.sleep(wait)
+            with open(data_file_name, 'wb') as data_file:
+                def write(chunk):
+                    data_file.write(chunk)
+                    stats.add({BYTES_DOWNLOADED: len(chunk)})
+
+                request = HTTPRequest(url, connect_timeout=connect_timeout, request_timeout=ASYNC_REQUEST_TIMEOUT, streaming_callback=write)
+                t = time.time()
+                state["downloads"] += 1
+                try:
+                    yield client.fetch(request)
+                except AsyncHTTPError as e:
+                    if e.code in THROTTLE_STATUS_CODES and attempt < scheduler.max_retries:
+                        retry_after = parse_retry_after(e.response.headers.get("Retry-After")) if e.response is not None else None
+                        delay = retry_after if retry_after is not None else scheduler.backoff_delay(attempt)
+                        state["paused_until"] = max(state["paused_until"], time.time() + delay)
+                        logging.warning("{url} returned {code}. Retrying in {delay:.1f}s.\n".format(url=url, code=e.code, delay=delay))
+                    elif e.code == 599 and attempt < scheduler.max_retries:  # Connection errors and timeouts
+                        delay = scheduler.backoff_delay(attempt)
+                        logging.warning("Connection error ({url}). Will retry in {delay:.1f}s.\n".format(url=url, delay=delay))
+                    else:
+                        logging.error("Cannot read data file ({url}): {error}\n".format(url=url, error=e))
+                        raise gen.Return(False)
+                except IOError as e:
+                    if attempt >= scheduler.max_retries:
+                        logging.error("Cannot read data file ({url}): {error}\n".format(url=url, error=e))
+                        raise gen.Return(False)
+                    delay = scheduler.backoff_delay(attempt)
+                    logging.warning("Connection error ({url}). Will retry in {delay:.1f}s.\n".format(url=url, delay=delay))
+                else:
+                    raise gen.Return(True)
+                finally:
+                    state["downloads"] -= 1
+                    stats.add(timings={DOWNLOAD: time.time() - t})
+            stats.add({RETRIES: 1})
+            attempt += 1
+            yield gen.sleep(delay)
+
+    @gen.coroutine
+    def process(client, slots, downloads, index, url):
+        with (yield slots.acquire()):
+            data_file_name = cache.get(url) if cache is not None else None
+            downloaded = data_file_name is None
+            if downloaded is True:
+                data_file_name = os.path.join(download_folder, "{i:08d}.json.gz".format(i=index))
+                with (yield downloads.acquire()):
+                    success = yield download(client, url, data_file_name)
+            else:
+                success = True
+                stats.add({BYTES_FROM_DISK: os.path.getsize(data_file_name)})
+
+            count = 0
+            data_file_stats = ExportStats(interval=0).take()
+            if success is True:
+                state["converting"] += 1
+                try:
+                    index, count, success, data_file_stats = yield executor.submit(_convert_local_data_file,
+                                                                                   (index, data_file_name, segment_file_names[index], stages))
+                finally:
+                    state["converting"] -= 1
+
+            if downloaded is True:
+                if success is True and cache is not None:
+                    cache.add(url, data_file_name)
+                elif os.path.exists(data_file_name):
+                    os.remove(data_file_name)
+
+        finish_data_file(stats, data_file_stats, url, success)
+
+        if manifest is not None:
+            if success is True:
+                manifest.commit(url, count)
+                stats.add({ROWS_WRITTEN: count})
+            else:
+                manifest.discard(url)
+        else:
+            if not os.path.exists(segment_file_names[index]):
+                open(segment_file_names[index], 'w').close()
+            segments_done[index] = count
+            merge_segments()
+
+    @gen.coroutine
+    def run():
+        client = AsyncHTTPClient(force_instance=True, max_clients=max_downloads)
+        slots = locks.Semaphore(max_downloads + 2 * num_processes)
+        downloads = locks.Semaphore(max_downloads)
+        try:
+            yield [process(client, slots, downloads, index, url) for index, url in enumerate(pending_urls)]
+        finally:
+            client.close()
+
+    stats.start()
+    try:
+        ioloop.IOLoop.current().run_sync(run)
+    except KeyboardInterrupt:
+        executor.shutdown(wait=False)
+        if sink is not None:
+            sink.close()
+        shutil.rmtree(download_folder, ignore_errors=True)
+        sys.exit(1)
+    else:
+        executor.shutdown()
+        if manifest is not None:
+            finish_checkpoint(manifest, file_name, urls, output_format=output_format, stats=stats)
+        else:
+            sink.close()
+        shutil.rmtree(download_folder, ignore_errors=True)
+        stats.stop()
+        sys.stdout.write("Done. {summary}.\n".format(summary=stats.summary()))
+
+    return stats
+
+
+def build_csv_file(urls, file_name, num_get_request_threads, session=None, timeout=DEFAULT_TIMEOUT, stream=True,
+                   writer_queue_size=DEFAULT_WRITER_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE, engine=THREAD_ENGINE, resume=False, cache=None,
+                   num_processes=None, stages=None, output_format=None, stats=None, scheduler=None):
+    """
+    Download all the data files and put their tweets into a single CSV file
+    :param urls: Data file URLs
+    :param file_name: CSV file name
+    :param num_get_request_threads: Number of concurrent downloads (number of worker processes for the process engine, maximum number of
+                                    downloads in flight for the async engine). With the thread engine, the scheduler's AdaptiveConcurrency
+                                    takes precedence if there's one
+    :param session: HTTP session to reuse (typically the one from the PowerTrack instance). A new one is created if None
+    :param timeout: Request timeout, either a number of seconds or a (connect, read) tuple
+    :param stream: If True, data files are decompressed and converted while they're being downloaded, so memory usage per thread doesn't
+                   depend on the size of the files
+    :param writer_queue_size: Maximum number of converted rows waiting to be written. Download threads block when it's reached, so that
+                              memory usage is bounded if they're faster than the writer. 0 for no limit
+    :param batch_size: Number of CSV tweets handed over to the writer at once
+    :param engine: THREAD_ENGINE to download and convert data files in threads, PROCESS_ENGINE to do it in a pool of processes (see
+                   build_csv_file_with_processes), ASYNC_ENGINE to download them on an event loop and convert them in a pool of processes
+                   (see build_csv_file_async). Only the thread engine uses session, writer_queue_size and batch_size
+    :param resume: If True, every data file is written to its own segment file, and a manifest of the completed ones is kept in a folder
+                   next to the CSV file until the export is complete. If the export is interrupted, running it again only converts the
+                   remaining data files
+    :param cache: DataFileCache that data files are read through, so that exporting the same job again doesn't download them again.
+                  None for no cache
+    :param num_processes: Number of conversion processes for the async engine. Defaults to the number of CPUs
+    :param stages: Array of stages that add columns to every row, such as a category_helper.Job (see csv_helper.RowConverter). The
+                   process and async engines need them to be picklable. None for no extra columns
+    :param output_format: Output file format: sink_helper.CSV_FORMAT, PARQUET_FORMAT or ARROW_FORMAT. None for the one in the config file
+    :param stats: ExportStats to collect the metrics of the export in: bytes downloaded, rows produced, dropped and written, time spent
+                  in every stage, queue depths... (see metrics_helper). A new one, which prints a summary periodically, is created if None
+    :param scheduler: RequestScheduler that the thread engine sends its requests through (typically the one from the PowerTrack instance).
+                      Its AdaptiveConcurrency, if any, sets how many threads download data files at any time, as it adapts to throughput
+                      and throttling. If None, one is created from the config file, with num_get_request_threads as a fixed maximum
+    :return: ExportStats
+    """
+    if engine == ASYNC_ENGINE:
+        return build_csv_file_async(urls, file_name, num_get_request_threads, num_processes=num_processes, timeout=timeout, resume=resume,
+                                    cache=cache, stages=stages, output_format=output_format, stats=stats)
+    if engine == PROCESS_ENGINE:
+        return build_csv_file_with_processes(urls, file_name, num_get_request_threads, timeout=timeout, stream=stream, resume=resume,
+                                             cache=cache, stages=stages, output_format=output_format, stats=stats)
+
+    stats = stats if stats is not None else ExportStats()
+
+    if scheduler is None:
+        scheduler = build_scheduler(AdaptiveConcurrency(num_get_request_threads))
+    if scheduler.concurrency is not None:
+        num_get_request_threads = scheduler.concurrency.maximum
+
+    if session is None:
+        session = build_session(pool_maxsize=num_get_request_threads)
+
+    converter = RowConverter(stages=stages)
+
+    if resume is True:
+        manifest = Manifest(file_name + CHECKPOINT_FOLDER_SUFFIX, converter.header)
+        pending_urls = [url for url in urls if not manifest.is_done(url)]
+        sink = None
+    else:
+        manifest = None
+        pending_urls = urls
+        sink = open_sink(file_name, converter.header, output_format)
+
+    sys.stdout.write("Building CSV file {file_name} from {num_urls} URLs.\n".format(file_name=file_name, num_urls=len(pending_urls)))
 
     url_q = Queue()
-    writer_q = Queue()
+    writer_q = RowQueue(max_rows=writer_queue_size, weight=batch_weight)
+    stats.watch("urls_in_queue", url_q.qsize)
+    stats.watch("writer_queue_rows", lambda: writer_q.rows)
+    if scheduler.concurrency is not None:
+        stats.watch("download_threads", lambda: scheduler.concurrency.limit)
+    retries = scheduler.retries
+    stats.start()
 
     for i in range(num_get_request_threads):
-        t = GetRequestThread(url_q, writer_q)
+        t = GetRequestThread(url_q, writer_q, session, converter, timeout=timeout, stream=stream, batch_size=batch_size,
+                             cache=cache, stats=stats, scheduler=scheduler)
         t.daemon = True
         t.start()
 
-    writer = WriteTweetThread(csv_writer, writer_q)
+    writer = WriteTweetThread(sink, writer_q, manifest=manifest, stats=stats)
     writer.daemon = True
     writer.start()
 
     try:
-        for url in urls:
-            url_q.put(url)
+        for url in pending_urls:
+            url_q.put((url, 0, 0))
         url_q.join()
-        if not writer_q.empty():
-            writer_q.join()
+        writer_q.join()
+        for i in range(num_get_request_threads):
+            url_q.put(None)
     except KeyboardInterrupt:
-        csv_file.close()
+        if sink is not None:
+            sink.close()
         sys.exit(1)
     else:
-        csv_file.close()
-        sys.stdout.write("Done.\n")
+        if manifest is not None:
+            finish_checkpoint(manifest, file_name, urls, output_format=output_format, stats=stats)
+        else:
+            sink.close()
+        stats.add({RETRIES: scheduler.retries - retries})  # Requests retried by the scheduler itself
+        stats.stop()
+        sys.stdout.write("Done. {summary}. Writer queue: {queue_stats}.\n".format(summary=stats.summary(), queue_stats=writer_q.stats()))
+
+    return stats
@@ -0,0 +1,32 @@
+import requests
+import urlparse
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_TIMEOUT = (10, 60)  # (connect, read) in seconds
+
+
+def build_session(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_CONNECTIONS):
+    """
+    Create an HTTP session whose connections are kept alive and reused, instead of doing a new TCP+TLS handshake for every request
+    :param pool_connections: Number of per-host connection pools to keep
+    :param pool_maxsize: Maximum number of connections kept alive per host (should be at least the number of threads using the session)
+    :return: Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def data_file_key(url):
+    """
+    Get a stable identifier for a data file: its URL without the query string, which holds a signature that changes every time the URL
+    list is requested
+    :param url: Data file URL
+    :return: Identifier
+    """
+    parts = urlparse.urlsplit(url)
+    return parts.netloc + parts.path
@@ -0,0 +1,121 @@
+import json
+import re
+import string
+from functools import partial
+from threading import Lock
+
+from powertrack.config_helper import get_option
+
+
+AUTO = "auto"
+ORJSON = "orjson"
+UJSON = "ujson"
+STDLIB = "json"
+
+BACKENDS = (ORJSON, UJSON, STDLIB)  # In order of preference
+
+# Escaped high surrogate not followed by a low one, or low surrogate not preceded by a high one
+LONE_SURROGATE = re.compile(r"\\u[dD][89abAB][0-9a-fA-F]{2}(?!\\u[dD][c-fC-F])|"
+                            r"(?<!\\u[dD][89abAB][0-9a-fA-F]{2})\\u[dD][c-fC-F][0-9a-fA-F]{2}")
+DIGITS_AS_ZEROS = string.maketrans(string.digits, "0" * len(string.digits))
+LONG_NUMBER = "0" * 20  # Digits in 2 ** 64, once translated with DIGITS_AS_ZEROS
+
+_encoder = json.JSONEncoder()  # Same settings as json.dumps' defaults
+
+backend = None
+loads = json.loads
+
+
+def dumps(obj):
+    """
+    Serialize an object to JSON. Output is always the standard library's, byte by byte, because the faster libraries don't support its
+    separators; the encoder is just built once instead of on every call.
+    :param obj: Object to serialize
+    :return: JSON string
+    """
+    return _encoder.encode(obj)
+
+
+def _with_fallback(fast_loads):
+    """
+    Make a decoding function that falls back to the standard library's for the documents that a faster library rejects but are valid
+    JSON for the standard library, such as integers over 64 bits or NaN, so that they aren't dropped as invalid
+    :param fast_loads: loads function of the faster library
+    :return: loads function
+    """
+    def loads(text):
+        try:
+            return fast_loads(text)
+        except ValueError:
+            return json.loads(text)
+
+    return loads
+
+
+def _ujson_loads(ujson_loads):
+    """
+    Make a ujson decoding function that gives the same results as the standard library's. ujson decodes some valid documents differently
+    without raising: lone surrogates (such as \\ud800) become empty strings and integers over 64 bits can wrap around, so documents that
+    could contain either are decoded with the standard library, as well as those that ujson rejects.
+    ujson 2.x also keeps its number parser in a global that every call creates and then frees. When the garbage collector runs Python
+    code in the middle of a call, another thread can start decoding and free it under the first one, which crashes the interpreter, so
+    calls are serialized. ujson holds the GIL the whole time anyway, so that doesn't cost any parallelism
+    :param ujson_loads: ujson's loads function
+    :return: loads function
+    """
+    lock = Lock()
+
+    def loads(text):
+        if type(text) is not str or LONG_NUMBER in text.translate(DIGITS_AS_ZEROS) or LONE_SURROGATE.search(text):
+            return json.loads(text)
+        try:
+            with lock:
+                return ujson_loads(text)
+        except ValueError:
+            return json.loads(text)
+
+    return loads
+
+
+def _get_loads(name):
+    """
+    Get the decoding function of a JSON library
+    :param name: Library name, one of BACKENDS
+    :return: loads function. Raises ImportError if the library is not installed
+    """
+    if name == ORJSON:
+        import orjson
+        return _with_fallback(orjson.loads)
+    elif name == UJSON:
+        import ujson
+        try:
+            ujson.loads("0", precise_float=True)
+        except TypeError:  # ujson >= 2.0 always parses floats precisely
+            return _ujson_loads(ujson.loads)
+        return _ujson_loads(partial(ujson.loads, precise_float=True))  # Floats must round-trip exactly or coordinates would change
+    elif name == STDLIB:
+        return json.loads
+
+    raise ValueError("Unknown JSON backend: {name}".format(name=name))
+
+
+def set_backend(name=AUTO):
+    """
+    Select the library used to decode JSON
+    :param name: One of BACKENDS, or AUTO to pick the fastest one installed
+    :return: Name of the selected library
+    """
+    global backend, loads
+
+    for candidate in (BACKENDS if name == AUTO else (name,)):
+        try:
+            loads = _get_loads(candidate)
+        except ImportError:
+            if name != AUTO:
+                raise
+        else:
+            backend = candidate
+            return backend
+
+
+set_backend(get_option('output', 'json_backend', AUTO))
@@ -0,0 +1,186 @@
+import sys
+import time
+from threading import Event, Lock, Thread
+
+from powertrack.config_helper import get_option
+
+
+DEFAULT_STATS_INTERVAL = 10
+
+# Counters
+DATA_FILES = "data_files"
+DATA_FILES_FAILED = "data_files_failed"
+PAGES = "pages"
+RETRIES = "retries"
+BYTES_DOWNLOADED = "bytes_downloaded"
+BYTES_FROM_DISK = "bytes_from_disk"  # Cached or already downloaded data files
+LINES = "lines"
+DECODE_ERRORS = "decode_errors"
+ROWS = "rows"
+ROWS_WITHOUT_GEOMETRY = "rows_without_geometry"
+ROWS_DROPPED = "rows_dropped"
+ROWS_WRITTEN = "rows_written"
+
+COUNTERS = (DATA_FILES, DATA_FILES_FAILED, PAGES, RETRIES, BYTES_DOWNLOADED, BYTES_FROM_DISK, LINES, DECODE_ERRORS, ROWS,
+            ROWS_WITHOUT_GEOMETRY, ROWS_DROPPED, ROWS_WRITTEN)
+
+# Stages. Their timings add up the time spent by every thread or process, so they can exceed the elapsed time
+DOWNLOAD = "download"  # Or reading from disk, including decompression
+DECODE = "decode"
+CONVERT = "convert"
+QUEUE_WAIT = "queue_wait"  # Producers blocked by a full writer queue
+WRITE = "write"
+
+STAGES = (DOWNLOAD, DECODE, CONVERT, QUEUE_WAIT, WRITE)
+
+# Callback events
+DATA_FILE_EVENT = "data_file"
+PAGE_EVENT = "page"
+PROGRESS_EVENT = "progress"
+DONE_EVENT = "done"
+
+
+class ExportStats(object):
+    """
+    Counters, per-stage timings and gauges (such as queue depths) of an export, shared by all its threads. Worker processes keep their own
+    and send them back to be merged. A callback can be notified of every data file or result page and of periodic progress, and a
+    summary can be printed periodically as well.
+    """
+    def __init__(self, callback=None, interval=None, output=None):
+        """
+        ExportStats constructor
+        :param callback: Function called as callback(event, stats, data) for every event (see *_EVENT), data being a dictionary with
+                         details of the event (e.g. the URL and number of rows of a data file). None for no callback
+        :param interval: Seconds between progress events and printed summaries. 0 for none. Defaults to the stats_interval option in the
+                         config file, or DEFAULT_STATS_INTERVAL
+        :param output: File where summaries are printed, sys.stdout if None. False to only call the callback
+        :return:
+        """
+        self.callback = callback
+        self.interval = get_option('output', 'stats_interval', DEFAULT_STATS_INTERVAL, float) if interval is None else interval
+        self.output = output
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.timings = dict.fromkeys(STAGES, 0.0)
+        self.gauges = {}
+        self.start_time = time.time()
+        self.end_time = None
+        self.lock = Lock()
+        self.stopped = Event()
+        self.reporter = None
+
+    def add(self, counters=None, timings=None):
+        """
+        Add to counters and stage timings at once
+        :param counters: Dictionary of counter increments
+        :param timings: Dictionary of stage times, in seconds
+        """
+        with self.lock:
+            for name, value in (counters or {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, value in (timings or {}).items():
+                self.timings[name] = self.timings.get(name, 0.0) + value
+
+    def merge(self, snapshot):
+        """
+        Add the counters and timings of another ExportStats, typically from a worker process
+        :param snapshot: Result of take() or snapshot()
+        """
+        self.add(snapshot["counters"], snapshot["timings"])
+
+    def take(self):
+        """
+        Get the counters and timings and reset them, so that they can be merged into another ExportStats
+        :return: Dictionary with counters and timings
+        """
+        with self.lock:
+            taken = {"counters": self.counters, "timings": self.timings}
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.timings = dict.fromkeys(STAGES, 0.0)
+        return taken
+
+    def watch(self, name, function):
+        """
+        Add a gauge, whose value is read whenever a snapshot is taken
+        :param name: Gauge name, such as "writer_queue_rows"
+        :param function: Function without arguments that returns the current value
+        """
+        self.gauges[name] = function
+
+    def snapshot(self):
+        """
+        :return: Dictionary with the elapsed time, counters, timings, gauges and writer lag (rows produced but not written yet)
+        """
+        with self.lock:
+            counters = dict(self.counters)
+            timings = dict(self.timings)
+        return {
+            "elapsed": (self.end_time or time.time()) - self.start_time,
+            "counters": counters,
+            "timings": timings,
+            "gauges": dict((name, function()) for name, function in self.gauges.items()),
+            "writer_lag": counters[ROWS] - counters[ROWS_WRITTEN],
+        }
+
+    def summary(self):
+        """
+        :return: Human-readable summary of a snapshot
+        """
+        snapshot = self.snapshot()
+        counters = snapshot["counters"]
+        elapsed = max(snapshot["elapsed"], 1e-6)
+        downloaded = counters[BYTES_DOWNLOADED] / 1024.0 / 1024.0
+        from_disk = counters[BYTES_FROM_DISK] / 1024.0 / 1024.0
+
+        summary = "{rows} rows ({rate:.0f}/s), {written} written (lag {lag}), {no_geometry} without geometry, {dropped} dropped, " \
+                  "{decode_errors} undecodable lines. {downloaded:.1f} MB downloaded ({download_rate:.2f} MB/s), {from_disk:.1f} MB read " \
+                  "from disk, {files} data files ({failed} failed), {pages} pages, {retries} retries in {elapsed:.1f}s".format(
+                      rows=counters[ROWS], rate=counters[ROWS] / elapsed, written=counters[ROWS_WRITTEN], lag=snapshot["writer_lag"],
+                      no_geometry=counters[ROWS_WITHOUT_GEOMETRY], dropped=counters[ROWS_DROPPED], decode_errors=counters[DECODE_ERRORS],
+                      downloaded=downloaded, download_rate=downloaded / elapsed, from_disk=from_disk, files=counters[DATA_FILES],
+                      failed=counters[DATA_FILES_FAILED], pages=counters[PAGES], retries=counters[RETRIES], elapsed=snapshot["elapsed"])
+        summary += ". Stage times: " + ", ".join("{stage} {seconds:.1f}s".format(stage=stage, seconds=snapshot["timings"][stage])
+                                                 for stage in STAGES)
+        if snapshot["gauges"]:
+            summary += ". " + ", ".join("{name} {value}".format(name=name, value=value) for name, value in sorted(snapshot["gauges"].items()))
+
+        return summary
+
+    def event(self, name, **data):
+        """
+        Notify the callback of an event
+        :param name: Event name, one of *_EVENT
+        :param data: Details of the event
+        """
+        if self.callback is not None:
+            self.callback(name, self, data)
+
+    def report(self):
+        while not self.stopped.wait(self.interval):
+            if self.output is not False:
+                (self.output or sys.stdout).write("Progress: {summary}\n".format(summary=self.summary()))
+            self.event(PROGRESS_EVENT)
+
+    def start(self):
+        """
+        Start measuring the elapsed time, and start the periodic summaries if there's an interval
+        :return: self
+        """
+        self.start_time = time.time()
+        self.end_time = None
+        self.stopped.clear()
+        if self.interval > 0 and self.reporter is None:
+            self.reporter = Thread(target=self.report)
+            self.reporter.daemon = True
+            self.reporter.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the periodic summaries and notify the callback that the export is done
+        """
+        self.end_time = time.time()
+        self.stopped.set()
+        if self.reporter is not None:
+            self.reporter.join()
+            self.reporter = None
+        self.event(DONE_EVENT)
@@ -0,0 +1,60 @@
+import time
+from Queue import Queue
+
+
+class RowQueue(Queue):
+    """
+    Queue bounded by the number of rows it holds instead of by the number of items, so that producers block when the high-water mark is
+    reached. It also keeps track of its peak depth and of how long producers have been blocked, which helps tune the limit.
+    """
+    def __init__(self, max_rows=0, weight=None):
+        """
+        RowQueue constructor
+        :param max_rows: High-water mark, in rows. 0 for an unbounded queue
+        :param weight: Function that returns the number of rows in an item. Every item is a single row if None
+        :return:
+        """
+        Queue.__init__(self)
+        self.max_rows = max_rows
+        self.weight = weight or (lambda item: 1)
+        self.rows = 0
+        self.max_rows_seen = 0
+        self.blocked_puts = 0
+        self.blocked_time = 0.0
+
+    def put(self, item):
+        """
+        Put an item into the queue, waiting until there's room for it if the high-water mark has been reached.
+        An item bigger than the high-water mark is accepted as soon as the queue is empty.
+        :param item: Row or batch of rows
+        """
+        weight = self.weight(item)
+        with self.not_full:
+            if self.max_rows > 0 and 0 < self.rows and self.rows + weight > self.max_rows:
+                start = time.time()
+                while 0 < self.rows and self.rows + weight > self.max_rows:
+                    self.not_full.wait()
+                self.blocked_puts += 1
+                self.blocked_time += time.time() - start
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put(self, item):
+        self.queue.append(item)
+        self.rows += self.weight(item)
+        self.max_rows_seen = max(self.max_rows_seen, self.rows)
+
+    def _get(self):
+        item = self.queue.popleft()
+        self.rows -= self.weight(item)
+        self.not_full.notify_all()  # Several producers may fit now
+        return item
+
+    def stats(self):
+        """
+        Get a summary of the queue usage
+        :return: Human-readable string
+        """
+        return "peak depth {max_rows_seen} rows (limit {max_rows}), producers blocked {blocked_puts} times for {blocked_time:.2f}s".format(
+            max_rows_seen=self.max_rows_seen, max_rows=self.max_rows or "none", blocked_puts=self.blocked_puts, blocked_time=self.blocked_time)
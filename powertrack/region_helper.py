@@ -0,0 +1,234 @@
+import json
+
+from powertrack.config_helper import get_option
+
+
+INSIDE = 0  # The whole cell is inside the region
+BOUNDARY = 1  # The region's boundary goes through the cell, points need a full test
+
+CELLS_PER_REGION_SIDE = 4  # Default cell size is a fraction of a typical region's, so that many cells are entirely inside a region
+DEFAULT_MAX_REGION_CELLS = 4096  # Regions spanning more cells than this are tested for every point, by bounding box first
+EDGES_PER_SLAB = 4
+
+
+def get_rings(geometry):
+    """
+    :param geometry: Polygon or MultiPolygon GeoJSON dictionary
+    :return: List of rings (outer rings and holes alike), each a list of (lon, lat) tuples
+    """
+    if geometry["type"] in ("Polygon", "polygon"):
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] in ("MultiPolygon", "multipolygon"):
+        polygons = geometry["coordinates"]
+    else:
+        raise ValueError("Regions must be polygons, not {type}".format(type=geometry["type"]))
+    return [[(float(point[0]), float(point[1])) for point in ring] for polygon in polygons for ring in polygon]
+
+
+def load_regions(file_name, id_property=None):
+    """
+    Read regions from a GeoJSON file
+    :param file_name: GeoJSON file with a FeatureCollection (or a single Feature) of polygons or multipolygons
+    :param id_property: Feature property used as the region id. None for the features' id, or their position in the file if they don't
+                        have one
+    :return: List of (region id, rings) tuples, in file order
+    """
+    with open(file_name) as regions_file:
+        data = json.load(regions_file)
+
+    features = data["features"] if data.get("type") == "FeatureCollection" else [data]
+    regions = []
+    for i, feature in enumerate(features):
+        if id_property is not None:
+            region_id = (feature.get("properties") or {}).get(id_property)
+        else:
+            region_id = feature.get("id")
+        if region_id is None:
+            region_id = i
+        if isinstance(region_id, unicode):
+            region_id = region_id.encode("utf-8")
+        regions.append((str(region_id), get_rings(feature.get("geometry") or feature)))
+
+    return regions
+
+
+class Polygon(object):
+    """
+    Region geometry that answers point-in-polygon queries with the even-odd rule. Its edges are split into horizontal slabs, so that only
+    the edges that can cross a point's horizontal ray are tested
+    """
+    def __init__(self, rings):
+        """
+        Polygon constructor
+        :param rings: List of rings, each a list of (lon, lat) tuples. Rings don't need to be closed
+        :return:
+        """
+        edges = []
+        for ring in rings:
+            for i in range(len(ring)):
+                (x1, y1), (x2, y2) = ring[i - 1], ring[i]
+                edges.append((x1, y1, x2, y2))
+        self.edges = edges
+
+        points = [point for ring in rings for point in ring]
+        self.min_x = min(x for x, y in points)
+        self.max_x = max(x for x, y in points)
+        self.min_y = min(y for x, y in points)
+        self.max_y = max(y for x, y in points)
+
+        num_slabs = max(1, len(edges) // EDGES_PER_SLAB)
+        self.slab_height = (self.max_y - self.min_y) / num_slabs or 1.0
+        self.slabs = [[] for i in range(num_slabs)]
+        for edge in edges:
+            first, last = self.get_slab(edge[1]), self.get_slab(edge[3])
+            if first == last:
+                self.slabs[first].append(edge)
+                continue
+            for i in range(min(first, last), max(first, last) + 1):
+                self.slabs[i].append(edge)
+
+    def get_slab(self, y):
+        return min(max(int((y - self.min_y) / self.slab_height), 0), len(self.slabs) - 1)
+
+    def contains(self, x, y):
+        """
+        :return: True if the point is inside the polygon (outside all its holes)
+        """
+        if not (self.min_x <= x <= self.max_x and self.min_y <= y <= self.max_y):
+            return False
+        inside = False
+        for x1, y1, x2, y2 in self.slabs[self.get_slab(y)]:
+            if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+                inside = not inside
+        return inside
+
+    def touched_cells(self, cell_size):
+        """
+        :param cell_size: Grid cell size, in degrees
+        :return: Set of (x, y) grid cells that the polygon's edges may go through
+        """
+        cells = set()
+        for x1, y1, x2, y2 in self.edges:
+            cell_x1, cell_x2 = int(x1 // cell_size), int(x2 // cell_size)
+            cell_y1, cell_y2 = int(y1 // cell_size), int(y2 // cell_size)
+            if cell_x1 == cell_x2 and cell_y1 == cell_y2:  # Most edges are much shorter than a cell
+                cells.add((cell_x1, cell_y1))
+                continue
+            for x in range(min(cell_x1, cell_x2), max(cell_x1, cell_x2) + 1):
+                for y in range(min(cell_y1, cell_y2), max(cell_y1, cell_y2) + 1):
+                    cells.add((x, y))
+        return cells
+
+
+class RegionIndex(object):
+    """
+    Grid index of regions. Every grid cell lists the regions that overlap it, and whether the cell is entirely inside them (so no
+    point-in-polygon test is needed) or their boundary goes through it. Looking up a point takes finding its cell and testing the
+    regions there, which doesn't depend on the total number of regions
+    """
+    def __init__(self, regions, cell_size=None, max_region_cells=DEFAULT_MAX_REGION_CELLS):
+        """
+        RegionIndex constructor
+        :param regions: List of (region id, rings) tuples, as returned by load_regions
+        :param cell_size: Grid cell size, in degrees. Defaults to a quarter of the median size of the regions' bounding boxes
+        :param max_region_cells: Regions whose bounding box spans more cells than this are kept out of the grid and tested (by bounding
+                                 box first) for every point
+        :return:
+        """
+        self.ids = [region_id for region_id, rings in regions]
+        self.polygons = [Polygon(rings) for region_id, rings in regions]
+
+        if cell_size is None:
+            sizes = sorted(max(polygon.max_x - polygon.min_x, polygon.max_y - polygon.min_y) for polygon in self.polygons)
+            cell_size = sizes[len(sizes) // 2] / CELLS_PER_REGION_SIDE if sizes else 1.0
+        self.cell_size = cell_size or 1.0
+
+        self.cells = {}
+        self.large = []
+        for index, polygon in enumerate(self.polygons):
+            min_x, min_y = int(polygon.min_x // self.cell_size), int(polygon.min_y // self.cell_size)
+            max_x, max_y = int(polygon.max_x // self.cell_size), int(polygon.max_y // self.cell_size)
+            if (max_x - min_x + 1) * (max_y - min_y + 1) > max_region_cells:
+                self.large.append(index)
+                continue
+
+            boundary = polygon.touched_cells(self.cell_size)
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    if (x, y) in boundary:
+                        self.cells.setdefault((x, y), []).append((index, BOUNDARY))
+                    elif polygon.contains((x + 0.5) * self.cell_size, (y + 0.5) * self.cell_size):
+                        self.cells.setdefault((x, y), []).append((index, INSIDE))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, lon, lat):
+        """
+        :return: Id of the first region (in the order they were given) that contains the point, or None
+        """
+        found = None
+        for index, status in self.cells.get((int(lon // self.cell_size), int(lat // self.cell_size)), ()):
+            if status == INSIDE or self.polygons[index].contains(lon, lat):
+                found = index
+                break
+        for index in self.large:
+            if found is not None and index > found:
+                break
+            if self.polygons[index].contains(lon, lat):
+                found = index
+                break
+        return self.ids[found] if found is not None else None
+
+
+class RegionFilter(object):
+    """
+    Pipeline stage (see csv_helper.RowConverter) that tags tweets with the id of the region they're in, and drops the ones outside all
+    regions. It tests the tweet's point (the_geom) before the row is built, so put it first among the stages
+    """
+    header = ["region_id"]
+
+    def __init__(self, index, keep_outside=False):
+        """
+        RegionFilter constructor
+        :param index: RegionIndex
+        :param keep_outside: If True, tweets outside all regions are kept, with an empty region id
+        :return:
+        """
+        self.index = index
+        self.keep_outside = keep_outside
+
+    @classmethod
+    def from_file(cls, file_name, id_property=None, keep_outside=False, cell_size=None):
+        """
+        Create a RegionFilter for the regions in a GeoJSON file (see load_regions)
+        :return: RegionFilter
+        """
+        return cls(RegionIndex(load_regions(file_name, id_property), cell_size=cell_size), keep_outside=keep_outside)
+
+    def process_point(self, tweet, point):
+        """
+        :param tweet: Tweet in json format
+        :param point: Its point GeoJSON dictionary
+        :return: [region id], or None if the tweet is outside all regions
+        """
+        try:
+            region_id = self.index.find(float(point["coordinates"][0]), float(point["coordinates"][1]))
+        except (KeyError, TypeError, IndexError, ValueError):
+            region_id = None
+        if region_id is None:
+            return [""] if self.keep_outside is True else None
+        return [region_id]
+
+
+def get_region_filter():
+    """
+    Create a RegionFilter as set in the [regions] section of the config file
+    :return: RegionFilter, or None if the section doesn't set a file
+    """
+    file_name = get_option('regions', 'file')
+    if file_name is None:
+        return None
+    return RegionFilter.from_file(file_name, id_property=get_option('regions', 'id_property'),
+                                  keep_outside=get_option('regions', 'keep_outside', False, bool),
+                                  cell_size=get_option('regions', 'cell_size', None, float))
@@ -0,0 +1,252 @@
+import logging
+import random
+import time
+from email.utils import mktime_tz, parsedate_tz
+from threading import Condition, Lock
+
+from requests.exceptions import ConnectionError, Timeout
+
+from powertrack.config_helper import get_option
+
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_BASE = 1  # Seconds
+DEFAULT_BACKOFF_MAX = 60
+DEFAULT_INCREASE_THRESHOLD = 1.05  # Throughput must improve at least 5% for concurrency to keep growing
+DEFAULT_DECREASE_FACTOR = 0.5
+
+THROTTLE_STATUS_CODES = (429, 503)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def backoff_delay(attempt, base=DEFAULT_BACKOFF_BASE, maximum=DEFAULT_BACKOFF_MAX):
+    """
+    Exponential backoff with jitter, so that clients that failed at the same time don't retry at the same time
+    :param attempt: Number of retries so far (0 for the first one)
+    :param base: Delay of the first retry, in seconds
+    :param maximum: Maximum delay, in seconds
+    :return: Seconds to wait, between half and all of min(maximum, base * 2 ** attempt)
+    """
+    delay = min(maximum, base * 2 ** min(attempt, 32))
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header, either a number of seconds or an HTTP date
+    :return: Seconds to wait, or None if there's no valid header
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class TokenBucket(object):
+    """
+    Rate limiter shared by all the threads making requests: every request takes a token, and tokens are added at a fixed rate up to the
+    bucket's capacity, which allows short bursts. The bucket can also be paused, e.g. for as long as a Retry-After header says
+    """
+    def __init__(self, rate=None, burst=None):
+        """
+        TokenBucket constructor
+        :param rate: Requests per second. None for no limit (the bucket can still be paused)
+        :param burst: Bucket capacity, i.e. maximum number of requests made at once after being idle. Defaults to rate (at least 1)
+        :return:
+        """
+        self.rate = rate
+        self.capacity = burst or max(1, rate or 1)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.paused_until = 0
+        self.lock = Lock()
+
+    def pause(self, seconds):
+        """
+        Stop handing out tokens for a while
+        :param seconds: Seconds from now
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def acquire(self):
+        """
+        Take a token, waiting until there's one
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency(object):
+    """
+    Concurrency limit that adapts to the server with AIMD (additive increase, multiplicative decrease): workers hold a slot while they
+    work on an item, and report how much they got done when they release it. After every window of as many items as the current limit,
+    the limit grows by one if throughput improved over the previous window. It's cut by decrease_factor (at most once per window) when
+    a request is throttled or fails.
+    """
+    def __init__(self, initial, minimum=1, maximum=None, increase_threshold=DEFAULT_INCREASE_THRESHOLD,
+                 decrease_factor=DEFAULT_DECREASE_FACTOR):
+        """
+        AdaptiveConcurrency constructor
+        :param initial: Initial limit
+        :param minimum: Lowest limit
+        :param maximum: Highest limit. Defaults to initial, i.e. the limit can only go down and back up
+        :param increase_threshold: Ratio between the throughput of a window and the previous one needed for the limit to grow
+        :param decrease_factor: Factor the limit is multiplied by when throttled
+        :return:
+        """
+        self.minimum = max(1, minimum)
+        self.maximum = max(initial, maximum or initial)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.increase_threshold = increase_threshold
+        self.decrease_factor = decrease_factor
+        self.active = 0
+        self.condition = Condition()
+        self.last_throughput = None
+        self.start_window()
+
+    def start_window(self):
+        self.window_start = time.time()
+        self.window_amount = 0
+        self.window_items = 0
+        self.decreased = False
+
+    def acquire(self):
+        """
+        Take a slot, waiting until there's one
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, amount=0):
+        """
+        Give a slot back
+        :param amount: Work done while holding it, in any unit (e.g. bytes downloaded)
+        """
+        with self.condition:
+            self.active -= 1
+            self.window_amount += amount
+            self.window_items += 1
+            if self.window_items >= self.limit:
+                throughput = self.window_amount / max(time.time() - self.window_start, 1e-6)
+                if self.last_throughput is None or throughput >= self.last_throughput * self.increase_threshold:
+                    self.limit = min(self.limit + 1, self.maximum)
+                self.last_throughput = throughput
+                self.start_window()
+            self.condition.notify_all()
+
+    def decrease(self):
+        """
+        Cut the limit after throttling or an error. Workers above the new limit finish their current item first
+        """
+        with self.condition:
+            if self.decreased is True:
+                return
+            limit = max(self.minimum, int(self.limit * self.decrease_factor))
+            if limit < self.limit:
+                logging.warning("Throttled, reducing concurrency from {old} to {new}.\n".format(old=self.limit, new=limit))
+                self.limit = limit
+            self.last_throughput = None
+            self.start_window()
+            self.decreased = True
+
+
+class RequestScheduler(object):
+    """
+    Sends the requests of a PowerTrack instance (or a worker process) through a token bucket, retrying throttled requests after the
+    time given by their Retry-After header (which pauses all the other requests too) and failed ones with exponential backoff. Throttling
+    and errors are reported to an AdaptiveConcurrency, if there's one
+    """
+    def __init__(self, rate=None, burst=None, concurrency=None, max_retries=DEFAULT_MAX_RETRIES, backoff_base=DEFAULT_BACKOFF_BASE,
+                 backoff_max=DEFAULT_BACKOFF_MAX):
+        """
+        RequestScheduler constructor
+        :param rate: Requests per second. None for no limit
+        :param burst: Maximum number of requests made at once after being idle. Defaults to rate
+        :param concurrency: AdaptiveConcurrency of the workers using this scheduler, or None
+        :param max_retries: Number of retries before giving up on a request
+        :param backoff_base: Delay of the first retry, in seconds
+        :param backoff_max: Maximum delay between retries, in seconds
+        :return:
+        """
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+
+    def backoff_delay(self, attempt):
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max)
+
+    def throttled(self):
+        if self.concurrency is not None:
+            self.concurrency.decrease()
+
+    def send(self, request, retry_errors=True):
+        """
+        Send a request, retrying it if it's throttled or fails
+        :param request: Function without arguments that sends the request and returns its response (e.g. a functools.partial of
+                        session.get)
+        :param retry_errors: If True, server errors (5xx) and connection errors are retried as well as throttled requests (429, 503).
+                             Set it to False for requests that are not idempotent
+        :return: Response. It can still be an error response if retries run out (or for status codes that are not retried)
+        """
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                r = request()
+            except (ConnectionError, Timeout) as e:
+                if retry_errors is False or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                logging.warning("Connection error ({error}). Retrying in {delay:.1f}s.\n".format(error=e, delay=delay))
+            else:
+                retryable = r.status_code in (RETRY_STATUS_CODES if retry_errors is True else THROTTLE_STATUS_CODES)
+                if not retryable or attempt >= self.max_retries:
+                    return r
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+                delay = retry_after if retry_after is not None else self.backoff_delay(attempt)
+                if r.status_code in THROTTLE_STATUS_CODES:
+                    self.bucket.pause(delay)
+                logging.warning("{url} returned {status}. Retrying in {delay:.1f}s.\n".format(url=r.url, status=r.status_code, delay=delay))
+                r.close()
+            self.throttled()
+            self.retries += 1
+            time.sleep(delay)
+            attempt += 1
+
+
+def build_scheduler(concurrency=None):
+    """
+    Create a RequestScheduler as set in the [connection] section of the config file
+    :param concurrency: AdaptiveConcurrency of the workers using it, or None
+    :return: RequestScheduler
+    """
+    return RequestScheduler(rate=get_option('connection', 'requests_per_second', None, float),
+                            burst=get_option('connection', 'burst', None, int),
+                            concurrency=concurrency,
+                            max_retries=get_option('connection', 'max_retries', DEFAULT_MAX_RETRIES, int),
+                            backoff_base=get_option('connection', 'backoff_base', DEFAULT_BACKOFF_BASE, float),
+                            backoff_max=get_option('connection', 'backoff_max', DEFAULT_BACKOFF_MAX, float))
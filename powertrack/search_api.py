@@ -2,93 +2,417 @@ import csv
 import logging
 import os
 import sys
+import tempfile
+import time
 import requests
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
-from powertrack.csv_helper import tweet2csv
+from powertrack import json_helper
+from powertrack.checkpoint_helper import SyncState
+from powertrack.config_helper import get_option
+from powertrack.csv_helper import NO_GEOMETRY, RowConverter
+from powertrack.dedup_helper import DuplicateFilter
+from powertrack.metrics_helper import BYTES_DOWNLOADED, CONVERT, DECODE, DOWNLOAD, LINES, PAGE_EVENT, PAGES, RETRIES, ROWS, \
+    ROWS_DROPPED, ROWS_WITHOUT_GEOMETRY, ROWS_WRITTEN, WRITE, ExportStats
+from powertrack.sink_helper import get_extension, open_sink
+
+
+SYNC_STATE_SUFFIX = ".sync.json"  # High-water marks of incremental exports are kept in <output file>.sync.json
+SEARCH_API_DAYS = 30  # How far back the Search API goes
 
 
 class Job(object):
     data_path = None
+    mark = None  # checkpoint_helper.HighWaterMark of an incremental export
 
-    def __init__(self, pt, title, job_data, columns=None):
+    def __init__(self, pt, title, job_data, columns=None, stages=None):
         """
         Job constructor
         :param pt: Powertrack instance
         :param title: Title for the job, used as a file name
         :param job_data: Dictionary with parameters for the GNIP request
         :param columns: Array of columns to be created in CartoDB's table. None for all columns.
+        :param stages: Array of stages that add columns to every row (see csv_helper.RowConverter). None for no extra columns
         :return:
         """
         self.pt = pt
-        self.file_name = os.path.join(pt.folder, "{filename}.csv".format(filename=title))
+        self.file_name = os.path.join(pt.folder, title + get_extension())
         self.request_data = job_data
         self.columns = columns
+        self.converter = RowConverter(columns, stages)
         self.data_path = "search/30day/accounts/{account_name}/{label}.json".format(account_name=pt.account_name, label=pt.label)
         self.count_path = "search/30day/accounts/{account_name}/{label}/counts.json".format(account_name=pt.account_name, label=pt.label)
 
-    def export_tweets(self, append=False):
+    def export_tweets(self, append=False, concurrency=None, stats=None, incremental=False, windows=None):
         """
-        Gets data from GNIP and generates CSV file
-        :param append: whether the rows are to be added to the file in append mode
+        Gets data from GNIP and generates the output file (CSV unless otherwise set in the config file, see sink_helper)
+        :param append: whether the rows are to be added to the file in append mode (CSV only). If the job has a
+                       dedup_helper.DuplicateFilter stage, the tweets already in the file are added to it first, so that they're not
+                       written again
+        :param concurrency: Maximum number of time windows fetched at the same time. Defaults to the search_concurrency option in the config
+                            file, or 1
+        :param stats: ExportStats to collect the metrics of the export in (see metrics_helper). A new one is created if None
+        :param incremental: If True, only the tweets newer than those of the previous incremental export of the same rule are fetched and
+                            appended to the file (see start_sync). The first time, the whole time span is exported. Nothing is appended
+                            until all the new tweets have been fetched, so that a failed export can just be run again
+        :param windows: Number of time windows the job's time span is split into, with about the same number of tweets each (see
+                        split_windows), if greater than 1. Defaults to the search_windows option in the config file, or the concurrency.
+                        Windows are uneven when the tweets are (they're split by day), so more windows than concurrency keeps all the
+                        requests busy until the end
         :return: number of tweets collected
         """
-        next_page = True
+        if concurrency is None:
+            concurrency = get_option('output', 'search_concurrency', 1, int)
+        if windows is None:
+            windows = get_option('output', 'search_windows', concurrency, int)
+        stats = stats if stats is not None else ExportStats()
 
-        count = 0
+        if incremental is True:
+            state, resumed = start_sync([self], self.file_name)
+            append = append or resumed
+
+        sys.stdout.write("Building output file {file_name}.\n".format(file_name=self.file_name))
 
-        sys.stdout.write("Building CSV file {file_name}.\n".format(file_name=self.file_name))
+        sink = open_sink(self.file_name, self.converter.header, append=append)
 
         if append is True:
-            csv_file = open(self.file_name, 'a')
-        else:
-            csv_file = open(self.file_name, 'w')
-        csv_writer = csv.writer(csv_file)
-        if append is False:
-            csv_writer.writerow(tweet2csv(columns=self.columns))  # Header row
+            for stage in self.converter.stages:
+                if isinstance(stage, DuplicateFilter):
+                    stage.seed(self.file_name)
+
+        retries = self.pt.scheduler.retries
+        stats.start()
+        try:
+            if windows > 1:
+                count = self.export_windows(sink, windows, concurrency, stats=stats, atomic=incremental)
+            elif incremental is True:
+                count = append_segments(sink, [self.export_segment(dict(self.request_data), stats=stats)], stats)
+            else:
+                count = self.export_window(dict(self.request_data), sink, stats=stats)
+                stats.add({ROWS_WRITTEN: count})
+        finally:
+            sink.close()
+            stats.add({RETRIES: self.pt.scheduler.retries - retries})  # Throttled or failed requests retried by the scheduler
+            stats.stop()
+
+        if incremental is True:
+            finish_sync([self], state)
+
+        sys.stdout.write("Done. {summary}.\n".format(summary=stats.summary()))
+
+        return count
+
+    @property
+    def sync_key(self):
+        return self.request_data["query"]
+
+    def start_sync(self, state):
+        """
+        Set the job up for an incremental export: its high-water mark is taken from the state, and fromDate is moved forward to the minute
+        of the mark (fromDate has minute precision, so the tweets of that minute that are not newer than the mark are dropped as they come)
+        :param state: checkpoint_helper.SyncState
+        :return: True if the rule had been exported before, so that its new tweets are to be appended
+        """
+        self.mark = state.get_mark(self.sync_key)
+        if self.mark.posted_time is None:
+            return False
+
+        from_date = self.mark.posted_time[:16].replace("-", "").replace("T", "").replace(":", "")  # YYYYMMDDhhmm
+        earliest = (datetime.utcnow() - timedelta(days=SEARCH_API_DAYS)).strftime("%Y%m%d%H%M")
+        if from_date > max(self.request_data.get("fromDate") or "", earliest):
+            self.request_data["fromDate"] = from_date
+        return True
+
+    def export_window(self, request_data, csv_writer, stats=None):
+        """
+        Go through all the result pages of a request and write the tweets to a CSV file or sink. Raises requests.HTTPError if a page can't
+        be fetched (after the scheduler's retries)
+        :param request_data: Dictionary with parameters for the GNIP request. It will be updated with the "next" parameter
+        :param csv_writer: CSV writer, or sink (see sink_helper)
+        :param stats: ExportStats where bytes, rows and the time spent in every stage are added after every page, or None. Rows are not
+                      counted as written, as the caller knows when they reach the output file
+        :return: number of tweets collected
+        """
+        next_page = True
+
+        count = 0
 
         while next_page:
             if next_page is not True:
-                self.request_data.update({"next": next_page})
+                request_data.update({"next": next_page})
 
-            r = self.pt.post(self.data_path, self.request_data)
+            t0 = time.time()
+            r = self.pt.post(self.data_path, request_data)
 
-            if r.status_code != requests.codes.ok:
+            if r.status_code != requests.codes.ok:  # Throttled requests have already been retried (see schedule_helper)
                 try:
                     logging.error(r.json()["error"]["message"])
-                except ValueError:
+                except (KeyError, TypeError, ValueError):
                     logging.error(r.text)
-                next_page = False
-                continue
+                # Rather than leaving the export silently truncated
+                raise requests.HTTPError("Search API request failed with status {status}".format(status=r.status_code), response=r)
 
-            response_data = r.json()
+            t1 = time.time()
+            response_data = json_helper.loads(r.content)
+            t2 = time.time()
+
+            results = response_data["results"]
+            if self.mark is not None:
+                results = self.mark.filter(results)
 
-            for tweet in response_data["results"]:
-                csv_tweet = tweet2csv(tweet, columns=self.columns)
+            rows = without_geometry = 0
+            dropped = len(response_data["results"]) - len(results)  # Already exported
+            write_time = 0.0
+            for csv_tweet, reason in self.converter.convert_batch(results):
                 if csv_tweet is not None:
+                    t = time.time()
                     csv_writer.writerow(csv_tweet)
-                    count += 1
+                    write_time += time.time() - t
+                    rows += 1
+                elif reason == NO_GEOMETRY:
+                    without_geometry += 1
+                else:
+                    dropped += 1
+            count += rows
 
             next_page = response_data["next"] if "next" in response_data else False
 
-        csv_file.close()
+            if stats is not None:
+                stats.add({PAGES: 1, BYTES_DOWNLOADED: len(r.content), LINES: len(response_data["results"]), ROWS: rows,
+                           ROWS_WITHOUT_GEOMETRY: without_geometry, ROWS_DROPPED: dropped},
+                          {DOWNLOAD: t1 - t0, DECODE: t2 - t1, CONVERT: time.time() - t2 - write_time, WRITE: write_time})
+                stats.event(PAGE_EVENT, rows=rows, next=next_page)
 
         return count
 
+    def export_segment(self, request_data, stats=None):
+        """
+        Go through all the result pages of a request and write the tweets to a temporary CSV segment (see export_window)
+        :param request_data: Dictionary with parameters for the GNIP request
+        :param stats: ExportStats where the metrics of every page are added, or None
+        :return: (segment file object, at its start, number of tweets collected) tuple
+        """
+        segment_file = tempfile.TemporaryFile()
+        count = self.export_window(request_data, csv.writer(segment_file), stats=stats)
+        segment_file.seek(0)
+        return segment_file, count
+
+    def export_windows(self, sink, num_windows, concurrency, stats=None, atomic=False):
+        """
+        Split the job into time windows, fetch them concurrently and write their tweets to the output file, newest window first (the same
+        order the Search API would return them in a single request). Windows are written to temporary CSV segments until they're appended
+        :param sink: Sink for the output file (see sink_helper)
+        :param num_windows: Number of windows (see split_windows)
+        :param concurrency: Maximum number of windows fetched at the same time
+        :param stats: ExportStats to collect the metrics of the export in, or None
+        :param atomic: If True, no window is appended until all of them have been fetched, so that a failed export leaves the file as it was
+        :return: number of tweets collected
+        """
+        windows = self.split_windows(num_windows)
+        stats = stats if stats is not None else ExportStats(interval=0)
+
+        def export_to_segment(window):
+            from_date, to_date = window
+            request_data = dict(self.request_data)
+            for param, value in (("fromDate", from_date), ("toDate", to_date)):
+                if value is not None:
+                    request_data[param] = value
+                else:
+                    request_data.pop(param, None)
+
+            return self.export_segment(request_data, stats=stats)
+
+        pool = ThreadPool(max(1, min(concurrency, len(windows))))
+        try:
+            segments = pool.imap(export_to_segment, windows)
+            if atomic is True:
+                segments = list(segments)
+            return append_segments(sink, segments, stats)
+        finally:
+            pool.close()
+
+    def get_counts(self, bucket="day"):
+        """
+        Gets the number of tweets per time bucket from GNIP
+        :param bucket: "day", "hour" or "minute"
+        :return: List of (timePeriod, count) tuples sorted by time, timePeriod being the start of the bucket in the same format as fromDate
+        """
+        request_data = dict((param, value) for param, value in self.request_data.items() if param in ("query", "fromDate", "toDate"))
+        request_data["bucket"] = bucket
+
+        counts = []
+        next_page = True
+
+        while next_page:
+            if next_page is not True:
+                request_data["next"] = next_page
+
+            r = self.pt.post(self.count_path, request_data)
+            r.raise_for_status()
+            response_data = r.json()
+
+            counts.extend((result["timePeriod"][:12], result["count"]) for result in response_data["results"])
+
+            next_page = response_data["next"] if "next" in response_data else False
+
+        return sorted(counts)
+
+    def split_windows(self, num_windows, bucket="day"):
+        """
+        Split the job's time span into windows with about the same number of tweets each, based on the counts per bucket
+        :param num_windows: Maximum number of windows (there can't be more windows than non-empty buckets)
+        :param bucket: Bucket size used for the split, "day", "hour" or "minute"
+        :return: List of (fromDate, toDate) tuples, newest first. The oldest fromDate and the newest toDate are those of the job, which
+                 can be None (i.e. GNIP's defaults)
+        """
+        counts = self.get_counts(bucket)
+        total = sum(count for time_period, count in counts)
+
+        if total == 0:
+            return [(self.request_data.get("fromDate"), self.request_data.get("toDate"))]
+
+        boundaries = []
+        accumulated = 0
+        for time_period, count in counts:
+            if accumulated >= total * (len(boundaries) + 1) / float(num_windows) and len(boundaries) < num_windows - 1:
+                boundaries.append(time_period)
+            accumulated += count
+
+        dates = [self.request_data.get("fromDate")] + boundaries + [self.request_data.get("toDate")]
+        windows = zip(dates[:-1], dates[1:])
+        windows.reverse()
+
+        return windows
+
     def estimate_tweets(self):
         """
         Gets data from GNIP and estimates tweet count for these rules
         """
-        self.request_data["bucket"] = "day"
-        r = self.pt.post(self.count_path, self.request_data)
+        return sum(count for time_period, count in self.get_counts("day"))
+
+
+def append_segment(sink, segment_file, count, stats):
+    """
+    Append a temporary segment file to the output file and close it
+    :param sink: Sink for the output file
+    :param segment_file: Segment file object, at its start
+    :param count: Number of rows in the segment
+    :param stats: ExportStats where rows written and write time are added
+    """
+    t = time.time()
+    sink.write_segment(segment_file)
+    segment_file.close()
+    stats.add({ROWS_WRITTEN: count}, {WRITE: time.time() - t})
+
+
+def append_segments(sink, segments, stats):
+    """
+    Append temporary segment files to the output file, in order, as they come
+    :param sink: Sink for the output file
+    :param segments: Iterable of (segment file object, number of rows) tuples
+    :param stats: ExportStats where rows written and write time are added
+    :return: Number of rows appended
+    """
+    count = 0
+    for segment_file, segment_count in segments:
+        append_segment(sink, segment_file, segment_count, stats)
+        count += segment_count
+    return count
+
+
+def start_sync(jobs, file_name):
+    """
+    Set jobs up for an incremental export into a file, from the high-water marks in its state file (see Job.start_sync). If the output
+    file is gone, the marks are discarded and the jobs start over
+    :param jobs: Jobs to be exported
+    :param file_name: Output file name
+    :return: (checkpoint_helper.SyncState, whether the new tweets are to be appended to the file) tuple
+    """
+    state = SyncState(file_name + SYNC_STATE_SUFFIX)
+    if not os.path.exists(file_name):
+        state.clear()
+
+    resumed = False
+    for job in jobs:
+        resumed = job.start_sync(state) or resumed
+
+    return state, resumed
+
+
+def finish_sync(jobs, state):
+    """
+    Store the jobs' new high-water marks, once all their tweets have been written. As the marks are only stored then, the new tweets must
+    not reach the output file before all of them have been fetched, or a failed export would write them again when it's run again
+    :param jobs: Jobs set up by start_sync
+    :param state: checkpoint_helper.SyncState returned by start_sync
+    """
+    for job in jobs:
+        job.mark.advance()
+        state.set_mark(job.sync_key, job.mark)
+    state.save()
+
+
+def export_jobs(jobs, file_name, concurrency, stats=None, append=False, incremental=False):
+    """
+    Fetch several jobs concurrently and write all their tweets to a single output file, in job order. Jobs are expected to share their
+    columns and stages (the header row is the first job's), and a shared dedup_helper.DuplicateFilter stage keeps tweets matched by
+    several jobs from being written more than once
+    :param jobs: Jobs to be fetched, typically one per rule
+    :param file_name: Output file name. Its format is the one in the config file (see sink_helper)
+    :param concurrency: Number of jobs fetched at the same time
+    :param stats: ExportStats to collect the metrics of the export in (see metrics_helper). A new one is created if None
+    :param append: whether the rows are to be added to the file in append mode (CSV only). A shared DuplicateFilter stage is given the
+                   tweets already in the file first
+    :param incremental: If True, every job only fetches the tweets newer than those of the previous incremental export of its rule, and
+                        they're appended to the file (see start_sync). Rules not exported before are fetched whole. Nothing is appended
+                        until all the jobs have been fetched, so that a failed export can just be run again
+    :return: number of tweets collected
+    """
+    if incremental is True:
+        state, resumed = start_sync(jobs, file_name)
+        append = append or resumed
+
+    sys.stdout.write("Building output file {file_name} from {num_jobs} requests.\n".format(file_name=file_name, num_jobs=len(jobs)))
+    stats = stats if stats is not None else ExportStats()
+
+    def export_to_segment(job):
+        return job.export_segment(dict(job.request_data), stats=stats)
+
+    pool = ThreadPool(concurrency)
+    sink = open_sink(file_name, jobs[0].converter.header, append=append)
+
+    if append is True:
+        for stage in jobs[0].converter.stages:
+            if isinstance(stage, DuplicateFilter):
+                stage.seed(file_name)
+
+    retries = jobs[0].pt.scheduler.retries
+    stats.start()
+    try:
+        segments = pool.imap(export_to_segment, jobs)
+        if incremental is True:
+            segments = list(segments)  # See finish_sync
+        count = append_segments(sink, segments, stats)
+    finally:
+        sink.close()
+        pool.close()
+        stats.add({RETRIES: jobs[0].pt.scheduler.retries - retries})
+        stats.stop()
+
+    if incremental is True:
+        finish_sync(jobs, state)
+
+    sys.stdout.write("Done. {summary}.\n".format(summary=stats.summary()))
 
-        return r.json()["totalResults"]
+    return count
 
 
 class JobManager(object):
     def __init__(self, pt):
         self.pt = pt
 
-    def create(self, start=None, end=None, title="twitter_search_result", rule=None, columns=None):
+    def create(self, start=None, end=None, title="twitter_search_result", rule=None, columns=None, stages=None):
         """
         Create a new job definition
         :param start: Start timestamp, defaults to 30 days ago
@@ -96,6 +420,7 @@ class JobManager(object):
         :param title: Title for the job (file name)
         :param rule: Powertrack rule, up to 2048 chars, including all operators and spaces, with no single term exceeding 128 characters. Will be ANDed with geo-enabled filter, so you need to reserve room for that.
         :param columns: Array of columns to be created in CartoDB's table. None for all columns.
+        :param stages: Array of stages that add columns to every row (see csv_helper.RowConverter). None for no extra columns
         :return:
         """
         query = "({value}) (has:geo)".format(value=rule) if rule is not None else "has:geo"
@@ -111,4 +436,4 @@ class JobManager(object):
         if end is not None:
             data["toDate"] = end.strftime("%Y%m%d%H%M")
 
-        return Job(self.pt, title=title, job_data=data, columns=columns)
+        return Job(self.pt, title=title, job_data=data, columns=columns, stages=stages)
@@ -0,0 +1,335 @@
+import csv
+import os
+import shutil
+from abc import ABCMeta, abstractmethod
+
+from powertrack.aggregate_helper import AGGREGATE_HEADER, COUNT_COLUMN, build_aggregator
+from powertrack.config_helper import get_option
+from powertrack.csv_helper import COLUMNS
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+CSV_FORMAT = "csv"
+PARQUET_FORMAT = "parquet"
+ARROW_FORMAT = "arrow"
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+DEFAULT_RECORD_BATCH_SIZE = 65536
+
+STRING = "string"
+INT = "int"
+BOOL = "bool"
+
+
+def get_output_format():
+    """
+    :return: Output format set in the config file, CSV_FORMAT by default
+    """
+    return get_option('output', 'format', CSV_FORMAT)
+
+
+def get_extension(output_format=None):
+    """
+    :param output_format: CSV_FORMAT, PARQUET_FORMAT or ARROW_FORMAT. None for the one in the config file
+    :return: File name extension for the format, such as ".csv"
+    """
+    return "." + (output_format or get_output_format())
+
+
+def get_column_types(header):
+    """
+    Get the type of every column, based on the default value of its field (see csv_helper.COLUMNS). Fields serialized as JSON (including
+    the_geom) and columns added by stages are strings. Aggregate tables have an integer count column as well
+    :param header: Column names
+    :return: List of STRING, INT or BOOL
+    """
+    types = []
+    for name in header:
+        if name == COUNT_COLUMN:
+            types.append(INT)
+            continue
+        default = COLUMNS[name][2] if name in COLUMNS and COLUMNS[name][3] is False else ""
+        if isinstance(default, bool):
+            types.append(BOOL)
+        elif isinstance(default, (int, long)):
+            types.append(INT)
+        else:
+            types.append(STRING)
+    return types
+
+
+def to_string(value):
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return unicode(value)
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() == "true"  # Rows read back from CSV segments have "True" and "False"
+
+
+CASTS = {STRING: to_string, INT: to_int, BOOL: to_bool}
+
+
+class CSVSink(object):
+    """
+    Writes rows to a CSV file. This is what every export used to do directly with csv.writer
+    """
+    def __init__(self, file_name, header, append=False):
+        """
+        CSVSink constructor. The header row is written right away, unless appending
+        :param file_name: Output file name
+        :param header: Column names
+        :param append: If True, rows are added to an existing file
+        :return:
+        """
+        self.file = open(file_name, 'a' if append is True else 'w', WRITE_BUFFER_SIZE)
+        self.csv_writer = csv.writer(self.file)
+        if append is False:
+            self.csv_writer.writerow(header)
+
+    def writerow(self, row):
+        self.csv_writer.writerow(row)
+
+    def writerows(self, rows):
+        self.csv_writer.writerows(rows)
+
+    def write_segment(self, segment_file):
+        """
+        Add the rows of a CSV segment file (without header), as written by the process engines
+        :param segment_file: Segment file object
+        """
+        shutil.copyfileobj(segment_file, self.file, WRITE_BUFFER_SIZE)
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarSink(object):
+    """
+    Base class for sinks that accumulate rows into typed record batches. Column types come from get_column_types. Subclasses write the
+    batches to their file format
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, file_name, header, append=False, batch_size=DEFAULT_RECORD_BATCH_SIZE):
+        """
+        ColumnarSink constructor
+        :param file_name: Output file name
+        :param header: Column names
+        :param append: Must be False, columnar files cannot be appended to
+        :param batch_size: Number of rows in every record batch
+        :return:
+        """
+        if pyarrow is None:
+            raise ImportError("Columnar output needs pyarrow: pip install python-powertrack[columnar]")
+        if append is True:
+            raise ValueError("Columnar output files cannot be appended to")
+
+        self.file_name = file_name
+        self.header = list(header)
+        self.casts = [CASTS[column_type] for column_type in get_column_types(header)]
+        self.types = [{STRING: pyarrow.string(), INT: pyarrow.int64(), BOOL: pyarrow.bool_()}[column_type]
+                      for column_type in get_column_types(header)]
+        self.schema = pyarrow.schema([pyarrow.field(name, column_type) for name, column_type in zip(self.header, self.types)])
+        self.batch_size = batch_size
+        self.columns = [[] for name in self.header]
+
+    def writerow(self, row):
+        for column, cast, value in zip(self.columns, self.casts, row):
+            column.append(cast(value))
+        if len(self.columns[0]) >= self.batch_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_segment(self, segment_file):
+        """
+        Add the rows of a CSV segment file (without header), as written by the process engines
+        :param segment_file: Segment file object
+        """
+        self.writerows(csv.reader(segment_file))
+
+    def flush(self):
+        """
+        Write the accumulated rows as a record batch
+        """
+        if not self.columns[0]:
+            return
+        batch = pyarrow.RecordBatch.from_arrays([pyarrow.array(column, type=column_type)
+                                                 for column, column_type in zip(self.columns, self.types)], self.header)
+        self.write_batch(batch)
+        self.columns = [[] for name in self.header]
+
+    @abstractmethod
+    def write_batch(self, batch):
+        """
+        Write a record batch to the file
+        :param batch: pyarrow.RecordBatch with the sink's schema
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Flush the remaining rows and close the file
+        """
+
+
+class ParquetSink(ColumnarSink):
+    """
+    Writes rows to a Parquet file, one row group per record batch
+    """
+    def __init__(self, file_name, header, append=False, batch_size=DEFAULT_RECORD_BATCH_SIZE):
+        super(ParquetSink, self).__init__(file_name, header, append=append, batch_size=batch_size)
+        self.writer = pyarrow.parquet.ParquetWriter(file_name, self.schema)
+
+    def write_batch(self, batch):
+        self.writer.write_table(pyarrow.Table.from_batches([batch]))
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ArrowSink(ColumnarSink):
+    """
+    Writes rows to an Arrow IPC (Feather v2) file
+    """
+    def __init__(self, file_name, header, append=False, batch_size=DEFAULT_RECORD_BATCH_SIZE):
+        super(ArrowSink, self).__init__(file_name, header, append=append, batch_size=batch_size)
+        self.file = pyarrow.OSFile(file_name, 'wb')
+        self.writer = pyarrow.RecordBatchFileWriter(self.file, self.schema)
+
+    def write_batch(self, batch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        self.file.close()
+
+
+SINKS = {
+    CSV_FORMAT: CSVSink,
+    PARQUET_FORMAT: ParquetSink,
+    ARROW_FORMAT: ArrowSink,
+}
+
+
+def get_aggregate_file_name(file_name):
+    """
+    :param file_name: Output file name, such as tweets.csv (or tweets.csv.part while it's being built)
+    :return: Aggregate table file name, such as tweets.agg.csv
+    """
+    if file_name.endswith(".part"):
+        file_name = file_name[:-len(".part")]
+    root, extension = os.path.splitext(file_name)
+    return root + ".agg" + extension
+
+
+class AggregateSink(object):
+    """
+    Counts the rows written to it with an aggregate_helper.Aggregator, and writes the aggregate table when it's closed. Rows are passed on
+    to the output file, and the table written next to it (see get_aggregate_file_name), or else the table is written instead of them
+    """
+    def __init__(self, file_name, header, aggregator, output_format, append=False, keep_rows=True):
+        """
+        AggregateSink constructor
+        :param file_name: Output file name
+        :param header: Column names
+        :param aggregator: Aggregator
+        :param output_format: CSV_FORMAT, PARQUET_FORMAT or ARROW_FORMAT, for both the rows and the aggregate table
+        :param append: If True, rows are added to an existing file, and counts to the existing aggregate table (CSV only)
+        :param keep_rows: If False, only the aggregate table is written, to file_name
+        :return:
+        """
+        if append is True and output_format != CSV_FORMAT:
+            raise ValueError("Columnar output files cannot be appended to")
+
+        self.sink = SINKS[output_format](file_name, header, append=append) if keep_rows is True else None
+        self.table_class = SINKS[output_format]
+        self.table_file_name = get_aggregate_file_name(file_name) if keep_rows is True else file_name
+        self.aggregator = aggregator
+        self.indexes = aggregator.indexes(header)
+        self.skipped = 0
+
+        if append is True and os.path.exists(self.table_file_name):
+            with open(self.table_file_name) as table_file:
+                csv_reader = csv.reader(table_file)
+                next(csv_reader, None)
+                aggregator.seed(csv_reader)
+
+    def writerow(self, row):
+        self.skipped += self.aggregator.add_rows((row,), self.indexes)
+        if self.sink is not None:
+            self.sink.writerow(row)
+
+    def writerows(self, rows):
+        """
+        :param rows: List of rows
+        """
+        self.skipped += self.aggregator.add_rows(rows, self.indexes)
+        if self.sink is not None:
+            self.sink.writerows(rows)
+
+    def write_segment(self, segment_file):
+        """
+        Count the rows of a CSV segment file (without header), and add them to the output file
+        :param segment_file: Segment file object, which must be seekable
+        """
+        position = segment_file.tell()
+        self.skipped += self.aggregator.add_rows(csv.reader(segment_file), self.indexes)
+        if self.sink is not None:
+            segment_file.seek(position)
+            self.sink.write_segment(segment_file)
+
+    def close(self):
+        if self.sink is not None:
+            self.sink.close()
+        table = self.table_class(self.table_file_name, AGGREGATE_HEADER)
+        try:
+            table.writerows(self.aggregator.get_rows())
+        finally:
+            table.close()
+
+
+def open_sink(file_name, header, output_format=None, append=False):
+    """
+    Create the sink for an output file. If the [aggregate] section of the config file sets a grid, rows are aggregated as well (see
+    AggregateSink)
+    :param file_name: Output file name
+    :param header: Column names
+    :param output_format: CSV_FORMAT, PARQUET_FORMAT or ARROW_FORMAT. None for the one in the config file
+    :param append: If True, rows are added to an existing file (CSV only)
+    :return: Sink, with writerow, writerows, write_segment and close methods
+    """
+    output_format = output_format or get_output_format()
+    try:
+        sink_class = SINKS[output_format]
+    except KeyError:
+        raise ValueError("Unknown output format: {output_format}".format(output_format=output_format))
+
+    aggregator = build_aggregator()
+    if aggregator is not None:
+        return AggregateSink(file_name, header, aggregator, output_format, append=append,
+                             keep_rows=get_option('aggregate', 'rows', True, bool))
+
+    return sink_class(file_name, header, append=append)
@@ -24,6 +24,12 @@ setup(
     install_requires=[
         'requests',
     ],
+    extras_require={
+        'fastjson': ['ujson'],
+        'async': ['tornado'],
+        'columnar': ['pyarrow'],
+        'fastgeo': ['numpy'],
+    },
     include_package_data=True,
     license='MIT',
     description="Access GNIP's Powertrack APIs in Python.",
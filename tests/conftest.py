@@ -0,0 +1,58 @@
+import pytest
+
+from benchmarks.gnip_server import ACCOUNT_NAME, LABEL, GnipStandIn
+from powertrack.config_helper import config
+
+
+@pytest.fixture
+def settings():
+    """
+    Override options of the config file for a test. The config file's own options are restored afterwards
+    :return: Function that takes a section name and its options as keyword arguments
+    """
+    saved = dict((section, config.items(section)) for section in config.sections())
+
+    def set_options(section, **options):
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options.items():
+            config.set(section, option, str(value))
+
+    yield set_options
+
+    for section in config.sections():
+        config.remove_section(section)
+    for section, items in saved.items():
+        config.add_section(section)
+        for option, value in items:
+            config.set(section, option, value)
+
+
+@pytest.fixture(scope="module")
+def gnip(tmpdir_factory):
+    """
+    GNIP stand-in (see benchmarks.gnip_server) with a delivered Historical API job of a few data files, and Search API results
+    """
+    stand_in = GnipStandIn(str(tmpdir_factory.mktemp("gnip")), num_files=4, tweets_per_file=300, search_tweets=1500).start()
+    yield stand_in
+    stand_in.stop()
+
+
+@pytest.fixture
+def powertrack(gnip, settings, tmpdir):
+    """
+    :return: Function that creates a PowerTrack instance for an API, connected to the GNIP stand-in and writing to a temporary folder
+    """
+    settings("credentials", account_name=ACCOUNT_NAME, username="test", password="test", label=LABEL)
+    settings("output", folder=str(tmpdir), num_threads=3, num_processes=2, format="csv")
+    settings("connection", backoff_base=0.01, backoff_max=0.05)
+    config.remove_section("cache")
+
+    def create(api):
+        from powertrack.api import PowerTrack
+
+        pt = PowerTrack(api=api)
+        pt.powertrack_root_url = gnip.url + "/"
+        return pt
+
+    return create
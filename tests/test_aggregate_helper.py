@@ -0,0 +1,41 @@
+import csv
+import json
+from StringIO import StringIO
+
+import pytest
+
+from benchmarks.synthetic import make_lines
+from powertrack import aggregate_helper
+from powertrack.aggregate_helper import LATLON, QUADKEY, Aggregator
+from powertrack.csv_helper import RowConverter
+from powertrack.geometry_helper import EWKB, GEOJSON
+
+
+def convert(geometry_format):
+    converter = RowConverter(geometry_format=geometry_format)
+    rows = [row for row, reason in converter.convert_batch([json.loads(line) for line in make_lines(1000)]) if row is not None]
+    return converter.header, rows
+
+
+def to_segment(rows):
+    segment_file = StringIO()
+    csv.writer(segment_file).writerows(rows)
+    segment_file.seek(0)
+    return segment_file
+
+
+@pytest.mark.parametrize("geometry_format", [GEOJSON, EWKB])
+@pytest.mark.parametrize("grid", [QUADKEY, LATLON])
+def test_converted_rows_are_not_parsed_back(monkeypatch, geometry_format, grid):
+    header, rows = convert(geometry_format)
+    from_segment = Aggregator(grid=grid, zoom=6, geometry_format=geometry_format)
+    assert from_segment.add_rows(csv.reader(to_segment(rows)), from_segment.indexes(header)) == 0
+
+    def no_parsing(the_geom):
+        raise AssertionError("the_geom parsed back")
+    monkeypatch.setattr(aggregate_helper, "parse_point", no_parsing)
+    from_converter = Aggregator(grid=grid, zoom=6, geometry_format=geometry_format)
+    assert from_converter.add_rows(rows, from_converter.indexes(header)) == 0
+
+    assert from_converter.get_rows() == from_segment.get_rows()
+    assert sum(row[-1] for row in from_converter.get_rows()) == len(rows)
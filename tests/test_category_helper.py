@@ -0,0 +1,119 @@
+import csv
+import os
+import random
+from datetime import datetime
+from threading import Event, Thread, current_thread
+
+import pytest
+
+from powertrack import category_helper
+from powertrack.api import SEARCH_API
+from powertrack.category_helper import HISTORICAL_API_GEO_RULE, HISTORICAL_API_MAX_POSITIVE_CLAUSES, HISTORICAL_API_MAX_RULE_LENGTH, \
+    SEARCH_API_GEO_RULE, SEARCH_API_MAX_POSITIVE_CLAUSES, SEARCH_API_MAX_RULE_LENGTH, Job, TermMatcher, count_positive_clauses, \
+    pack_rules
+
+
+def naive_find(terms, text):
+    values = [value for term, value in terms if term in text]
+    return min(values) if values else None
+
+
+def test_term_matcher_matches_substring_search():
+    rnd = random.Random(0)
+    alphabet = u"abc #@"
+    terms = [(u"".join(rnd.choice(alphabet) for i in range(rnd.randint(1, 4))), value) for value in range(40)]
+    matcher = TermMatcher(terms)
+
+    for i in range(2000):
+        text = u"".join(rnd.choice(alphabet) for j in range(rnd.randint(0, 30)))
+        assert matcher.find(text) == naive_find(terms, text)
+
+
+def test_find_category_takes_the_first_category():
+    job = Job("test")
+    job.create_category("lakers", ["#lakers", "randle"])
+    job.create_category("celtics", ["#celtics", "ainge"])
+
+    assert job.find_category(u"Ainge and RANDLE") == ("1", "lakers")
+    assert job.find_category(u"ainge") == ("2", "celtics")
+    assert job.find_category(u"nothing") == ("", "")
+    assert job.find_category(u"", {"hashtags": [{"text": u"Celtics"}]}) == ("2", "celtics")
+
+
+class PausingTerms(list):
+    """
+    Category terms that make the given thread wait for an event whenever it goes through them
+    """
+    def __init__(self, terms, thread_name, signal, event):
+        super(PausingTerms, self).__init__(terms)
+        self.thread_name = thread_name
+        self.signal = signal
+        self.event = event
+
+    def __iter__(self):
+        if current_thread().name == self.thread_name:
+            self.signal.set()
+            self.event.wait(5)
+        return super(PausingTerms, self).__iter__()
+
+
+def test_find_category_while_another_thread_builds_the_matcher():
+    first_halfway, second_started, first_done = Event(), Event(), Event()
+    job = Job("test")
+    job.create_category("lakers", PausingTerms(["#lakers"], "second", second_started, first_done))
+    job.create_category("celtics", PausingTerms(["#celtics"], "first", first_halfway, second_started))
+    found = []
+
+    def find_first():
+        found.append(job.find_category(u"", {"hashtags": [{"text": u"Lakers"}]}))
+        first_done.set()
+
+    first = Thread(target=find_first, name="first")
+    second = Thread(target=job.find_category, args=(u"",), name="second")
+    first.start()
+    first_halfway.wait(5)  # The first thread has gone through the lakers terms, and waits for the second one to start building
+    second.start()
+    first.join()
+    second.join()
+
+    assert found == [("1", "lakers")]
+
+
+@pytest.mark.parametrize("dedup", ["packed", "none"])
+def test_tweets_matched_by_several_rules_are_written_once(gnip, powertrack, settings, monkeypatch, dedup):
+    settings("output", dedup=dedup)
+    monkeypatch.setattr(category_helper, "PowerTrack", powertrack)
+    job = Job("overlapping")
+    job.create_category("terms", ["term{i}".format(i=i) for i in range(SEARCH_API_MAX_POSITIVE_CLAUSES * 2)])
+    assert len(job.get_ruleset(SEARCH_API)) > 1
+
+    job.run(datetime(2016, 6, 1))  # Every rule gets the same tweets from the GNIP stand-in
+
+    with open(os.path.join(powertrack(SEARCH_API).folder, "overlapping.csv")) as csv_file:
+        rows = list(csv.reader(csv_file))[1:]
+    assert len(rows) == len(set(tuple(row) for row in rows)) > 0
+
+
+@pytest.mark.parametrize("max_length,max_clauses,geo_rule", [
+    (SEARCH_API_MAX_RULE_LENGTH, SEARCH_API_MAX_POSITIVE_CLAUSES, SEARCH_API_GEO_RULE),
+    (HISTORICAL_API_MAX_RULE_LENGTH, HISTORICAL_API_MAX_POSITIVE_CLAUSES, HISTORICAL_API_GEO_RULE),
+])
+def test_packed_rules_fit_the_limits(max_length, max_clauses, geo_rule):
+    rnd = random.Random(0)
+    terms = ["term{i}".format(i=i) for i in range(200)] + ['"a phrase {i}"'.format(i=i) for i in range(20)] + \
+            ["#{word}".format(word="x" * rnd.randint(10, 120)) for i in range(60)] + ["(big OR bigger OR biggest)", "term0"]
+
+    rules = pack_rules(terms, max_length, max_clauses, geo_rule)
+
+    for rule in rules:
+        assert len(geo_rule.format(rule=rule)) <= max_length
+        assert count_positive_clauses(geo_rule.format(rule=rule)) <= max_clauses
+    packed_terms = [term for rule in rules for term in rule.split(" OR ") if term]
+    assert sorted(packed_terms) == sorted(set(terms) - {"(big OR bigger OR biggest)"} | {"(big", "bigger", "biggest)"})
+
+
+def test_wrapper_takes_only_its_own_clauses():
+    terms = ["term{i}".format(i=i) for i in range(SEARCH_API_MAX_POSITIVE_CLAUSES - 1)]
+
+    assert len(pack_rules(terms, SEARCH_API_MAX_RULE_LENGTH, SEARCH_API_MAX_POSITIVE_CLAUSES, SEARCH_API_GEO_RULE)) == 1
+    assert len(pack_rules(terms[:-1], HISTORICAL_API_MAX_RULE_LENGTH, HISTORICAL_API_MAX_POSITIVE_CLAUSES, HISTORICAL_API_GEO_RULE)) == 1
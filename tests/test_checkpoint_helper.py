@@ -0,0 +1,73 @@
+import csv
+import os
+
+from powertrack.checkpoint_helper import HighWaterMark, Manifest, SyncState
+
+
+HEADER = ["the_geom", "postedtime"]
+
+
+def write_segment(manifest, url, rows):
+    with open(manifest.segment_file_name(url, partial=True), "w") as segment_file:
+        csv.writer(segment_file).writerows(rows)
+    manifest.commit(url, len(rows))
+
+
+def test_manifest_resume(tmpdir):
+    folder = str(tmpdir.join("export.csv.parts"))
+    file_name = str(tmpdir.join("export.csv"))
+    urls = ["https://example.com/{i}.json.gz?signature=a".format(i=i) for i in range(3)]
+
+    manifest = Manifest(folder, HEADER)
+    write_segment(manifest, urls[0], [["a", "1"]])
+    write_segment(manifest, urls[2], [["c", "3"]])
+    open(manifest.segment_file_name(urls[1], partial=True), "w").close()  # Interrupted
+
+    # New signatures, same data files
+    urls = [url.replace("signature=a", "signature=b") for url in urls]
+    manifest = Manifest(folder, HEADER)
+    assert [manifest.is_done(url) for url in urls] == [True, False, True]
+    assert manifest.merge(file_name, urls, output_format="csv") == [urls[1]]
+
+    write_segment(manifest, urls[1], [["b", "2"]])
+    assert manifest.merge(file_name, urls, output_format="csv") == []
+    with open(file_name) as csv_file:
+        assert list(csv.reader(csv_file)) == [HEADER, ["a", "1"], ["b", "2"], ["c", "3"]]
+
+    manifest.remove()
+    assert not os.path.exists(folder)
+
+
+def test_manifest_with_another_header_starts_over(tmpdir):
+    folder = str(tmpdir.join("export.csv.parts"))
+    write_segment(Manifest(folder, HEADER), "https://example.com/0.json.gz", [["a", "1"]])
+
+    assert not Manifest(folder, HEADER + ["body"]).is_done("https://example.com/0.json.gz")
+
+
+def tweet(i, posted_time="2016-06-01T00:00:00.000Z"):
+    return {"id": "tag:search.twitter.com,2005:{i}".format(i=i), "postedTime": posted_time}
+
+
+def test_high_water_mark_round_trip(tmpdir):
+    state = SyncState(str(tmpdir.join("export.csv.sync.json")))
+    mark = state.get_mark("rule")
+    assert mark.posted_time is None
+
+    assert mark.filter([tweet(3), tweet(1), tweet(2)]) == [tweet(3), tweet(1), tweet(2)]
+    mark.advance()
+    state.set_mark("rule", mark)
+    state.save()
+
+    mark = SyncState(str(tmpdir.join("export.csv.sync.json"))).get_mark("rule")
+    assert (mark.posted_time, mark.activity_id) == ("2016-06-01T00:00:00.000Z", tweet(3)["id"])
+    newer = tweet(1, "2016-06-01T00:00:01.000Z")
+    assert mark.filter([newer, tweet(4), tweet(3), tweet(2)]) == [newer, tweet(4)]
+
+
+def test_high_water_mark_only_advances():
+    mark = HighWaterMark("2016-06-02T00:00:00.000Z", tweet(5)["id"])
+
+    assert mark.filter([tweet(9)]) == []
+    mark.advance()
+    assert mark.posted_time == "2016-06-02T00:00:00.000Z"
@@ -0,0 +1,35 @@
+import csv
+import json
+from StringIO import StringIO
+
+from benchmarks.bench_tweet2csv import legacy_tweet2csv
+from benchmarks.synthetic import GEO_VARIANTS, make_lines, make_tweet
+from powertrack.csv_helper import RowConverter, tweet2csv
+
+
+def to_csv(rows):
+    output = StringIO()
+    csv.writer(output).writerows(rows)
+    return output.getvalue()
+
+
+def test_tweet2csv_matches_baseline():
+    lines = list(make_lines(2000))
+
+    assert tweet2csv() == legacy_tweet2csv()
+    assert to_csv(tweet2csv(json.loads(line)) or [] for line in lines) == \
+        to_csv(legacy_tweet2csv(json.loads(line)) or [] for line in lines)
+
+
+def test_convert_batch_matches_convert():
+    lines = list(make_lines(500))
+    converter = RowConverter()
+
+    rows = [converter.convert(json.loads(line)) for line in lines]
+    assert [row for row, reason in converter.convert_batch([json.loads(line) for line in lines])] == rows
+
+
+def test_tweets_without_geometry_are_dropped():
+    tweet = make_tweet(0, geo_variant=GEO_VARIANTS[-1])
+
+    assert tweet2csv(tweet) is None
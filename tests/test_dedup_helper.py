@@ -0,0 +1,46 @@
+import random
+
+from powertrack.dedup_helper import BloomFilter, DuplicateFilter, PackedIdSet, get_duplicate_filter, tweet_id
+
+
+def test_packed_id_set_membership():
+    rnd = random.Random(0)
+    items = [rnd.randint(0, 2 ** 63 - 1) for i in range(5000)]
+    ids = PackedIdSet(num_buckets=101)
+
+    for item in items + items[:100]:
+        ids.add(item)
+
+    assert len(ids) == len(set(items))
+    assert all(item in ids for item in items)
+    assert not any(rnd.randint(0, 2 ** 63 - 1) in ids for i in range(5000))
+
+
+def test_bloom_filter_membership():
+    rnd = random.Random(0)
+    items = [rnd.randint(0, 2 ** 63 - 1) for i in range(10000)]
+    ids = BloomFilter(capacity=10000, error_rate=0.01)
+
+    for item in items:
+        ids.add(item)
+
+    assert all(item in ids for item in items)  # No false negatives
+    false_positives = sum(1 for i in range(10000) if rnd.randint(0, 2 ** 63 - 1) in ids)
+    assert false_positives < 300
+
+
+def test_duplicate_filter():
+    dedup = DuplicateFilter()
+    tweet = {"id": "tag:search.twitter.com,2005:123"}
+
+    assert dedup.process(tweet) == []
+    assert dedup.process(tweet) is None
+    assert tweet_id("http://twitter.com/user/statuses/123") in dedup.seen
+
+
+def test_bloom_filter_is_sized_from_the_config(settings):
+    settings("output", dedup="bloom")
+    assert get_duplicate_filter().seen.memory_size() < 16 * 1024 * 1024  # The default doesn't take hundreds of MB up front
+
+    settings("output", dedup_capacity=1000, dedup_error_rate=0.01)
+    assert get_duplicate_filter().seen.memory_size() == BloomFilter(capacity=1000, error_rate=0.01).memory_size()
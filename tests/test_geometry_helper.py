@@ -0,0 +1,39 @@
+import copy
+import random
+
+import pytest
+
+from powertrack.geometry_helper import MIN_VECTORIZED, bbox_centroid, bbox_centroids, get_point, get_points
+
+
+def make_ring(rnd, integer):
+    coordinate = rnd.randint if integer is True else rnd.uniform
+    return [[coordinate(-180, 180), coordinate(-85, 85)] for i in range(rnd.randint(4, 6))]
+
+
+def make_tweet(rnd, integer):
+    return {"location": {"geo": {"type": "Polygon", "coordinates": [make_ring(rnd, integer)]}}}
+
+
+@pytest.mark.parametrize("integer", [True, False])
+def test_vectorized_centroids_match_pure_ones(integer):
+    pytest.importorskip("numpy")
+    rnd = random.Random(0)
+    rings = [make_ring(rnd, integer) for i in range(2 * MIN_VECTORIZED)]
+
+    centroids = bbox_centroids(rings)
+
+    assert centroids == [bbox_centroid(ring) for ring in rings]
+    assert all(isinstance(value, float) for centroid in centroids for value in centroid)
+
+
+def test_odd_integer_bounding_boxes_keep_their_center():
+    assert bbox_centroid([[0, 0], [1, 1], [1, 0]]) == [0.5, 0.5]
+
+
+@pytest.mark.parametrize("num_tweets", [MIN_VECTORIZED - 1, 2 * MIN_VECTORIZED])
+def test_batch_points_match_single_ones(num_tweets):
+    rnd = random.Random(1)
+    tweets = [make_tweet(rnd, integer=i % 2 == 0) for i in range(num_tweets)]
+
+    assert get_points(copy.deepcopy(tweets)) == [get_point(tweet) for tweet in copy.deepcopy(tweets)]
@@ -0,0 +1,131 @@
+import csv
+import gzip
+import json
+import os
+from StringIO import StringIO
+from threading import Thread
+
+import pytest
+
+from benchmarks.gnip_server import JOB_TITLE, JOB_UUID
+from powertrack import historical_api
+from powertrack.api import HISTORICAL_API
+from powertrack.csv_helper import RowConverter
+from powertrack.historical_api import Job, build_csv_file
+from powertrack.metrics_helper import DATA_FILES, DATA_FILES_FAILED, ExportStats
+from powertrack.schedule_helper import build_scheduler
+
+
+def expected_csv(gnip):
+    """
+    :return: CSV file the stand-in's job should be exported to, converting its data files one by one, in order
+    """
+    converter = RowConverter()
+    output = StringIO()
+    csv_writer = csv.writer(output)
+    csv_writer.writerow(converter.header)
+    for name in gnip.data_file_names:
+        for line in gzip.open(os.path.join(gnip.folder, name)):
+            row = converter.convert(json.loads(line))
+            if row is not None:
+                csv_writer.writerow(row)
+    return output.getvalue()
+
+
+def export(pt, **options):
+    job = pt.jobs.get()[0]
+    job.export_tweets(**options)
+    with open(os.path.join(pt.folder, job.title + ".csv")) as csv_file:
+        return csv_file.read()
+
+
+@pytest.mark.parametrize("engine", ["threads", "processes", "async"])
+@pytest.mark.parametrize("resume", [False, True])
+def test_engines_write_the_same_csv(gnip, powertrack, settings, engine, resume):
+    settings("output", engine=engine)
+    expected = expected_csv(gnip)
+
+    output = export(powertrack(HISTORICAL_API), resume=resume)
+
+    if engine == "threads" and resume is False:  # Data files are written as they're converted
+        assert sorted(output.splitlines()) == sorted(expected.splitlines())
+    else:
+        assert output == expected
+
+
+@pytest.mark.parametrize("engine", ["threads", "processes", "async"])
+def test_unreachable_data_files_fail(gnip, powertrack, settings, tmpdir, engine):
+    settings("connection", max_retries=1)
+    url = gnip.url + "/data/" + gnip.data_file_names[0]
+    unreachable_url = "http://127.0.0.1:1/data/00000.json.gz"  # Connection refused
+    stats = ExportStats(interval=0)
+
+    build_csv_file([url, unreachable_url], str(tmpdir.join("export.csv")), 2, engine=engine, stats=stats,
+                   scheduler=build_scheduler() if engine == "threads" else None)
+
+    assert stats.counters[DATA_FILES] == 1
+    assert stats.counters[DATA_FILES_FAILED] == 1
+
+
+def test_exports_in_a_row_share_the_concurrency(gnip, powertrack, settings):
+    settings("output", engine="threads")
+    pt = powertrack(HISTORICAL_API)
+    outputs = []
+    exports = Thread(target=lambda: outputs.extend(export(pt) for i in range(2)))
+    exports.daemon = True
+
+    exports.start()
+    exports.join(60)
+
+    assert not exports.is_alive(), "Second export waiting on the first one's download threads"
+    assert len(outputs) == 2 and outputs[0] and sorted(outputs[0].splitlines()) == sorted(outputs[1].splitlines())
+    assert pt.concurrency.active == 0
+
+
+def test_exports_are_not_checkpointed_by_default(gnip, powertrack, monkeypatch):
+    def no_manifest(*args, **kwargs):
+        raise AssertionError("Segments written without resume")
+    monkeypatch.setattr(historical_api, "Manifest", no_manifest)
+
+    assert sorted(export(powertrack(HISTORICAL_API)).splitlines()) == sorted(expected_csv(gnip).splitlines())
+
+
+@pytest.mark.parametrize("export_concurrency", [1, 2])
+def test_watcher_exports_delivered_jobs(gnip, powertrack, settings, monkeypatch, export_concurrency):
+    settings("output", engine="threads")
+    pt = powertrack(HISTORICAL_API)
+    job_data = pt.jobs.list_job_data()[0]
+    listing = [job_data, dict(job_data, title="second", jobURL=job_data["jobURL"].replace(JOB_UUID + ".json", "second.json"))]
+    monkeypatch.setattr(pt.jobs, "list_job_data", lambda: listing)
+    jobs = [Job(pt, job_data=dict(data, status="running")) for data in listing]
+    changes = []
+
+    watcher = pt.jobs.watch(jobs=jobs, interval=0.01, export_concurrency=export_concurrency, callback=lambda job: changes.append(job.uuid))
+    watcher.join(60)
+
+    assert not watcher.is_alive()
+    assert watcher.results() == {JOB_UUID: True, "second": True}
+    assert sorted(changes) == [JOB_UUID, "second"]
+    expected = sorted(expected_csv(gnip).splitlines())
+    for title in (JOB_TITLE, "second"):
+        with open(os.path.join(pt.folder, title + ".csv")) as csv_file:
+            assert sorted(csv_file.read().splitlines()) == expected
+
+
+def test_job_info_is_cached_for_its_ttl(powertrack, monkeypatch):
+    pt = powertrack(HISTORICAL_API)
+    job = Job(pt, job_data=pt.jobs.list_job_data()[0], ttl=30)
+    requests = []
+    get = pt.get
+    monkeypatch.setattr(pt, "get", lambda *args, **kwargs: requests.append(args) or get(*args, **kwargs))
+
+    assert job.status == "delivered" and job.status_message
+    assert job.refresh() is False
+    assert requests == []
+
+    job.updated_at -= 30
+    assert job.status == "delivered"
+    assert len(requests) == 1
+
+    assert job.refresh(ttl=0) is True
+    assert len(requests) == 2
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from powertrack import json_helper
+
+
+DOCUMENTS = [
+    '{"id": "tag:search.twitter.com,2005:1234567890123456789", "body": "caf\\u00e9 \\ud83d\\ude00 \\u2603", '
+    '"geo": {"type": "Point", "coordinates": [40.416775, -3.70379]}, "retweetCount": 0, "favoritesCount": 12}',
+    '{"coordinates": [0.1, 1e-07, -179.99999999999997, 1.7976931348623157e308]}',
+    '"\\ud800"',  # Lone high surrogate
+    '"\\udc00 and \\ud800\\udc00"',  # Lone low surrogate, then a pair
+    '123456789012345678901',
+    '18446744073709551616',
+    '-9223372036854775809',
+    '[9223372036854775807, -9223372036854775808, 18446744073709551615]',
+    '{"a": NaN, "b": Infinity, "c": -Infinity}',
+    '"\\\\ud800"',  # Escaped backslash, not a surrogate
+]
+
+
+@pytest.mark.parametrize("name", json_helper.BACKENDS)
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_backends_decode_like_the_standard_library(name, document):
+    try:
+        loads = json_helper._get_loads(name)
+    except ImportError:
+        pytest.skip("{name} is not installed".format(name=name))
+
+    expected = json.loads(document)
+    decoded = loads(document)
+
+    assert repr(decoded) == repr(expected)  # repr, so that NaN compares equal and int and float don't
+
+
+@pytest.mark.parametrize("name", json_helper.BACKENDS)
+def test_backends_reject_invalid_documents(name):
+    try:
+        loads = json_helper._get_loads(name)
+    except ImportError:
+        pytest.skip("{name} is not installed".format(name=name))
+
+    with pytest.raises(ValueError):
+        loads('{"id": 1')
@@ -0,0 +1,43 @@
+import math
+import random
+
+from powertrack.region_helper import Polygon, RegionIndex
+
+
+def random_region(rnd, size):
+    """
+    :return: Star-shaped polygon, sometimes with a hole, as a list of rings
+    """
+    x, y = rnd.uniform(-170, 170), rnd.uniform(-80, 80)
+    num_points = rnd.randint(3, 12)
+    ring = []
+    for i in range(num_points):
+        angle = 2 * math.pi * i / num_points
+        radius = rnd.uniform(0.3, 1.0) * size
+        ring.append((x + radius * math.cos(angle), y + radius * math.sin(angle)))
+    rings = [ring]
+    if rnd.random() < 0.3:
+        hole = size * 0.1
+        rings.append([(x - hole, y - hole), (x + hole, y - hole), (x + hole, y + hole), (x - hole, y + hole)])
+    return rings
+
+
+def test_region_index_matches_brute_force():
+    rnd = random.Random(0)
+    regions = [(str(i), random_region(rnd, rnd.choice((0.5, 2, 30)))) for i in range(300)]
+    polygons = [Polygon(rings) for region_id, rings in regions]
+    index = RegionIndex(regions, max_region_cells=64)
+    assert index.large  # Some regions are kept out of the grid
+
+    for i in range(20000):
+        lon, lat = rnd.uniform(-180, 180), rnd.uniform(-90, 90)
+        expected = next((regions[j][0] for j, polygon in enumerate(polygons) if polygon.contains(lon, lat)), None)
+        assert index.find(lon, lat) == expected
+
+
+def test_polygon_with_hole():
+    square = Polygon([[(0, 0), (10, 0), (10, 10), (0, 10)], [(4, 4), (6, 4), (6, 6), (4, 6)]])
+
+    assert square.contains(1, 1)
+    assert not square.contains(5, 5)
+    assert not square.contains(11, 5)
@@ -0,0 +1,108 @@
+import csv
+import time
+from datetime import datetime
+from threading import Lock
+
+import pytest
+import requests
+
+from powertrack.api import SEARCH_API
+from powertrack.search_api import export_jobs
+
+
+def read_rows(file_name):
+    with open(file_name) as csv_file:
+        return list(csv.reader(csv_file))
+
+
+def test_split_windows(gnip, powertrack):
+    job = powertrack(SEARCH_API).jobs.create(title="windows")
+    counts = job.get_counts("day")
+    total = sum(count for time_period, count in counts)
+
+    windows = job.split_windows(4)
+
+    assert len(windows) == 4
+    assert windows[0][1] is None and windows[-1][0] is None  # The job's own (default) time span
+    assert all(newer[0] == older[1] for newer, older in zip(windows[:-1], windows[1:]))  # Contiguous, newest first
+    window_counts = [len(gnip.select(dict((param, value) for param, value in (("fromDate", from_date), ("toDate", to_date)) if value)))
+                     for from_date, to_date in windows]
+    assert sum(window_counts) == total
+    assert max(window_counts) <= total / 4 + max(count for time_period, count in counts)  # Balanced up to a bucket
+
+
+@pytest.mark.parametrize("concurrency,windows", [(2, None), (4, None), (2, 6), (1, 3)])
+def test_windows_match_a_sequential_export(powertrack, concurrency, windows):
+    pt = powertrack(SEARCH_API)
+    sequential = pt.jobs.create(title="sequential")
+    windowed = pt.jobs.create(title="windowed")
+    post = pt.post
+    lock = Lock()
+    in_flight = [0, 0]  # Data requests being sent, most at the same time
+
+    def count_in_flight(path, data, **kwargs):
+        if path != windowed.data_path:
+            return post(path, data, **kwargs)
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        try:
+            time.sleep(0.01)
+            return post(path, data, **kwargs)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    count = sequential.export_tweets()
+    pt.post = count_in_flight
+
+    assert windowed.export_tweets(concurrency=concurrency, windows=windows) == count
+    assert read_rows(windowed.file_name) == read_rows(sequential.file_name)
+    assert in_flight[1] <= concurrency
+
+
+def test_failed_requests_raise(powertrack, settings):
+    settings("connection", max_retries=0)
+    job = powertrack(SEARCH_API).jobs.create(title="failed")
+    job.data_path = "search/30day/accounts/unknown/unknown.json"
+
+    with pytest.raises(requests.HTTPError):
+        job.export_tweets()
+
+
+def export_incrementally(job, concurrency):
+    if concurrency is None:
+        return export_jobs([job], job.file_name, 1, incremental=True)
+    return job.export_tweets(concurrency=concurrency, incremental=True)
+
+
+@pytest.mark.parametrize("concurrency", [1, 3, None])  # None for export_jobs
+def test_failed_incremental_exports_can_be_run_again(powertrack, settings, concurrency):
+    settings("connection", max_retries=0)
+    pt = powertrack(SEARCH_API)
+    complete = pt.jobs.create(title="complete")
+    complete.export_tweets()
+
+    export_incrementally(pt.jobs.create(end=datetime(2016, 6, 15), title="incremental"), concurrency)
+
+    job = pt.jobs.create(title="incremental")
+    post = pt.post
+    data_requests = []
+
+    def fail_second_page(path, data, **kwargs):
+        if path == job.data_path:
+            data_requests.append(data)
+            if len(data_requests) == 2:
+                path = "search/30day/accounts/unknown/unknown.json"
+        return post(path, data, **kwargs)
+
+    pt.post = fail_second_page
+    with pytest.raises(requests.HTTPError):
+        export_incrementally(job, concurrency)
+    pt.post = post
+
+    export_incrementally(pt.jobs.create(title="incremental"), concurrency)
+
+    rows = read_rows(job.file_name)
+    assert rows[0] == read_rows(complete.file_name)[0]
+    assert sorted(rows[1:]) == sorted(read_rows(complete.file_name)[1:])
@@ -0,0 +1,58 @@
+import csv
+import json
+
+import pytest
+
+from benchmarks.synthetic import make_lines
+from powertrack.csv_helper import RowConverter
+from powertrack.sink_helper import CASTS, CSVSink, ColumnarSink, get_column_types
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.ipc  # noqa: E402
+import pyarrow.parquet  # noqa: E402
+
+from powertrack.sink_helper import ArrowSink, ParquetSink  # noqa: E402
+
+
+ARROW_TYPES = {"string": pyarrow.string(), "int": pyarrow.int64(), "bool": pyarrow.bool_()}
+
+
+@pytest.fixture(scope="module")
+def rows():
+    converter = RowConverter()
+    return converter.header, [row for row in (converter.convert(json.loads(line)) for line in make_lines(1200)) if row is not None]
+
+
+def read_table(sink_class, file_name):
+    if sink_class is ParquetSink:
+        return pyarrow.parquet.read_table(file_name)
+    return pyarrow.ipc.open_file(pyarrow.OSFile(file_name)).read_all()
+
+
+def test_columnar_sink_is_abstract(tmpdir):
+    with pytest.raises(TypeError):
+        ColumnarSink(str(tmpdir.join("rows")), ["id"])
+
+
+@pytest.mark.parametrize("sink_class", [ParquetSink, ArrowSink])
+def test_columnar_files_match_csv(tmpdir, rows, sink_class):
+    header, data = rows
+    csv_file_name = str(tmpdir.join("rows.csv"))
+    file_name = str(tmpdir.join("rows.columnar"))
+    for sink in (CSVSink(csv_file_name, header), sink_class(file_name, header, batch_size=300)):
+        sink.writerows(data[:500])
+        for row in data[500:]:
+            sink.writerow(row)
+        sink.close()
+
+    with open(csv_file_name) as csv_file:
+        csv_reader = csv.reader(csv_file)
+        assert next(csv_reader) == header
+        casts = [CASTS[column_type] for column_type in get_column_types(header)]
+        expected = [[cast(value) for cast, value in zip(casts, row)] for row in csv_reader]
+    table = read_table(sink_class, file_name)
+    columns = table.to_pydict()
+
+    assert table.schema.names == header
+    assert [field.type for field in table.schema] == [ARROW_TYPES[column_type] for column_type in get_column_types(header)]
+    assert [[columns[name][i] for name in header] for i in range(table.num_rows)] == expected